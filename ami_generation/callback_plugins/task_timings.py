@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Ansible callback plugin recording the wall-clock time of every task on every host.
+
+Enabled with ANSIBLE_CALLBACKS_ENABLED=task_timings (ANSIBLE_CALLBACK_WHITELIST in older versions),
+writes a JSON list of {"task", "host", "start", "duration_s", "status"} to the file in
+ANSIBLE_TASK_TIMINGS_FILE when the playbook finishes.
+"""
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'task_timings'
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self.timings = []
+        self._task_start = {}
+
+    def _task_name(self, task) -> str:
+        return '{}: {}'.format(task.get_path() or '', task.get_name().strip())
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._task_start[task._uuid] = time.time()
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._task_start[task._uuid] = time.time()
+
+    def _record(self, result, status: str):
+        task = result._task
+        start = self._task_start.get(task._uuid, time.time())
+        self.timings.append({
+            'task': self._task_name(task),
+            'host': result._host.get_name(),
+            'start': start,
+            'duration_s': time.time() - start,
+            'status': status,
+        })
+
+    def v2_runner_on_ok(self, result):
+        self._record(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record(result, 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self._record(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self._record(result, 'unreachable')
+
+    def v2_playbook_on_stats(self, stats):
+        path = os.getenv('ANSIBLE_TASK_TIMINGS_FILE')
+        if path:
+            with open(path, 'w') as f:
+                json.dump(self.timings, f, indent=1)
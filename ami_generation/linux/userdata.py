@@ -7,16 +7,23 @@ import sys
 import logging
 import os
 from subprocess import check_call, call, check_output, DEVNULL
+import itertools
 import json
 import re
 import shutil
 import urllib.request
+import urllib.error
 import tempfile
-from typing import List
+import threading
+from typing import List, Dict, Tuple, Optional, NamedTuple, Callable
 import shutil
 import time
 
 
+# Ephemeral raid set up at boot: (raid device, mount point, level), ex. ('/dev/md0', '/mnt/ephemeral', '0')
+EPHEMERAL_RAID = None
+
+
 def _scall(*args, **kwargs):
     """
     Call 'subprocess.call' silently
@@ -42,179 +49,681 @@ def _not(func):
     return not_func
 
 
-class BlockDeviceState:
-    '''Cache for block devices from lsblk'''
-    @staticmethod
-    def blockdevices() -> List[object]:
-        lsblk_j = check_output(["lsblk", "-J"]).decode('utf-8')
-        blockdevices = json.loads(lsblk_j)['blockdevices']
-        return blockdevices
-
-    @staticmethod
-    def _is_mounted(x) -> bool:
-        if x['mountpoint']:
-            return True
-        if 'children' in x:
-            for children in x['children']:
-                if children['mountpoint']:
-                    return True
-        return False
+INSTANCE_STORE_MODEL = 'Amazon EC2 NVMe Instance Storage'
+
+
+def _read_sys(path: str, default: str = '') -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return default
 
-    @staticmethod
-    def _is_root(x) -> bool:
-        def is_root_(x):
-            return x['mountpoint'] == '/' or x['mountpoint'] == '[SWAP]'
-        if is_root_(x):
-            return True
-        if 'children' in x:
-            for children in x['children']:
-                if is_root_(children):
-                    return True
-            return False
-
-    @staticmethod
-    def _dev_path(x) -> str:
-        return '/dev/{}'.format(x['name'])
-
-    def _partitions(blockdevices) -> List[object]:
+
+class BlockDevice(NamedTuple):
+    """Disk from /sys/block"""
+    name: str
+    model: str
+    # bytes
+    size: int
+    rotational: bool
+    queue_depth: int
+    discard: bool
+    partitions: Tuple[str, ...]
+    mountpoints: Tuple[str, ...]
+
+    @property
+    def path(self) -> str:
+        return '/dev/{}'.format(self.name)
+
+    @property
+    def instance_store(self) -> bool:
+        return self.model == INSTANCE_STORE_MODEL
+
+
+class BlockDeviceState:
+    """
+    Disks of the instance read from /sys/block. Ephemeral devices are the NVMe instance store
+    devices, identified by their model, so EBS volumes are never taken. On Xen instances, where
+    there's no model, the instance store devices come from the block device mapping in the
+    instance metadata.
+    """
+    def __init__(self, root: str = '/', ephemeral_names: Optional[List[str]] = None):
         """
-        :returns: list of /dev/[device][partition] strings
+        :param root: of sys and proc, a fake tree for tests
+        :param ephemeral_names: names of the non NVMe instance store devices, ex. xvdb, from the
+            instance metadata if None
         """
-        partitions = []
-        for x in blockdevices:
-            if 'children' in x:
-                for child in x['children']:
-                    if child['type'] == 'part':
-                        partitions.append(_dev_path(child))
-        return partitions
+        self.root = root
+        self._ephemeral_names = ephemeral_names
+        self.reload()
 
+    def _mountpoints(self) -> Dict[str, List[str]]:
+        res = {}
+        for line in _read_sys(os.path.join(self.root, 'proc/self/mounts')).splitlines():
+            fields = line.split()
+            if len(fields) > 1 and fields[0].startswith('/dev/'):
+                res.setdefault(fields[0][len('/dev/'):], []).append(fields[1])
+        return res
 
-    def __init__(self):
-        self.reload()
+    def _device(self, name: str, mounts: Dict[str, List[str]]) -> BlockDevice:
+        sys_dir = os.path.join(self.root, 'sys/block', name)
+        partitions = tuple(sorted(x for x in os.listdir(sys_dir)
+                                  if os.path.exists(os.path.join(sys_dir, x, 'partition'))))
+        queue_depth = (_read_sys(os.path.join(sys_dir, 'device/queue_depth'))
+                       or _read_sys(os.path.join(sys_dir, 'queue/nr_requests'), '0'))
+        return BlockDevice(
+            name=name,
+            model=_read_sys(os.path.join(sys_dir, 'device/model')),
+            size=int(_read_sys(os.path.join(sys_dir, 'size'), '0')) * 512,
+            rotational=_read_sys(os.path.join(sys_dir, 'queue/rotational')) == '1',
+            queue_depth=int(queue_depth),
+            discard=int(_read_sys(os.path.join(sys_dir, 'queue/discard_max_bytes'), '0')) > 0,
+            partitions=partitions,
+            mountpoints=tuple(itertools.chain.from_iterable(mounts.get(x, []) for x in (name,) + partitions)))
 
     def reload(self):
-        self.blockdevices = BlockDeviceState.blockdevices()
+        mounts = self._mountpoints()
+        sys_block = os.path.join(self.root, 'sys/block')
+        # disks have a device, unlike loop, md, dm and ram devices
+        self.devices = [self._device(x, mounts) for x in sorted(os.listdir(sys_block))
+                        if os.path.exists(os.path.join(sys_block, x, 'device'))]
+
+    def ephemeral_names(self) -> List[str]:
+        if self._ephemeral_names is None:
+            self._ephemeral_names = []
+            if any(not x.model for x in self.devices):
+                self._ephemeral_names = _metadata_ephemeral_names()
+        return self._ephemeral_names
+
+    def ephemeral(self) -> List[BlockDevice]:
+        return [x for x in self.devices if x.instance_store or (not x.model and x.name in self.ephemeral_names())]
 
     def ephemeral_devs(self) -> List[str]:
-        ephemeral = list(filter(lambda x: not BlockDeviceState._is_root(x) and not BlockDeviceState._is_mounted(x) and x['type'] == 'disk',
-            self.blockdevices))
-        devs = map(BlockDeviceState._dev_path, ephemeral)
-        return list(devs)
+        return [x.path for x in self.ephemeral()]
 
     def ephemeral_partitions(self) -> List[str]:
-        partitions = []
-        for b in self.blockdevices:
-            if 'children' in b and not BlockDeviceState._is_root(b) and b['type'] == 'disk':
-                for child in b['children']:
-                    if child['type'] == 'part':
-                        partitions.append(BlockDeviceState._dev_path(child))
-        return partitions
-
-
-def _clear_gpt(x):
-    with open(x, "w+") as f:
-        f.seek(0)
-        f.write('\0' * 34 * 512)
-        f.seek(0, 2)
-        sz = f.tell()
-        f.seek(sz - 34 * 512)
-        f.write('\0' * 34 * 512)
-
-
-def create_raid_partitions() -> List[str]:
-    state = BlockDeviceState()
+        return ['/dev/{}'.format(p) for x in self.ephemeral() for p in x.partitions]
+
+
+def _metadata_ephemeral_names() -> List[str]:
+    """:returns: device names of the instance store volumes in the block device mapping, sdb -> xvdb"""
+    res = []
+    try:
+        for x in instance_metadata.get('meta-data/block-device-mapping/').split():
+            if x.startswith('ephemeral'):
+                name = instance_metadata.get('meta-data/block-device-mapping/{}'.format(x)).split('/')[-1]
+                res.append(re.sub('^sd', 'xvd', name))
+    except OSError as e:
+        logging.warning("Instance store devices from the instance metadata: %s", e)
+    return res
+
+
+class InstanceMetadata:
+    """
+    EC2 instance metadata service client. Uses IMDSv2 session tokens, cached until they are about to
+    expire, and falls back to IMDSv1 if tokens are not available. Documents that can't change during
+    the life of the instance are memoized.
+    """
+    IMMUTABLE = {
+        'dynamic/instance-identity/document',
+        'meta-data/ami-id',
+        'meta-data/instance-id',
+        'meta-data/instance-type',
+        'meta-data/placement/availability-zone',
+        'meta-data/placement/region',
+    }
+
+    def __init__(self, endpoint: str = None, token_ttl_s: int = 21600, timeout_s: float = 1.0, tries: int = 3):
+        self.endpoint = (endpoint or os.getenv('AWS_EC2_METADATA_SERVICE_ENDPOINT', 'http://169.254.169.254'))
+        self.token_ttl_s = token_ttl_s
+        self.timeout_s = timeout_s
+        self.tries = tries
+        self._lock = threading.Lock()
+        self._token = None
+        self._token_expires = 0
+        self._cache = {}
+
+    def token(self, refresh: bool = False) -> str:
+        """:returns: IMDSv2 session token or None if the service only supports IMDSv1"""
+        import time
+        with self._lock:
+            if refresh or time.time() > self._token_expires - 60:
+                request = urllib.request.Request(
+                    self.endpoint.rstrip('/') + '/latest/api/token', method='PUT',
+                    headers={'X-aws-ec2-metadata-token-ttl-seconds': str(self.token_ttl_s)})
+                try:
+                    with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+                        self._token = response.read().decode('utf-8')
+                except OSError as e:
+                    # HTTPError, or URLError and socket.timeout from services which don't answer the PUT
+                    logging.debug("IMDSv2 token not available (%s), using IMDSv1", e)
+                    self._token = None
+                self._token_expires = time.time() + self.token_ttl_s
+            return self._token
+
+    def _get(self, path: str, token: str) -> str:
+        headers = {'X-aws-ec2-metadata-token': token} if token else {}
+        request = urllib.request.Request('{}/latest/{}'.format(self.endpoint.rstrip('/'), path), headers=headers)
+        with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+            return response.read().decode('utf-8')
+
+    def get(self, path: str) -> str:
+        """:param path: path under /latest, ex. 'meta-data/instance-type'"""
+        import time
+        path = path.strip('/')
+        if path in self._cache:
+            return self._cache[path]
+        for attempt in range(1, self.tries + 1):
+            try:
+                res = self._get(path, self.token(refresh=attempt > 1))
+                break
+            except urllib.error.HTTPError as e:
+                # 401 is an expired token, retried with a new one
+                if e.code != 401 or attempt == self.tries:
+                    raise
+            except OSError as e:
+                if attempt == self.tries:
+                    raise
+                logging.debug("Instance metadata %s: %s, retrying", path, e)
+                time.sleep(0.1 * attempt)
+        if path in self.IMMUTABLE:
+            self._cache[path] = res
+        return res
+
+    def get_many(self, paths) -> Dict[str, str]:
+        """Fetch several paths concurrently, :returns: dict of path -> value"""
+        from concurrent.futures import ThreadPoolExecutor
+        paths = list(paths)
+        self.token()
+        with ThreadPoolExecutor(max(len(paths), 1)) as executor:
+            return dict(zip(paths, executor.map(self.get, paths)))
+
+    def identity(self) -> Dict:
+        return json.loads(self.get('dynamic/instance-identity/document'))
+
+    def instance_type(self) -> str:
+        return self.get('meta-data/instance-type')
+
+
+# Shared by everything in the process so the token and immutable documents are fetched once
+instance_metadata = InstanceMetadata()
+
+
+SECTOR_SIZE = 512
+# Protective MBR, GPT header and partition entries at the start, entries and backup header at the end
+GPT_PRIMARY_SECTORS = 34
+GPT_BACKUP_SECTORS = 33
+BLKDISCARD = 0x1277
+BLKSECDISCARD = 0x127d
+
+
+def _device_size(fd: int) -> int:
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def discard_device(dev: str, secure: bool = False) -> bool:
+    """
+    Discard all the blocks of dev, instance store NVMe devices read zeros afterwards
+    :returns: True if the device supports it
+    """
+    import fcntl
+    import struct
+    if not _is_block_device(dev):
+        return False
+    fd = os.open(dev, os.O_WRONLY)
+    try:
+        fcntl.ioctl(fd, BLKSECDISCARD if secure else BLKDISCARD, struct.pack('QQ', 0, _device_size(fd)))
+        return True
+    except OSError as e:
+        logging.debug("Discard of %s not supported: %s", dev, e)
+        return False
+    finally:
+        os.close(fd)
+
+
+def zero_gpt(dev: str) -> None:
+    """Zero the primary and backup GPT regions of dev, which also clears an MBR"""
+    fd = os.open(dev, os.O_WRONLY)
+    try:
+        size = _device_size(fd)
+        head = min(GPT_PRIMARY_SECTORS * SECTOR_SIZE, size)
+        os.pwrite(fd, bytes(head), 0)
+        tail = min(GPT_BACKUP_SECTORS * SECTOR_SIZE, size - head)
+        if tail > 0:
+            os.pwrite(fd, bytes(tail), size - tail)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def wipe_device(dev: str, discard: bool = True) -> str:
+    """
+    Wipe the partition table of dev, discarding the whole NVMe device if possible
+    :returns: method used, 'discard' or 'zero'
+    """
+    if discard and 'nvme' in os.path.basename(dev) and discard_device(dev):
+        return 'discard'
+    zero_gpt(dev)
+    return 'zero'
+
+
+def wipe_devices(devs: List[str], discard: bool = True) -> Dict[str, Tuple[str, float]]:
+    """
+    Wipe the devices concurrently
+    :returns: dict of device -> (method, seconds)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def wipe(dev: str) -> Tuple[str, float]:
+        start = time.time()
+        method = wipe_device(dev, discard)
+        return method, time.time() - start
+
+    with ThreadPoolExecutor(max(len(devs), 1)) as executor:
+        return dict(zip(devs, executor.map(wipe, devs)))
+
+
+def partition_path(dev: str, number: int = 1) -> str:
+    """:returns: path of a partition of dev, /dev/xvdb -> /dev/xvdb1, /dev/nvme1n1 -> /dev/nvme1n1p1"""
+    return '{}{}{}'.format(dev, 'p' if dev[-1].isdigit() else '', number)
+
+
+def _is_block_device(path: str) -> bool:
+    import stat
+    try:
+        return stat.S_ISBLK(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+def _reread_partitions(dev: str) -> None:
+    """Ask the kernel to re-read the partition table of dev, as partprobe"""
+    import fcntl
+    BLKRRPART = 0x125f
+    try:
+        fd = os.open(dev, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, BLKRRPART)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logging.warning("Re-reading the partitions of %s: %s", dev, e)
+
+
+def _wait_partition(dev: str, part: str, deadline: float) -> None:
+    """
+    Wait until the kernel and udev show the new partition of dev, re-reading the partition table if
+    it doesn't show up. File backed stand-in devices have no partition devices, so there's no wait.
+    :raises TimeoutError: if the partition is not there at the deadline
+    """
+    if not _is_block_device(dev):
+        return
+    delay = 0.01
+    reread = time.time() + 0.5
+    sysfs_part = os.path.join('/sys/class/block', os.path.basename(part))
+    while not (os.path.exists(sysfs_part) and _is_block_device(part)):
+        now = time.time()
+        if now > deadline:
+            raise TimeoutError("Partition {} of {} didn't appear".format(part, dev))
+        if reread and now > reread:
+            _reread_partitions(dev)
+            reread = None
+        if os.path.exists(sysfs_part) and shutil.which('udevadm'):
+            # the kernel has it, wait for udev to create the device node
+            _scall(['udevadm', 'settle', '--timeout={}'.format(max(int(deadline - now), 1))])
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+
+def prepare_device(dev: str, deadline: float) -> Dict[str, float]:
+    """
+    Wipe dev and create a single raid partition on it
+    :returns: dict of step -> seconds
+    """
+    timings = {}
+    start = time.time()
+    wipe_device(dev)
+    timings['wipe'] = time.time() - start
+    start = time.time()
+    # the wipe already cleared the old GPT and MBR, no need for sgdisk -Z
+    check_call(['sgdisk', '-o', '-n', '1', '-t', '1:fd00', dev], stdout=DEVNULL)
+    timings['partition'] = time.time() - start
+    start = time.time()
+    _wait_partition(dev, partition_path(dev), deadline)
+    timings['settle'] = time.time() - start
+    return timings
+
+
+def partition_devices(devs: List[str], timeout: float = 60) -> Dict[str, Dict[str, float]]:
+    """
+    Prepare all the devices concurrently
+    :param timeout: in seconds for all the partitions to appear
+    :returns: dict of device -> dict of step -> seconds
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    deadline = time.time() + timeout
+    logging.info("Partitioning %s", devs)
+    with ThreadPoolExecutor(max(len(devs), 1)) as executor:
+        timings = dict(zip(devs, executor.map(lambda dev: prepare_device(dev, deadline), devs)))
+    for dev, t in timings.items():
+        logging.info("%s: %s total %.3f s", dev, ' '.join('{} {:.3f} s'.format(k, v) for k, v in t.items()),
+                     sum(t.values()))
+    return timings
+
+
+def create_raid_partitions(state: Optional[BlockDeviceState] = None) -> List[str]:
+    if state is None:
+        state = BlockDeviceState()
     for x in state.ephemeral_partitions():
         _scall(['umount', x])
 
     for x in state.ephemeral_devs():
         _scall(['umount', x])
 
-    for x in state.ephemeral_devs():
-        check_call(['dd','if=/dev/zero','of={}'.format(x),'bs=4096','count=1024'], stderr=DEVNULL, stdout=DEVNULL)
-        logging.info("Partitioning %s", x)
-        #check_call(f'sgdisk -z -o -n 1 -t 1:fd00 {x}'.split(), stderr=DEVNULL, stdout=DEVNULL)
-        _clear_gpt(x)
-        check_call(f'sgdisk -Z {x}'.split(), stdout=DEVNULL)
-        time.sleep(1)
-        check_call(f'sgdisk -o -n 1 -t 1:fd00 {x}'.split(), stdout=DEVNULL)
-        time.sleep(1)
-
-    # reload partitions
-    call(['partprobe'])
-    # wait for partitions to stabilize, otherwise they are not listed
-    time.sleep(3)
-    state.reload()
-    return state.ephemeral_partitions()
-
-
-def add_to_fstab(device, mount) -> None:
-    fstab = []
-    with open("/etc/fstab", "r") as f:
-        for line in f:
-            fields = re.split('\s+', line)
-            device_field = fields[0]
-            if device != device_field:
-                fstab.append(line)
-        fstab.append('{} {} ext4 noatime,discard 0 0'.format(device, mount))
+    devs = state.ephemeral_devs()
+    partition_devices(devs)
+    return [partition_path(x) for x in devs]
 
-    with tempfile.NamedTemporaryFile(delete=False, mode='w+') as f:
-        f.writelines(fstab)
-        f.write('\n')
-        f.close()
-        shutil.move('/etc/fstab', '/etc/fstab.bak')
-        shutil.move(f.name, '/etc/fstab')
 
+FS_BLOCK_SIZE = 4096
+# Mount options of the ephemeral array, discards are left to fstrim instead of every delete
+MOUNT_OPTIONS = {
+    'ext4': 'noatime,nodiscard,commit=60,nofail',
+    'xfs': 'noatime,nodiscard,logbufs=8,logbsize=256k,largeio,swalloc,nofail',
+}
 
-def raid_setup(raid_device, mount, level='0') -> bool:
-    """Create raid device.
-    :param raid_device: device for the raid, ex: /dev/md0
-    :param mount: mount point, ex: /home
+
+class RaidGeometry(NamedTuple):
+    level: str
+    devices: int
+    # data disks a stripe is spread over
+    data_disks: int
+    chunk_kb: int
+    # in filesystem blocks, ext4 stride and stripe_width
+    stride: int
+    stripe_width: int
+
+
+def raid_geometry(level: str, device_sizes: List[int], chunk_kb: Optional[int] = None) -> RaidGeometry:
+    """
+    :param level: '0', '1' or '10'
+    :param device_sizes: of the raid members in bytes
+    :param chunk_kb: raid chunk, by default 512K, or 256K for members smaller than 64 GiB
+    """
+    n = len(device_sizes)
+    if level not in ('0', '1', '10'):
+        raise ValueError("Unsupported raid level {}".format(level))
+    if level in ('1', '10') and n < 2:
+        raise ValueError("Raid {} needs at least 2 devices, got {}".format(level, n))
+    data_disks = {'0': n, '1': 1, '10': max(n // 2, 1)}[level]
+    if chunk_kb is None:
+        chunk_kb = 512 if min(device_sizes) >= 64 * 2**30 else 256
+    stride = chunk_kb * 1024 // FS_BLOCK_SIZE
+    return RaidGeometry(level, n, data_disks, chunk_kb, stride, stride * data_disks)
+
+
+# Space taken by the partition alignment and the GPT of each member
+PARTITION_OVERHEAD = 2 * 2**20
+# Of the array taken by the filesystem metadata, inode tables and journal
+FS_OVERHEAD = 0.03
+
+
+def raid_capacity(geometry: RaidGeometry, device_sizes: List[int]) -> int:
+    """:returns: conservative estimate of the bytes available in the filesystem of the raid"""
+    member = min(device_sizes) - PARTITION_OVERHEAD
+    return int(geometry.data_disks * member * (1 - FS_OVERHEAD))
+
+
+def mdadm_create_cmd(raid_device: str, geometry: RaidGeometry, partitions: List[str]) -> List[str]:
+    cmd = ['mdadm', '--create', '--force', '--run', '--verbose', raid_device, '--level={}'.format(geometry.level),
+           '--raid-devices={}'.format(len(partitions))]
+    if geometry.level == '1':
+        # the members are blank, there's nothing to resync
+        cmd.extend(['--assume-clean', '--bitmap=internal'])
+    else:
+        cmd.append('--chunk={}K'.format(geometry.chunk_kb))
+        if geometry.level == '10':
+            cmd.extend(['--assume-clean', '--bitmap=internal'])
+    cmd.extend(partitions)
+    return cmd
+
+
+def mkfs_cmd(device: str, fs_type: str, geometry: RaidGeometry, label: Optional[str] = None) -> List[str]:
+    """:returns: mkfs command aligned to the raid stripes which doesn't initialize or discard the device"""
+    # a mirror has no stripes to align to
+    striped = geometry.level != '1'
+    if fs_type == 'ext4':
+        extended = ['lazy_itable_init=1', 'lazy_journal_init=1', 'nodiscard']
+        if striped:
+            extended[:0] = ['stride={}'.format(geometry.stride), 'stripe_width={}'.format(geometry.stripe_width)]
+        cmd = ['mkfs.ext4', '-q', '-F', '-m', '0', '-b', str(FS_BLOCK_SIZE), '-E', ','.join(extended)]
+    elif fs_type == 'xfs':
+        cmd = ['mkfs.xfs', '-q', '-f', '-K']
+        if striped:
+            cmd.extend(['-d', 'su={}k,sw={}'.format(geometry.chunk_kb, geometry.data_disks)])
+    else:
+        raise ValueError("Unsupported filesystem {}".format(fs_type))
+    if label:
+        cmd.extend(['-L', label])
+    cmd.append(device)
+    return cmd
+
+
+# add_to_fstab is called from concurrent userdata steps
+_fstab_lock = threading.Lock()
+
+
+def add_to_fstab(device, mount, fs_type='ext4', options=None, fstab='/etc/fstab') -> None:
+    """
+    Add the fstab entry of device on mount, replacing the entries of the same device or mount
+    point. The file is replaced atomically, the previous one is kept as fstab.bak.
+    """
+    with _fstab_lock:
+        lines = []
+        with open(fstab, "r") as f:
+            for line in f:
+                fields = re.split(r'\s+', line)
+                device_field = fields[0]
+                # replace the entries of the device or the mount point, tmpfs is not a device
+                if (device != device_field or device == 'tmpfs') and (len(fields) < 2 or fields[1] != mount):
+                    lines.append(line)
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines.append('{} {} {} {} 0 0\n'.format(device, mount, fs_type, options or MOUNT_OPTIONS[fs_type]))
+
+        shutil.copy2(fstab, fstab + '.bak')
+        # in the same directory so the rename is atomic
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fstab), prefix='.fstab.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            shutil.copymode(fstab, tmp)
+            os.replace(tmp, fstab)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def _size(path: str) -> int:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return _device_size(fd)
+    finally:
+        os.close(fd)
+
+
+def create_raid(raid_device, level='0', fs_type='ext4', chunk_kb=None) -> bool:
+    """Create the raid device on the ephemeral drives and format it, see raid_setup
     :returns: True if the raid was created, False otherwise
     """
-    logging.info("Raid setup, device: %s, mount point: %s", raid_device, mount)
     _scall(['umount', raid_device])
     # some instances mount the first ephemeral in /mnt
     _scall(['umount', '/mnt'])
     _scall(["mdadm", "--stop", raid_device])
 
     state = BlockDeviceState()
+    for x in state.devices:
+        logging.info("%s", x)
     if len(state.ephemeral_devs()) < 1:
-        logging.error("raid_setup: Need at least one ephemeral drive that is not in use to configure the raid, aborting.")
+        logging.error("raid_setup: Need at least one ephemeral drive that is not in use to configure the raid, "
+                      "aborting.")
         return False
 
-    partitions = create_raid_partitions()
+    partitions = create_raid_partitions(state)
     logging.info("Created partitions %s", partitions)
-    state.reload()
+    try:
+        geometry = raid_geometry(str(level), [_size(x) for x in partitions], chunk_kb)
+    except ValueError as e:
+        logging.error("raid_setup: %s, aborting.", e)
+        return False
+    logging.info("Raid geometry: %s", geometry)
 
     # Create raid
-    cmd = ['mdadm', '--create', '--force', '--verbose', raid_device, '--level={}'.format(level), '-c256K',
-        '--raid-devices={}'.format(len(partitions))]
-    cmd.extend(partitions)
-    check_call(cmd, stdout=DEVNULL)
+    check_call(mdadm_create_cmd(raid_device, geometry, partitions), stdout=DEVNULL)
 
     check_call("mdadm --detail --scan > /etc/mdadm.conf", shell=True, stdout=DEVNULL)
 
     # format fs
-    check_call(['mkfs', '-q',  '-t', 'ext4', '-F', '-m', '0', raid_device])
+    check_call(mkfs_cmd(raid_device, fs_type, geometry))
+    return True
+
 
-    add_to_fstab(raid_device, mount)
+def raid_setup(raid_device, mount, level='0', fs_type='ext4', chunk_kb=None) -> bool:
+    """Create raid device.
+    :param raid_device: device for the raid, ex: /dev/md0
+    :param mount: mount point, ex: /home
+    :param level: 0, 1 or 10, 1 and 10 are created with --assume-clean and a write intent bitmap
+    :param fs_type: ext4 or xfs
+    :param chunk_kb: raid chunk, see raid_geometry
+    :returns: True if the raid was created, False otherwise
+    """
+    logging.info("Raid setup, device: %s, mount point: %s", raid_device, mount)
+    if not create_raid(raid_device, level, fs_type, chunk_kb):
+        return False
+    add_to_fstab(raid_device, mount, fs_type)
     os.makedirs(mount, exist_ok=True)
     check_call(['mount', mount])
     return True
 
 
-def raid_setup_file_preserving(raid_dev, mount_point, level='0'):
+def _disk_usage(path: str) -> int:
+    """:returns: bytes used by the tree at path, without crossing filesystems"""
+    return int(check_output(['du', '-sxB1', path]).split()[0])
+
+
+def _fs_used(path: str) -> int:
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+def _log_copy_progress(dst: str, base_used: int, total: int, done, interval_s: float = 5) -> None:
+    while not done.wait(interval_s):
+        copied = _fs_used(dst) - base_used
+        logging.info("Copied %.1f / %.1f GiB (%.0f%%)", copied / 2**30, total / 2**30, 100 * copied / max(total, 1))
+
+
+def copy_tree(src: str, dst: str, workers: int = 4, total: Optional[int] = None) -> None:
+    """
+    Copy the contents of src into dst with cp -a, the top level entries are split between the
+    workers. Logs the aggregate progress instead of every file.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    entries = [os.path.join(src, x) for x in os.listdir(src)]
+    if not entries:
+        return
+    if total is None:
+        total = _disk_usage(src)
+    done = threading.Event()
+    progress = threading.Thread(target=_log_copy_progress, args=(dst, _fs_used(dst), total, done), daemon=True)
+    progress.start()
+    try:
+        if workers <= 1 or len(entries) == 1:
+            check_call(['cp', '-a', os.path.join(src, '.'), dst])
+        else:
+            # biggest entries first so a big one doesn't start last
+            entries.sort(key=lambda x: -_disk_usage(x))
+            with ThreadPoolExecutor(workers) as executor:
+                list(executor.map(lambda x: check_call(['cp', '-a', x, dst]), entries))
+    finally:
+        done.set()
+        progress.join()
+
+
+def raid_setup_file_preserving(raid_dev, mount_point, level='0', strategy='copy', workers=4, **raid_args) -> bool:
+    """
+    Create the raid and mount it on mount_point keeping the files that were there. The raid is
+    mounted on a staging directory first and the existing files are copied to it in a single pass.
+
+    :param strategy: 'copy' leaves the original files hidden under the mount point, 'move' deletes
+        them once copied to free the root volume
+    :param workers: parallel copies of the top level entries
+    :param raid_args: fs_type and chunk_kb for create_raid
+    :returns: True if the raid was created
+    :raises RuntimeError: if the files don't fit in the raid, checked before creating it
+    """
     assert mount_point.startswith('/')
-    with tempfile.TemporaryDirectory() as tmpdir:
-        if os.path.exists(mount_point):
-            check_call(['rsync', '-vaP', os.path.join(mount_point,''), tmpdir])
-        success = raid_setup(raid_dev, mount_point, level)
-        if success and os.path.exists(mount_point):
-            check_call(['rsync', '-vaP', os.path.join(tmpdir, ''), mount_point])
+    assert strategy in ('copy', 'move')
+    timings = {}
+    start = time.time()
+    used = _disk_usage(mount_point) if os.path.isdir(mount_point) else 0
+    timings['scan'] = time.time() - start
+    sizes = [x.size for x in BlockDeviceState().ephemeral()]
+    try:
+        capacity = raid_capacity(raid_geometry(str(level), sizes, raid_args.get('chunk_kb')), sizes) if sizes else None
+    except ValueError:
+        # create_raid reports it
+        capacity = None
+    if capacity is not None and used > capacity:
+        raise RuntimeError("{} uses {} bytes, the raid would have about {} free, the disks were not touched".format(
+            mount_point, used, capacity))
+
+    start = time.time()
+    if not create_raid(raid_dev, level, **raid_args):
+        return False
+    timings['raid'] = time.time() - start
+
+    fs_type = raid_args.get('fs_type', 'ext4')
+    staging = tempfile.mkdtemp(prefix='raid_staging_')
+    check_call(['mount', '-t', fs_type, raid_dev, staging])
+    try:
+        st = os.statvfs(staging)
+        if used > st.f_bavail * st.f_frsize:
+            raise RuntimeError("{} uses {} bytes, the raid has {} free".format(
+                mount_point, used, st.f_bavail * st.f_frsize))
+        if used:
+            start = time.time()
+            copy_tree(mount_point, staging, workers, used)
+            timings['copy'] = time.time() - start
+    finally:
+        check_call(['umount', staging])
+        os.rmdir(staging)
+
+    if used and strategy == 'move':
+        start = time.time()
+        for x in os.listdir(mount_point):
+            path = os.path.join(mount_point, x)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        timings['remove'] = time.time() - start
+
+    start = time.time()
+    add_to_fstab(raid_dev, mount_point, fs_type)
+    os.makedirs(mount_point, exist_ok=True)
+    check_call(['mount', mount_point])
+    timings['mount'] = time.time() - start
+    logging.info("Raid on %s: %s, %.2f GiB preserved%s", mount_point,
+                 ' '.join('{} {:.1f} s'.format(k, v) for k, v in timings.items()), used / 2**30,
+                 ' at {:.0f} MiB/s'.format(used / 2**20 / timings['copy']) if timings.get('copy') else '')
+    return True
 
 
 def set_hostname() -> None:
-    ip = urllib.request.urlopen('http://169.254.169.254/latest/meta-data/public-ipv4').read().decode()
+    ip = instance_metadata.get('meta-data/public-ipv4')
     ip = ip.replace('.', '-')
     with open('/etc/hostname', 'w+') as fh:
         fh.write(ip)
@@ -222,14 +731,354 @@ def set_hostname() -> None:
     check_call(['hostname', '-F', '/etc/hostname'])
 
 
+class Relocation(NamedTuple):
+    """Directory moved off the root volume at boot, see RELOCATIONS"""
+    path: str
+    # systemd units stopped during the move and started again if they were running
+    services: Tuple[str, ...] = ()
+    # 'bind': directory on the ephemeral raid bind mounted on path, 'tmpfs': tmpfs mounted on path
+    mode: str = 'bind'
+    owner: Optional[str] = None
+    # of the instance memory, for tmpfs
+    tmpfs_fraction: float = 0.1
+
+
+# Directories moved to the ephemeral raid (EPHEMERAL_RAID) or to tmpfs at boot
+RELOCATIONS = [
+    Relocation('/var/lib/docker', ('docker.socket', 'docker')),
+    Relocation('/home/jenkins_slave/workspace', owner='jenkins_slave'),
+    Relocation('/home/jenkins_slave/.ccache', owner='jenkins_slave'),
+    #Relocation('/home/jenkins_slave/.cache/pip', mode='tmpfs', owner='jenkins_slave', tmpfs_fraction=0.05),
+]
+
+
+def _service_active(unit: str) -> bool:
+    return call(['systemctl', 'is-active', '--quiet', unit]) == 0
+
+
+class MountInfo(NamedTuple):
+    """Entry of /proc/self/mountinfo"""
+    # major:minor of the filesystem
+    device: str
+    # directory of the filesystem mounted, / unless it's a bind mount
+    root: str
+    mount_point: str
+    fs_type: str
+    source: str
+
+
+def mount_info(path: str, mountinfo: str = '/proc/self/mountinfo') -> Optional[MountInfo]:
+    """:returns: the mount on path, the top one if several are stacked, None if it's not a mount point.
+    os.path.ismount doesn't see bind mounts from the same filesystem."""
+    path = os.path.realpath(path)
+    res = None
+    with open(mountinfo) as f:
+        for line in f:
+            fields, _, fs_fields = line.partition(' - ')
+            fields = fields.split()
+            fs_fields = fs_fields.split()
+            if len(fields) > 4 and len(fs_fields) > 1 and fields[4] == path:
+                res = MountInfo(fields[2], fields[3], fields[4], fs_fields[0], fs_fields[1])
+    return res
+
+
+def _mem_total() -> int:
+    """:returns: bytes of memory of the instance"""
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("MemTotal not found in /proc/meminfo")
+
+
+def _relocated(target: Relocation, mount: MountInfo, array_mount: Optional[str]) -> bool:
+    """:returns: True if mount, the one on target.path, is already the relocation of target"""
+    if target.mode == 'tmpfs':
+        return mount.fs_type == 'tmpfs'
+    array = mount_info(array_mount) if array_mount else None
+    return array is not None and mount.device == array.device
+
+
+def relocate(target: Relocation, array_mount: Optional[str] = None) -> None:
+    """
+    Mount target.path from the ephemeral raid mounted on array_mount, or from a tmpfs, keeping its
+    contents. The services are stopped meanwhile. Nothing is done if path is already mounted from
+    the raid or a tmpfs, other mounts on path, like a bind mount from the root volume, are replaced.
+    """
+    import pwd
+    path = target.path
+    mount = mount_info(path) if os.path.exists(path) else None
+    if mount and _relocated(target, mount, array_mount):
+        logging.info("%s is already relocated", path)
+        return
+    start = time.time()
+    stopped = [x for x in target.services if _service_active(x)]
+    for unit in stopped:
+        check_call(['systemctl', 'stop', unit])
+    try:
+        os.makedirs(path, exist_ok=True)
+        if target.mode == 'bind':
+            assert array_mount, "bind relocations need the ephemeral raid"
+            src = os.path.join(array_mount, path.lstrip('/'))
+            os.makedirs(src, exist_ok=True)
+            copy_tree(path, src)
+            if mount:
+                logging.info("Replacing the mount of %s from %s", path, mount.root)
+                check_call(['umount', path])
+            check_call(['mount', '--bind', src, path])
+            add_to_fstab(src, path, 'none', 'bind,nofail,x-systemd.requires-mounts-for={}'.format(array_mount))
+        elif target.mode == 'tmpfs':
+            size = int(_mem_total() * target.tmpfs_fraction) // 2**20
+            options = 'size={}m,mode={:o},nofail'.format(size, os.stat(path).st_mode & 0o7777)
+            # A mount can't be moved out of a shared mount like / on systemd hosts, the contents
+            # are kept aside while the tmpfs is mounted on path
+            aside = tempfile.mkdtemp(prefix='.relocate_', dir=os.path.dirname(path))
+            try:
+                copy_tree(path, aside)
+                if mount:
+                    check_call(['umount', path])
+                check_call(['mount', '-t', 'tmpfs', '-o', options, 'tmpfs', path])
+                copy_tree(aside, path)
+            finally:
+                shutil.rmtree(aside)
+            add_to_fstab('tmpfs', path, 'tmpfs', options)
+        else:
+            raise ValueError("Unknown relocation mode {}".format(target.mode))
+        if target.owner:
+            pw = pwd.getpwnam(target.owner)
+            os.chown(path, pw.pw_uid, pw.pw_gid)
+    finally:
+        for unit in reversed(stopped):
+            check_call(['systemctl', 'start', unit])
+    logging.info("Relocated %s (%s) in %.1f s, services restarted: %s", path, target.mode, time.time() - start, stopped)
+
+
+# Kernel settings by tuning profile, path glob under /sys or /proc -> value, applied in this order
+_NETWORK_BUFFERS = {
+    'proc/sys/net/core/rmem_max': '67108864',
+    'proc/sys/net/core/wmem_max': '67108864',
+    'proc/sys/net/ipv4/tcp_rmem': '4096 87380 67108864',
+    'proc/sys/net/ipv4/tcp_wmem': '4096 65536 67108864',
+    'proc/sys/net/core/netdev_max_backlog': '30000',
+    'proc/sys/net/core/somaxconn': '4096',
+}
+# With no scheduler nr_requests is already the hardware queue depth, which is its limit
+_NVME_QUEUES = {
+    'sys/block/nvme*/queue/scheduler': 'none',
+}
+_CPU_PERFORMANCE = {
+    'sys/devices/system/cpu/cpu*/cpufreq/scaling_governor': 'performance',
+}
+# C-states deeper than C1
+_NO_DEEP_CSTATES = {
+    'sys/devices/system/cpu/cpu*/cpuidle/state[2-9]/disable': '1',
+}
+TUNING_PROFILES = {
+    'build': dict(
+        _CPU_PERFORMANCE, **_NVME_QUEUES, **{
+            'sys/kernel/mm/transparent_hugepage/enabled': 'madvise',
+            'sys/block/md*/queue/read_ahead_kb': '4096',
+            'proc/sys/vm/dirty_ratio': '40',
+            'proc/sys/vm/dirty_background_ratio': '10',
+            'proc/sys/vm/swappiness': '10',
+        }),
+    'gpu-train': dict(
+        _CPU_PERFORMANCE, **_NO_DEEP_CSTATES, **_NVME_QUEUES, **_NETWORK_BUFFERS, **{
+            'sys/kernel/mm/transparent_hugepage/enabled': 'always',
+            'sys/kernel/mm/transparent_hugepage/defrag': 'madvise',
+            'sys/block/md*/queue/read_ahead_kb': '8192',
+        }),
+    'network-bench': dict(
+        _CPU_PERFORMANCE, **_NO_DEEP_CSTATES, **_NETWORK_BUFFERS, **{
+            'sys/kernel/mm/transparent_hugepage/enabled': 'never',
+            'proc/sys/net/ipv4/tcp_low_latency': '1',
+        }),
+}
+# Tuning profile by instance family, 'build' for the rest
+FAMILY_PROFILES = {
+    'p2': 'gpu-train', 'p3': 'gpu-train', 'p3dn': 'network-bench', 'p4d': 'gpu-train', 'g3': 'gpu-train',
+    'g3s': 'gpu-train', 'g4dn': 'gpu-train', 'c5n': 'network-bench',
+}
+# Profile applied at boot, 'auto' to choose it from the instance family, None to leave the kernel as is
+TUNING_PROFILE = None
+
+
+def tuning_profile(instance_type: str) -> str:
+    """:returns: tuning profile for an instance type, ex. p3.16xlarge -> gpu-train"""
+    return FAMILY_PROFILES.get(instance_type.split('.')[0], 'build')
+
+
+def _current_setting(value: str) -> str:
+    """:returns: selected value of a sysfs choice list, 'always [madvise] never' -> 'madvise', or value"""
+    m = re.search(r'\[([^\]]+)\]', value)
+    return m.group(1) if m else ' '.join(value.split())
+
+
+def apply_tuning(profile: str, root: str = '/', record_file: Optional[str] = '/root/tuning_changes.json') -> List[Dict]:
+    """
+    Apply the settings of a tuning profile which are not already set, read them back to verify them.
+    Settings not supported by the instance, like cpufreq on most EC2 instances, are skipped.
+
+    :param root: of sys and proc, a fake tree for tests
+    :param record_file: every change made is added to this file, keeping the original value of a
+        setting from the first time it was changed
+    :returns: list of changes made, dict with path, old, new and ok
+    """
+    import glob
+    changes = []
+    # in the order of the profile, ex. a scheduler change resets the settings of the queue
+    for pattern, value in TUNING_PROFILES[profile].items():
+        for path in sorted(glob.glob(os.path.join(root, pattern))):
+            try:
+                old = _current_setting(_read_sys(path))
+                if old == value:
+                    continue
+                with open(path, 'w') as f:
+                    f.write(value)
+                new = _current_setting(_read_sys(path))
+                changes.append({'path': os.path.join('/', os.path.relpath(path, root)), 'old': old, 'new': new,
+                                'ok': new == value})
+            except OSError as e:
+                changes.append({'path': os.path.join('/', os.path.relpath(path, root)), 'old': old, 'new': None,
+                                'ok': False, 'error': str(e)})
+    failed = [x['path'] for x in changes if not x['ok']]
+    logging.info("Tuning profile %s: %d settings changed%s", profile, len(changes),
+                 ', not applied: {}'.format(failed) if failed else '')
+    if record_file and changes:
+        recorded = {}
+        if os.path.exists(record_file):
+            with open(record_file) as f:
+                recorded = {x['path']: x for x in json.load(f)}
+        for x in changes:
+            if x['path'] in recorded:
+                x = dict(x, old=recorded[x['path']]['old'])
+            recorded[x['path']] = dict(x, profile=profile)
+        with open(record_file, 'w') as f:
+            json.dump(list(recorded.values()), f, indent=1)
+    return changes
+
+
+def _tuning_step() -> None:
+    profile = TUNING_PROFILE
+    if profile == 'auto':
+        profile = tuning_profile(instance_metadata.instance_type())
+    apply_tuning(profile)
+
+
+class Step(NamedTuple):
+    name: str
+    func: Callable[[], object]
+    deps: Tuple[str, ...] = ()
+    # the completion marker waits for the required steps
+    required: bool = True
+
+
+def run_steps(steps: List[Step], on_required_done: Optional[Callable[[Dict[str, Dict]], None]] = None,
+              max_workers: Optional[int] = None) -> Dict[str, Dict]:
+    """
+    Run each step in a thread as soon as the steps it depends on succeeded. A step that fails
+    doesn't stop the others, the steps depending on it are skipped.
+
+    :param on_required_done: called with the results once all the required steps are done
+    :returns: dict of step name -> dict with status ('ok', 'failed' or 'skipped'), start_s,
+        duration_s and error
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    by_name = {x.name: x for x in steps}
+    for step in steps:
+        unknown = [x for x in step.deps if x not in by_name]
+        if unknown:
+            raise ValueError("Step {} depends on unknown steps {}".format(step.name, unknown))
+    started = time.time()
+    results = {}
+    running = {}
+    required_done = on_required_done is None
+
+    def run(step: Step) -> Dict:
+        start = time.time()
+        res = {'status': 'ok', 'start_s': round(start - started, 3)}
+        try:
+            step.func()
+        except Exception as e:
+            logging.exception("Step %s failed", step.name)
+            res.update(status='failed', error=str(e))
+        res['duration_s'] = round(time.time() - start, 3)
+        logging.info("Step %s: %s in %.3f s", step.name, res['status'], res['duration_s'])
+        return res
+
+    with ThreadPoolExecutor(max_workers or max(len(steps), 1)) as executor:
+        while len(results) < len(steps):
+            # until no more steps are skipped, the steps are not in dependency order
+            changed = True
+            while changed:
+                changed = False
+                for step in steps:
+                    if step.name in results or step.name in running.values():
+                        continue
+                    deps = [results.get(x, {}).get('status') for x in step.deps]
+                    if any(x in ('failed', 'skipped') for x in deps):
+                        results[step.name] = {'status': 'skipped', 'start_s': None, 'duration_s': 0.0}
+                        logging.warning("Step %s skipped, it depends on %s", step.name, step.deps)
+                        changed = True
+                    elif all(x == 'ok' for x in deps):
+                        running[executor.submit(run, step)] = step.name
+            if not required_done and all(x.name in results for x in steps if x.required):
+                required_done = True
+                on_required_done(results)
+            if len(results) == len(steps):
+                break
+            if not running:
+                raise ValueError("Steps with circular dependencies: {}".format(sorted(set(by_name) - set(results))))
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    if not required_done:
+        on_required_done(results)
+    return results
+
+
+def write_step_timings(results: Dict[str, Dict], fname: str = '/root/userdata_steps.json') -> None:
+    with open(fname, 'w') as f:
+        json.dump(results, f, indent=1)
+
+
+def _raid_step() -> None:
+    if not raid_setup_file_preserving(*EPHEMERAL_RAID):
+        raise RuntimeError("No ephemeral raid on {}".format(EPHEMERAL_RAID[1]))
+
+
+def userdata_steps() -> List[Step]:
+    """:returns: the boot steps of the instance"""
+    steps = [
+        Step('hostname', set_hostname),
+    ]
+    if EPHEMERAL_RAID:
+        steps.append(Step('raid', _raid_step))
+    if TUNING_PROFILE:
+        # after the raid so its read ahead is set
+        steps.append(Step('tuning', _tuning_step, ('raid',) if EPHEMERAL_RAID else ()))
+    for target in RELOCATIONS:
+        if target.mode == 'tmpfs':
+            steps.append(Step('relocate ' + target.path, lambda target=target: relocate(target)))
+        elif EPHEMERAL_RAID:
+            steps.append(Step('relocate ' + target.path, lambda target=target: relocate(target, EPHEMERAL_RAID[1]),
+                              ('raid',)))
+    return steps
+
+
 def main():
     config_logging()
     logging.info("Starting userdata.py")
-    #raid_setup_file_preserving('/dev/md0', '/mnt/ephemeral', '0')
-    set_hostname()
-    write_userdata_complete()
-    logging.info("userdata.py finished")
-    return 0
+
+    def required_done(results: Dict[str, Dict]) -> None:
+        write_step_timings(results)
+        write_userdata_complete()
+
+    results = run_steps(userdata_steps(), required_done)
+    write_step_timings(results)
+    failed = [name for name, x in results.items() if x['status'] != 'ok']
+    logging.info("userdata.py finished%s", ', failed steps: {}'.format(failed) if failed else '')
+    return 1 if failed else 0
 
 
 if __name__ == '__main__':
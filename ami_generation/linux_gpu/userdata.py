@@ -0,0 +1 @@
+../linux/userdata.py
\ No newline at end of file
@@ -26,9 +26,28 @@ import yaml
 import re
 from awsutils import *
 import itertools
+from collections import deque
+import json
+import time
+from typing import List, Dict, Sequence, Tuple, Optional, NamedTuple
 
 
 AMI_LAUNCH_TEMPLATE_FILE = os.getenv('PAQUITO_AMI_LAUNCH_TEMPLATE', 'linux/launch_template.yaml')
+PAQUITO_DIR = os.path.dirname(os.path.abspath(__file__))
+# AMI tag with the summary of the phase durations of the build
+TIMELINE_TAG = 'paquito:timeline'
+
+# Ansible execution profiles, selected with 'ansible-profile' in the launch template
+ANSIBLE_PROFILES = {
+    # Stock ansible settings, the baseline for the task timings
+    'default': {
+        'ANSIBLE_PIPELINING': 'False',
+        'ANSIBLE_SSH_ARGS': '-C -o ControlMaster=auto -o ControlPersist=60s',
+    },
+    'fast': {
+        'ANSIBLE_CONFIG': os.path.join(PAQUITO_DIR, 'ansible_fast.cfg'),
+    },
+}
 
 
 def group_user_data(xs):
@@ -65,7 +84,64 @@ def _create_ami_image(
     return id
 
 
-def _provision(ec2_resource, ec2_client, launch_template) -> None:
+def _launch_options(launch_template) -> List[LaunchOption]:
+    """:returns: instance type / subnet / AZ alternatives from 'launch-options', by priority"""
+    return [LaunchOption(x.get('instance-type', launch_template['instance-type']), x.get('subnet'),
+                         x.get('availability-zone'))
+            for x in launch_template.get('launch-options', [])]
+
+
+def _report_task_timings(launch_template, profile: str, timings: Sequence[Dict]) -> None:
+    """Save the task timings of this profile and log them compared with the default profile"""
+    playbook = launch_template['playbook'].replace(os.sep, '_')
+    timings_dir = cache_dir('paquito', 'task_timings')
+    summary = task_timings_summary(timings)
+    with open(os.path.join(timings_dir, '{}.{}.json'.format(playbook, profile)), 'w') as f:
+        json.dump(summary, f, indent=1)
+    baseline = {}
+    baseline_file = os.path.join(timings_dir, '{}.default.json'.format(playbook))
+    if profile != 'default' and os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+    logging.info("Ansible task timings, profile '%s'%s:\n%s", profile,
+                 " compared with 'default'" if baseline else '', compare_task_timings(summary, baseline))
+
+
+def _ansible_provision(hosts: List[str], launch_template) -> Tuple[Dict[str, bool], List[Dict]]:
+    """
+    Provision the hosts with the playbook and the ansible profile of the launch template
+    :returns: (dict of host -> success, per host task timings)
+    """
+    import tempfile
+    profile = launch_template.get('ansible-profile', 'fast')
+    extra_vars = {}
+    if launch_template.get('apt-cache-dir'):
+        extra_vars['apt_cache_dir'] = os.path.abspath(os.path.expanduser(launch_template['apt-cache-dir']))
+        os.makedirs(extra_vars['apt_cache_dir'], exist_ok=True)
+    timings = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        timings_file = os.path.join(tmpdir, 'task_timings.json')
+        env = ansible_env(
+            ANSIBLE_CALLBACK_PLUGINS=os.path.join(PAQUITO_DIR, 'callback_plugins'),
+            ANSIBLE_CALLBACKS_ENABLED='task_timings',
+            ANSIBLE_CALLBACK_WHITELIST='task_timings',
+            ANSIBLE_TASK_TIMINGS_FILE=timings_file,
+            **ANSIBLE_PROFILES[profile])
+        results = ansible_provision_hosts(hosts, launch_template['username'], launch_template['playbook'],
+                                          launch_template.get('ansible-forks'), env, extra_vars)
+        if os.path.exists(timings_file):
+            with open(timings_file) as f:
+                timings = json.load(f)
+    if timings:
+        _report_task_timings(launch_template, profile, timings)
+    return results, timings
+
+
+def _shared_setup(ec2_resource, ec2_client, launch_templates: Sequence[Dict]) -> List[str]:
+    """
+    Setup shared by all the images built: security group and ssh key pairs
+    :returns: security group ids
+    """
     try:
         logging.info("Creating security groups")
         security_groups = create_ssh_anywhere_sg(ec2_client, ec2_resource)
@@ -74,13 +150,22 @@ def _provision(ec2_resource, ec2_client, launch_template) -> None:
         res = ec2_client.describe_security_groups(GroupNames=['ssh_anywhere'])
         security_groups = [res['SecurityGroups'][0]['GroupId']]
 
-
-    try:
-        ec2_client.import_key_pair(KeyName=launch_template['ssh-key-name'], PublicKeyMaterial=read_file(launch_template['ssh-key-file']))
-    except botocore.exceptions.ClientError as e:
-        logging.info("Continuing: Key pair '%s' might already exist", launch_template['ssh-key-name'])
-
-    aws_account = boto3.client('sts').get_caller_identity()['Account']
+    key_pairs = {(x['ssh-key-name'], x['ssh-key-file']) for x in launch_templates}
+    for key_name, key_file in key_pairs:
+        try:
+            ec2_client.import_key_pair(KeyName=key_name, PublicKeyMaterial=read_file(key_file))
+        except botocore.exceptions.ClientError as e:
+            logging.info("Continuing: Key pair '%s' might already exist", key_name)
+    return security_groups
+
+
+def _launch_hosts(ec2_resource, ec2_client, launch_template, security_groups: List[str],
+                  timeline: Timeline) -> Tuple[List, List[str]]:
+    """
+    Launch the instances of the launch template and wait until they are reachable through ssh
+    :returns: (ec2 instances, public host names)
+    """
+    aws_account = aws_client('sts').get_caller_identity()['Account']
     logging.info("""
 
     AWS Account: %s
@@ -100,46 +185,371 @@ def _provision(ec2_resource, ec2_client, launch_template) -> None:
 
 
     logging.info("creating instances")
-    instances = create_instances(
-        ec2_resource,
-        launch_template['instance-name'],
-        launch_template['instance-type'],
-        launch_template['ssh-key-name'],
-        launch_template['ami'],
-        security_groups,
-        launch_template.get('user-data'),
-        launch_template.get('CreateInstanceArgs', {}))
+    with timeline.phase('create_instances') as phase:
+        instances = create_instances(
+            ec2_resource,
+            launch_template['instance-name'],
+            launch_template['instance-type'],
+            launch_template['ssh-key-name'],
+            launch_template['ami'],
+            security_groups,
+            launch_template.get('user-data'),
+            launch_template.get('CreateInstanceArgs', {}),
+            launch_options=_launch_options(launch_template),
+            tags={'AWSCop': 'DevDesktop'})
+        phase['instances'] = [instance.id for instance in instances]
     try:
-        wait_for_instances(instances)
-        ec2_resource.create_tags(
-            Resources = [instance.id for instance in instances]
-            , Tags = [
-              {'Key': 'AWSCop', 'Value': 'DevDesktop'}
-            ]
-        )
-
-
+        instance_ids = [instance.id for instance in instances]
+
+        from concurrent.futures import ThreadPoolExecutor
+        with timeline.phase('wait_ready') as phase:
+            phase['ready_s'] = {}
+            start = time.time()
+
+            def wait_ssh(host: str) -> str:
+                for _, _, is_open in wait_ports_open([(host, 22)], 300, ssh_banner=True):
+                    if not is_open:
+                        logging.warning("Host %s is not reachable through ssh, trying to continue", host)
+                phase['ready_s'][host] = round(time.time() - start, 3)
+                return host
+
+            # The ssh wait of each host starts as soon as its status checks pass
+            with ThreadPoolExecutor(max(len(instance_ids), 1)) as executor:
+                ready_timeout = launch_template.get('ready-timeout', INSTANCE_READY_TIMEOUT_S)
+                try:
+                    futures = [executor.submit(wait_ssh, record['PublicDnsName'])
+                               for record in iter_ready_instances(ec2_client, instance_ids, timeout=ready_timeout)]
+                except TimeoutError as e:
+                    # impaired instances are of no use, don't leave them running whatever keep-instance says
+                    logging.error("Stopping the instances which are not ready: %s", e)
+                    for instance in instances:
+                        instance.stop()
+                    raise RuntimeError("Instances of '{}' not ready after {} s, they might be impaired: {}".format(
+                        launch_template['image-name'], ready_timeout, e)) from e
+                hosts = [x.result() for x in futures]
+    except:
+        _stop_instances(instances, launch_template)
+        raise
+    return instances, hosts
+
+
+def _stop_instances(instances, launch_template) -> None:
+    if launch_template.get('keep-instance',False):
+        logging.info("Terminate instances")
         for instance in instances:
-            host = instance.public_dns_name
-            logging.info("Waiting for host {}".format(host))
-            wait_port_open(host, 22, 300)
-            if 'playbook' in launch_template:
-                ansible_provision_host(host, launch_template['username'], launch_template['playbook'])
-            logging.info("All done, the following hosts are now available: %s", host)
+            instance.stop()
+
+
+def _run_playbook(hosts: List[str], launch_template, timeline: Timeline, **attrs) -> None:
+    with timeline.phase('ansible', playbook=launch_template['playbook'], **attrs) as phase:
+        results, timings = _ansible_provision(hosts, launch_template)
+        phase['tasks'] = task_timings_summary(timings)
+    failed = [host for host, ok in results.items() if not ok]
+    if failed:
+        raise RuntimeError("Provisioning failed on {}".format(failed))
+
+
+def _wait_and_copy(ec2_client, ami_ids: List[str], launch_template, timeline: Timeline) -> Dict[str, str]:
+    """
+    Wait for the images, then copy the last one to the regions in 'copy-to-regions'
+    :returns: dict of region -> AMI id of the copies
+    """
+    logging.info("Waiting for AMI ids %s", ami_ids)
+    with timeline.phase('wait_image', images=ami_ids):
+        wait_images_available(ec2_client, ami_ids, launch_template.get('image-timeout', 3600))
+    with timeline.phase('copy_image') as phase:
+        copies = copy_image_to_regions(ec2_client, ami_ids[-1], launch_template.get('copy-to-regions', []))
+        phase['copies'] = copies
+    for region, ami_id in copies.items():
+        logging.info("AMI %s copied to %s: %s", ami_ids[-1], region, ami_id)
+    return copies
+
+
+def _provision(ec2_resource, ec2_client, launch_template, security_groups: List[str],
+               timeline: Timeline) -> Optional[str]:
+    """
+    Launch, provision and image an instance as described by the launch template
+    :returns: AMI id, None if the template is not imaged
+    """
+    ami_id = None
+    instances, hosts = _launch_hosts(ec2_resource, ec2_client, launch_template, security_groups, timeline)
+    try:
+        if 'playbook' in launch_template:
+            _run_playbook(hosts, launch_template, timeline)
+        logging.info("All done, the following hosts are now available: %s", hosts)
         instance = next(iter(instances))
         if launch_template['os-type'].lower() == 'linux':
             logging.info("Imaging the first instance: %s", instance.instance_id)
-            ami_id = _create_ami_image(ec2_client, instance.instance_id, launch_template['image-name'],
-                              launch_template['image-description'], launch_template)
-            ami_waiter = ec2_client.get_waiter('image_available')
-            logging.info("Waiting for AMI id %s (this might take a long time)", ami_id)
-            ami_waiter.wait(ImageIds=[ami_id], WaiterConfig={'Delay': 10, 'MaxAttempts': 180})
+            with timeline.phase('create_image'):
+                ami_id = _create_ami_image(ec2_client, instance.instance_id, launch_template['image-name'],
+                                  launch_template['image-description'], launch_template)
+            _wait_and_copy(ec2_client, [ami_id], launch_template, timeline)
+
+    finally:
+        _stop_instances(instances, launch_template)
+    return ami_id
+
+
+#
+# Layered builds
+#
+# With 'layers' in the launch template each playbook stage is imaged once it is applied. The AMI
+# of a stage is tagged with a hash of the base AMI, the user data and the contents of this stage and
+# the previous ones, so a rebuild launches from the deepest stage that didn't change.
+#
+LAYER_HASH_TAG = 'paquito:layer-hash'
+LAYER_NAME_TAG = 'paquito:layer'
+LAYER_IMAGE_TAG = 'paquito:image-name'
+LAYER_ROLE_TAG = 'paquito:role'
+# Flushes the filesystems so the layers can be imaged without rebooting the instance
+LAYER_SYNC_PLAYBOOK = os.path.join(PAQUITO_DIR, 'layer_sync.yml')
+# Files referenced by a playbook which are part of its content hash
+PLAYBOOK_INPUT_RE = re.compile(
+    r"""^[\s-]*(?:import_playbook|include_tasks|import_tasks|include|include_vars|src)\s*:\s*["']?([^"'\s{}]+)""")
+
+
+class Layer(NamedTuple):
+    name: str
+    playbook: str
+    hash: str
+
+
+def _playbook_inputs(playbook: str, inputs: Optional[List[str]] = None) -> List[str]:
+    """:returns: the playbook and the local files it imports or copies, recursively"""
+    if inputs is None:
+        inputs = []
+    if playbook in inputs or not os.path.isfile(playbook):
+        return inputs
+    inputs.append(playbook)
+    with open(playbook) as f:
+        for line in f:
+            m = PLAYBOOK_INPUT_RE.match(line)
+            if m:
+                _playbook_inputs(os.path.normpath(os.path.join(os.path.dirname(playbook), m.group(1))), inputs)
+    return inputs
+
+
+def _hash_files(h, paths: Sequence[str]) -> None:
+    for path in paths:
+        h.update(path.encode())
+        with open(path, 'rb') as f:
+            h.update(f.read())
+
+
+def layer_chain(launch_template) -> List[Layer]:
+    """
+    :returns: the stages of 'layers' in the launch template with their content hash. Each layer is a
+    playbook, or a dict with 'playbook', an optional 'name' and additional 'inputs' files.
+    """
+    import hashlib
+    h = hashlib.sha256()
+    h.update(launch_template['ami'].encode())
+    h.update(str(launch_template['username']).encode())
+    h.update(json.dumps(launch_template.get('CreateInstanceArgs', {}), sort_keys=True).encode())
+    _hash_files(h, [x[0] for x in launch_template.get('user-data', [])])
+    res = []
+    for layer in launch_template['layers']:
+        if isinstance(layer, str):
+            layer = {'playbook': layer}
+        name = layer.get('name', os.path.splitext(os.path.basename(layer['playbook']))[0])
+        h.update(name.encode())
+        inputs = sorted(flatten(glob.glob(x) for x in layer.get('inputs', [])))
+        _hash_files(h, _playbook_inputs(layer['playbook']) + inputs)
+        res.append(Layer(name, layer['playbook'], h.hexdigest()))
+    return res
+
+
+def layer_images(ec2_client, hashes: Optional[Sequence[str]] = None) -> List[Dict]:
+    """:returns: the available images of this account tagged as layers, with one of hashes if given"""
+    filters = [{'Name': 'state', 'Values': ['available']}]
+    if hashes is None:
+        filters.append({'Name': 'tag-key', 'Values': [LAYER_HASH_TAG]})
+    else:
+        filters.append({'Name': 'tag:' + LAYER_HASH_TAG, 'Values': list(hashes)})
+    res = []
+    for page in ec2_client.get_paginator('describe_images').paginate(Owners=['self'], Filters=filters):
+        for image in page['Images']:
+            image['Tags'] = {x['Key']: x['Value'] for x in image.get('Tags', [])}
+            res.append(image)
+    return res
+
+
+def _tag_layer(ec2_client, ami_id: str, launch_template, layer: Layer, role: str) -> None:
+    ec2_client.create_tags(Resources=[ami_id], Tags=[
+        {'Key': LAYER_HASH_TAG, 'Value': layer.hash},
+        {'Key': LAYER_NAME_TAG, 'Value': layer.name},
+        {'Key': LAYER_IMAGE_TAG, 'Value': launch_template['image-name']},
+        {'Key': LAYER_ROLE_TAG, 'Value': role},
+    ])
+
+
+def _provision_layered(ec2_resource, ec2_client, launch_template, security_groups: List[str],
+                       timeline: Timeline) -> str:
+    """
+    Build the image of the launch template from its deepest cached layer, imaging every stage applied
+    :returns: AMI id
+    """
+    with timeline.phase('layer_lookup'):
+        layers = layer_chain(launch_template)
+        cached = {x['Tags'][LAYER_HASH_TAG]: x['ImageId'] for x in layer_images(ec2_client, [x.hash for x in layers])}
+    start = 0
+    for i, layer in enumerate(layers):
+        if layer.hash in cached:
+            start = i + 1
+    if start == len(layers):
+        logging.info("All the layers of '%s' are cached: %s", launch_template['image-name'], cached[layers[-1].hash])
+        timeline.attrs['cached'] = True
+        _wait_and_copy(ec2_client, [cached[layers[-1].hash]], launch_template, timeline)
+        return cached[layers[-1].hash]
+    launch_template = dict(launch_template)
+    if start > 0:
+        logging.info("Starting from cached layer '%s': %s", layers[start - 1].name, cached[layers[start - 1].hash])
+        launch_template['ami'] = cached[layers[start - 1].hash]
+    logging.info("Layers to build: %s", [x.name for x in layers[start:]])
+
+    ami_ids = []
+    instances, hosts = _launch_hosts(ec2_resource, ec2_client, launch_template, security_groups, timeline)
+    try:
+        instance_id = next(iter(instances)).instance_id
+        for layer in layers[start:]:
+            logging.info("Layer '%s' (%s): running %s", layer.name, layer.hash[:12], layer.playbook)
+            _run_playbook(hosts, dict(launch_template, playbook=layer.playbook), timeline, layer=layer.name)
+            with timeline.phase('create_image', layer=layer.name):
+                if layer is layers[-1]:
+                    ami_id = _create_ami_image(ec2_client, instance_id, launch_template['image-name'],
+                                               launch_template['image-description'], launch_template)
+                    _tag_layer(ec2_client, ami_id, launch_template, layer, 'image')
+                else:
+                    ansible_provision_hosts(hosts[:1], launch_template['username'], LAYER_SYNC_PLAYBOOK)
+                    # The image is cached by content hash, the next layer can only write to the instance
+                    # once the snapshots are started or they could capture its changes
+                    image_name = launch_template['image-name']
+                    ami_id = _create_ami_image(ec2_client, instance_id,
+                                               '{} layer {} {}'.format(image_name, layer.name, layer.hash[:16]),
+                                               'paquito layer {} of {}'.format(layer.name, image_name),
+                                               launch_template, reboot=False)
+                    wait_image_snapshots(ec2_client, ami_id)
+                    _tag_layer(ec2_client, ami_id, launch_template, layer, 'layer')
+            ami_ids.append(ami_id)
+        _wait_and_copy(ec2_client, ami_ids, launch_template, timeline)
+    finally:
+        _stop_instances(instances, launch_template)
+    return ami_ids[-1]
+
+
+def stale_layer_images(ec2_client, launch_templates: Sequence[Dict]) -> List[Dict]:
+    """:returns: intermediate layer images of the templates' images which are not in their current layer chain"""
+    image_names = {x['image-name'] for x in launch_templates}
+    current = {layer.hash for x in launch_templates if 'layers' in x for layer in layer_chain(x)}
+    return [x for x in layer_images(ec2_client)
+            if x['Tags'].get(LAYER_IMAGE_TAG) in image_names
+            and x['Tags'].get(LAYER_ROLE_TAG) == 'layer'
+            and x['Tags'][LAYER_HASH_TAG] not in current]
+
+
+def list_layers(ec2_client, launch_templates: Sequence[Dict]) -> None:
+    current = {layer.hash for x in launch_templates if 'layers' in x for layer in layer_chain(x)}
+    print("{:<22} {:<24} {:<16} {:<13} {:<6} {}".format('ami', 'image', 'layer', 'hash', 'state', 'created'))
+    for image in sorted(layer_images(ec2_client), key=lambda x: x['CreationDate']):
+        tags = image['Tags']
+        print("{:<22} {:<24} {:<16} {:<13} {:<6} {}".format(
+            image['ImageId'], tags.get(LAYER_IMAGE_TAG, '-'), tags.get(LAYER_NAME_TAG, '-'),
+            tags[LAYER_HASH_TAG][:12], 'ok' if tags[LAYER_HASH_TAG] in current else 'stale', image['CreationDate']))
+
+
+def gc_layers(ec2_client, launch_templates: Sequence[Dict], dry_run: bool = False) -> List[str]:
+    """
+    Deregister the stale layer images of the templates and delete their snapshots
+    :returns: AMI ids removed
+    """
+    res = []
+    for image in stale_layer_images(ec2_client, launch_templates):
+        snapshots = [x['Ebs']['SnapshotId'] for x in image.get('BlockDeviceMappings', [])
+                     if 'Ebs' in x and 'SnapshotId' in x['Ebs']]
+        logging.info("%s stale layer %s '%s' %s (snapshots %s)", 'Would remove' if dry_run else 'Removing',
+                     image['ImageId'], image['Tags'].get(LAYER_NAME_TAG), image['Tags'][LAYER_HASH_TAG][:12], snapshots)
+        if not dry_run:
+            ec2_client.deregister_image(ImageId=image['ImageId'])
+            for snapshot in snapshots:
+                ec2_client.delete_snapshot(SnapshotId=snapshot)
+        res.append(image['ImageId'])
+    return res
+
+
+def _timeline_dir(launch_template) -> str:
+    if launch_template.get('timeline-dir'):
+        res = os.path.expanduser(launch_template['timeline-dir'])
+        os.makedirs(res, exist_ok=True)
+        return res
+    return cache_dir('paquito', 'timelines')
+
 
+def _save_timeline(ec2_client, timeline: Timeline, ami_id: Optional[str], launch_template) -> str:
+    """
+    Save the build timeline as <AMI id>.json in the timeline dir and tag the AMI with its summary
+    :returns: path of the timeline
+    """
+    import time
+    timeline.attrs['ami'] = ami_id
+    if ami_id:
+        path = os.path.join(_timeline_dir(launch_template), '{}.json'.format(ami_id))
+    else:
+        path = os.path.join(_timeline_dir(launch_template), '{}.{}.failed.json'.format(
+            launch_template['image-name'].replace(' ', '_'),
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime(timeline.started))))
+    timeline.save(path)
+    logging.info("Build timeline %s: %s", path, timeline.summary())
+    if ami_id and not timeline.attrs.get('cached'):
+        ec2_client.create_tags(Resources=[ami_id], Tags=[{'Key': TIMELINE_TAG, 'Value': timeline.summary()}])
+    return path
+
+
+def _build(ec2_client, launch_template, security_groups: List[str], shared: Timeline) -> Optional[str]:
+    """Build one image in a worker thread"""
+    import threading
+    threading.current_thread().name = launch_template.get('image-name', launch_template['instance-name'])
+    timeline = Timeline(launch_template['image-name'], template=launch_template['template'],
+                        instance_type=launch_template['instance-type'], base_ami=launch_template['ami'])
+    for phase in shared.phases:
+        timeline.add(**dict(phase, start_s=phase['start_s'] - (timeline.started - shared.started)))
+    ami_id = None
+    try:
+        # boto3 resources are not thread safe, use the one of this thread
+        provision = _provision_layered if 'layers' in launch_template else _provision
+        ami_id = provision(aws_resource('ec2'), ec2_client, launch_template, security_groups, timeline)
     finally:
-        if launch_template.get('keep-instance',False):
-            logging.info("Terminate instances")
-            for instance in instances:
-                instance.stop()
+        _save_timeline(ec2_client, timeline, ami_id, launch_template)
+    return ami_id
+
+
+def build_images(launch_templates: Sequence[Dict],
+                 parallel: int) -> Dict[str, Tuple[Optional[str], Optional[Exception]]]:
+    """
+    Build the images of several launch templates concurrently, sharing the security group and key setup
+    :param parallel: maximum number of images built at the same time
+    :returns: dict of template file -> (AMI id, exception if the build failed)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    ec2_client = aws_client('ec2')
+    shared = Timeline('shared')
+    with shared.phase('shared_setup'):
+        security_groups = _shared_setup(aws_resource('ec2'), ec2_client, launch_templates)
+    results = {}
+    with ThreadPoolExecutor(max(parallel, 1)) as executor:
+        futures = {x['template']: executor.submit(_build, ec2_client, x, security_groups, shared)
+                   for x in launch_templates}
+        for template, future in futures.items():
+            try:
+                results[template] = (future.result(), None)
+            except Exception as e:
+                logging.exception("Building %s failed", template)
+                results[template] = (None, e)
+    for template, (ami_id, error) in results.items():
+        if error:
+            logging.error("%s: FAILED %s", template, error)
+        else:
+            logging.info("%s: %s", template, ami_id or 'done')
+    return results
 
 
 def parse_args():
@@ -157,9 +567,32 @@ def parse_args():
     parser.add_argument('-m', '--image-name')
     parser.add_argument('-d', '--image-description')
     parser.add_argument('--instance-type')
-
-    parser.add_argument('template', help='template file')
+    parser.add_argument('--ansible-profile', choices=sorted(ANSIBLE_PROFILES.keys()),
+        help="Ansible execution profile, 'default' runs with stock settings to compare task timings")
+    parser.add_argument('--apt-cache-dir',
+        help="Local folder to keep the apt packages downloaded by the instances between builds")
+
+    parser.add_argument('--copy-to-regions', nargs='+', metavar='REGION',
+        help="Copy the image to these regions once it's available")
+    parser.add_argument('--list-layers', action='store_true',
+        help="List the cached layer AMIs, and whether they are current for the given templates")
+    parser.add_argument('--gc-layers', action='store_true',
+        help="Remove the layer AMIs of the given templates which don't match their current playbooks")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+        help="With --gc-layers, only show the layers that would be removed")
+
+    parser.add_argument('--timeline-dir',
+        help="Folder of the build timelines, <AMI id>.json. ~/.cache/awsutils/paquito/timelines by default")
+    parser.add_argument('--compare-timelines', nargs=2, metavar=('CURRENT', 'BASELINE'),
+        help="Compare the phase and ansible task durations of two build timelines")
+
+    parser.add_argument('-j', '--parallel', type=int, default=4,
+        help="Maximum number of images built at the same time")
+
+    parser.add_argument('template', nargs='*', help='template files, their images are built concurrently')
     args = parser.parse_args()
+    if not args.template and not args.compare_timelines:
+        parser.error("the following arguments are required: template")
     return args
 
 
@@ -177,42 +610,64 @@ def script_name() -> str:
 def config_logging():
     import time
     logging.getLogger().setLevel(logging.INFO)
-    logging.basicConfig(format='{}: %(asctime)sZ %(levelname)s %(message)s'.format(script_name()))
+    logging.basicConfig(format='{}: %(asctime)sZ %(levelname)s [%(threadName)s] %(message)s'.format(script_name()))
     logging.Formatter.converter = time.gmtime
 
 
-def main():
-    # Launch a new instance each time by removing the state, otherwise tf will destroy the existing
-    # one first
-    def script_name() -> str:
-        return os.path.split(sys.argv[0])[1]
-
-    config_logging()
-    args = parse_args()
-
+def _load_launch_template(template: str, args) -> Dict:
     launch_template = {
         'keep-instance': False
     }
-    if os.path.exists(args.template):
-        with open(args.template, 'r') as f:
+    if os.path.exists(template):
+        with open(template, 'r') as f:
             launch_template = yaml.load(f, Loader=yaml.SafeLoader)
+    launch_template['template'] = template
 
-    for arg in ['username', 'ssh-key-file', 'ssh-key-name', 'keep-instance', 'instance-type']:
+    for arg in ['username', 'ssh-key-file', 'ssh-key-name', 'keep-instance', 'instance-type',
+                'ansible-profile', 'apt-cache-dir', 'copy-to-regions', 'timeline-dir']:
         argname = arg.replace('-','_')
         if not arg in launch_template and getattr(args, argname):
             launch_template[arg] = getattr(args, argname)
 
     if 'ubuntu' in launch_template:
-        launch_template['ami'] = get_ubuntu_ami(boto3.session.Session().region_name, launch_template['ubuntu'])
+        # The AMI table is downloaded once and shared by all the templates
+        launch_template['ami'] = get_ubuntu_ami(boto3.session.Session().region_name, launch_template['ubuntu'],
+                                                source=launch_template.get('ubuntu-ami-source', 'releases-table'))
+    return launch_template
+
+
+def main():
+    # Launch a new instance each time by removing the state, otherwise tf will destroy the existing
+    # one first
+    def script_name() -> str:
+        return os.path.split(sys.argv[0])[1]
+
+    config_logging()
+    args = parse_args()
+
+    if args.compare_timelines:
+        current, baseline = [Timeline.load(x) for x in args.compare_timelines]
+        print(compare_timelines(current, baseline))
+        return 0
+
+    launch_templates = [_load_launch_template(template, args) for template in args.template]
 
-    ec2_resource = boto3.resource('ec2')
-    ec2_client = boto3.client('ec2')
+    if args.list_layers or args.gc_layers:
+        if args.list_layers:
+            list_layers(aws_client('ec2'), launch_templates)
+        if args.gc_layers:
+            gc_layers(aws_client('ec2'), launch_templates, args.dry_run)
+        return 0
 
     if args.image_instance_id:
-        _create_ami_image(ec2_client, args.image_instance_id, args.image_name, args.image_description, launch_template, True)
+        _create_ami_image(aws_client('ec2'), args.image_instance_id, args.image_name, args.image_description,
+                          launch_templates[0], True)
+        failed = []
     else:
-        _provision(ec2_resource, ec2_client, launch_template)
-    return 0
+        results = build_images(launch_templates, args.parallel)
+        failed = [template for template, (_, error) in results.items() if error]
+    logging.info("AWS clients: %s", client_registry.stats())
+    return 1 if failed else 0
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+AMI_GENERATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# userdata.py is self contained, it runs on the instance before anything is installed
+sys.path.insert(0, os.path.join(AMI_GENERATION_DIR, 'linux'))
+# paquito and the awsutils it imports
+sys.path.insert(0, AMI_GENERATION_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(AMI_GENERATION_DIR), 'awsutils'))
+
+
+@pytest.fixture
+def sparse_device(tmp_path):
+    """:returns: function creating a sparse file standing in for a disk, with data at both ends"""
+    def create(name: str, size: int = 64 * 2**20) -> str:
+        path = str(tmp_path / name)
+        with open(path, 'wb') as f:
+            f.truncate(size)
+            f.write(b'\xaa' * 2**20)
+            f.seek(size - 2**20)
+            f.write(b'\xaa' * 2**20)
+        return path
+    return create
@@ -0,0 +1,50 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+import paquito
+from awsutils import Timeline
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        yield boto3.resource('ec2'), boto3.client('ec2')
+
+
+@pytest.fixture
+def launch_template(aws):
+    _, ec2_client = aws
+    return {
+        'instance-type': 't3.micro', 'ami': ec2_client.describe_images()['Images'][0]['ImageId'],
+        'ssh-key-name': 'paquito', 'ssh-key-file': 'id_rsa.pub', 'instance-name': 'paquito_ami',
+        'image-name': 'linux cpu', 'ready-timeout': 0.5,
+    }
+
+
+def test_hosts_are_returned_once_reachable(aws, launch_template, monkeypatch):
+    monkeypatch.setattr(paquito, 'wait_ports_open', lambda targets, *args, **kwargs: iter([targets[0] + (True,)]))
+    timeline = Timeline('linux cpu')
+
+    instances, hosts = paquito._launch_hosts(*aws, launch_template, [], timeline)
+
+    assert hosts == [instances[0].public_dns_name]
+    assert [x['name'] for x in timeline.phases] == ['create_instances', 'wait_ready']
+    assert list(timeline.phases[-1]['ready_s']) == hosts
+
+
+def test_instances_not_ready_are_stopped(aws, launch_template, monkeypatch):
+    ec2_resource, ec2_client = aws
+
+    def never_ready(ec2_client, instance_ids, timeout=None, **kwargs):
+        assert timeout == 0.5
+        raise TimeoutError("Instances {} not ready after {} s".format(instance_ids, timeout))
+        yield
+    monkeypatch.setattr(paquito, 'iter_ready_instances', never_ready)
+
+    with pytest.raises(RuntimeError, match="Instances of 'linux cpu' not ready after 0.5 s"):
+        paquito._launch_hosts(ec2_resource, ec2_client, launch_template, [], Timeline('linux cpu'))
+
+    states = ec2_client.describe_instances()['Reservations'][0]['Instances']
+    assert [x['State']['Name'] for x in states] == ['stopped']
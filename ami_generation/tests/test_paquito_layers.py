@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+import pytest
+
+import paquito
+from awsutils import Timeline
+from paquito import Layer
+
+LAYERS = [Layer('base', 'base.yml', 'a' * 64), Layer('cuda', 'cuda.yml', 'b' * 64),
+          Layer('final', 'final.yml', 'c' * 64)]
+LAUNCH_TEMPLATE = {'image-name': 'linux gpu', 'image-description': 'gpu image', 'username': 'ubuntu',
+                   'ami': 'ami-base'}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Replaces the AWS and ansible steps of the layered build with recorders of their calls"""
+    calls = []
+    monkeypatch.setattr(paquito, 'layer_chain', lambda launch_template: LAYERS)
+    monkeypatch.setattr(paquito, '_launch_hosts',
+                        lambda *args: ([SimpleNamespace(instance_id='i-1')], ['host']))
+    monkeypatch.setattr(paquito, '_run_playbook',
+                        lambda hosts, launch_template, timeline, layer: calls.append(('playbook', layer)))
+    monkeypatch.setattr(paquito, 'ansible_provision_hosts', lambda *args: calls.append(('sync',)))
+    monkeypatch.setattr(paquito, '_create_ami_image',
+                        lambda ec2_client, instance_id, name, *args, **kwargs:
+                        calls.append(('create_image', name)) or 'ami-{}'.format(len(calls)))
+    monkeypatch.setattr(paquito, 'wait_image_snapshots',
+                        lambda ec2_client, ami_id: calls.append(('snapshots', ami_id)))
+    monkeypatch.setattr(paquito, '_tag_layer', lambda *args: None)
+    monkeypatch.setattr(paquito, '_wait_and_copy',
+                        lambda ec2_client, ami_ids, launch_template, timeline: calls.append(('copy', ami_ids)))
+    monkeypatch.setattr(paquito, '_stop_instances', lambda *args: calls.append(('stop',)))
+    return calls
+
+
+def _cached(monkeypatch, layers):
+    monkeypatch.setattr(paquito, 'layer_images', lambda ec2_client, hashes: [
+        {'ImageId': 'ami-{}'.format(x.name), 'Tags': {paquito.LAYER_HASH_TAG: x.hash}} for x in layers])
+
+
+def test_next_layer_waits_for_the_snapshots(calls, monkeypatch):
+    _cached(monkeypatch, LAYERS[:1])
+
+    ami_id = paquito._provision_layered(None, None, LAUNCH_TEMPLATE, [], Timeline('linux gpu'))
+
+    kinds = [x[0] for x in calls]
+    assert kinds == ['playbook', 'sync', 'create_image', 'snapshots', 'playbook', 'create_image', 'copy', 'stop']
+    assert calls[3] == ('snapshots', 'ami-3')
+    assert calls[-2] == ('copy', ['ami-3', ami_id])
+
+
+def test_cached_image_is_copied(calls, monkeypatch):
+    _cached(monkeypatch, LAYERS)
+    timeline = Timeline('linux gpu')
+
+    assert paquito._provision_layered(None, None, LAUNCH_TEMPLATE, [], timeline) == 'ami-final'
+    assert calls == [('copy', ['ami-final'])]
+    assert timeline.attrs['cached']
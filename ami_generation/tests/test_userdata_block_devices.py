@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+import userdata
+
+EBS_MODEL = 'Amazon Elastic Block Store'
+
+
+def _disk(root, name, model=None, sectors=2048, partitions=(), discard=True, queue_depth=None):
+    sys_dir = os.path.join(root, 'sys/block', name)
+    os.makedirs(os.path.join(sys_dir, 'device'))
+    os.makedirs(os.path.join(sys_dir, 'queue'))
+    files = {
+        'size': str(sectors),
+        'queue/rotational': '0',
+        'queue/discard_max_bytes': '2199023255040' if discard else '0',
+        'queue/nr_requests': '1023',
+    }
+    if model is not None:
+        files['device/model'] = model + '                    '
+    if queue_depth is not None:
+        files['device/queue_depth'] = str(queue_depth)
+    for x in partitions:
+        files['{}/partition'.format(x)] = '1'
+    for path, value in files.items():
+        os.makedirs(os.path.dirname(os.path.join(sys_dir, path)), exist_ok=True)
+        with open(os.path.join(sys_dir, path), 'w') as f:
+            f.write(value + '\n')
+
+
+def _virtual(root, name):
+    os.makedirs(os.path.join(root, 'sys/block', name, 'queue'))
+
+
+def _mounts(root, *mounts):
+    os.makedirs(os.path.join(root, 'proc/self'), exist_ok=True)
+    with open(os.path.join(root, 'proc/self/mounts'), 'w') as f:
+        for dev, mount in mounts:
+            f.write('{} {} ext4 rw,relatime 0 0\n'.format(dev, mount))
+        f.write('proc /proc proc rw 0 0\n')
+
+
+def test_nvme_instance_store_by_model(tmp_path):
+    root = str(tmp_path)
+    _disk(root, 'nvme0n1', EBS_MODEL, partitions=['nvme0n1p1'], discard=False)
+    _disk(root, 'nvme1n1', userdata.INSTANCE_STORE_MODEL, sectors=4096, partitions=['nvme1n1p1'])
+    _disk(root, 'nvme2n1', userdata.INSTANCE_STORE_MODEL, sectors=4096)
+    _disk(root, 'nvme3n1', EBS_MODEL)
+    _virtual(root, 'loop0')
+    _virtual(root, 'md0')
+    _mounts(root, ('/dev/nvme0n1p1', '/'), ('/dev/nvme1n1p1', '/mnt'))
+
+    state = userdata.BlockDeviceState(root)
+
+    assert [x.name for x in state.devices] == ['nvme0n1', 'nvme1n1', 'nvme2n1', 'nvme3n1']
+    assert state.ephemeral_devs() == ['/dev/nvme1n1', '/dev/nvme2n1']
+    assert state.ephemeral_partitions() == ['/dev/nvme1n1p1']
+    nvme1 = state.ephemeral()[0]
+    assert (nvme1.size, nvme1.discard, nvme1.queue_depth, nvme1.mountpoints) == (4096 * 512, True, 1023, ('/mnt',))
+    root_disk = state.devices[0]
+    assert (root_disk.instance_store, root_disk.discard, root_disk.mountpoints) == (False, False, ('/',))
+
+
+def test_reload_sees_new_partitions(tmp_path):
+    root = str(tmp_path)
+    _disk(root, 'nvme1n1', userdata.INSTANCE_STORE_MODEL)
+    _mounts(root)
+    state = userdata.BlockDeviceState(root)
+    assert state.ephemeral_partitions() == []
+    os.makedirs(os.path.join(root, 'sys/block/nvme1n1/nvme1n1p1'))
+    open(os.path.join(root, 'sys/block/nvme1n1/nvme1n1p1/partition'), 'w').close()
+    state.reload()
+    assert state.ephemeral_partitions() == ['/dev/nvme1n1p1']
+
+
+def test_xen_instance_store_from_the_given_names(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    for name in ('xvda', 'xvdb', 'xvdc', 'xvdf'):
+        _disk(root, name, queue_depth=32)
+    _mounts(root, ('/dev/xvda1', '/'))
+    monkeypatch.setattr(userdata, '_metadata_ephemeral_names', lambda: pytest.fail('metadata queried'))
+
+    state = userdata.BlockDeviceState(root, ephemeral_names=['xvdb', 'xvdc'])
+
+    assert state.ephemeral_devs() == ['/dev/xvdb', '/dev/xvdc']
+    assert state.ephemeral()[0].queue_depth == 32
+
+
+def test_xen_instance_store_from_the_metadata(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    for name in ('xvda', 'xvdb', 'xvdc'):
+        _disk(root, name)
+    _mounts(root)
+    mapping = {
+        'meta-data/block-device-mapping/': 'ami\nephemeral0\nephemeral1\nroot',
+        'meta-data/block-device-mapping/ephemeral0': 'sdb',
+        'meta-data/block-device-mapping/ephemeral1': '/dev/sdc',
+    }
+    monkeypatch.setattr(userdata.instance_metadata, 'get', mapping.__getitem__)
+
+    assert userdata.BlockDeviceState(root).ephemeral_devs() == ['/dev/xvdb', '/dev/xvdc']
+
+
+def test_nitro_instances_dont_query_the_metadata(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    _disk(root, 'nvme0n1', EBS_MODEL)
+    _mounts(root)
+    monkeypatch.setattr(userdata, '_metadata_ephemeral_names', lambda: pytest.fail('metadata queried'))
+    assert userdata.BlockDeviceState(root).ephemeral_devs() == []
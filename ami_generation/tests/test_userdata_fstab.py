@@ -0,0 +1,45 @@
+import os
+import threading
+
+import userdata
+
+
+def _fstab(tmp_path, content):
+    path = str(tmp_path / 'fstab')
+    with open(path, 'w') as f:
+        f.write(content)
+    os.chmod(path, 0o644)
+    return path
+
+
+def test_concurrent_edits_keep_every_entry(tmp_path):
+    fstab = _fstab(tmp_path, 'LABEL=cloudimg-rootfs / ext4 defaults 0 1\n')
+    threads = [threading.Thread(target=userdata.add_to_fstab,
+                                args=('/mnt/ephemeral/dir{}'.format(i), '/dir{}'.format(i), 'none', 'bind,nofail'),
+                                kwargs={'fstab': fstab}) for i in range(20)]
+    for x in threads:
+        x.start()
+    for x in threads:
+        x.join()
+
+    with open(fstab) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'LABEL=cloudimg-rootfs / ext4 defaults 0 1'
+    expected = ['/mnt/ephemeral/dir{0} /dir{0} none bind,nofail 0 0'.format(i) for i in range(20)]
+    assert sorted(lines[1:]) == sorted(expected)
+    assert os.stat(fstab).st_mode & 0o777 == 0o644
+    assert sorted(os.listdir(str(tmp_path))) == ['fstab', 'fstab.bak']
+
+
+def test_entries_of_the_device_or_mount_point_are_replaced(tmp_path):
+    fstab = _fstab(tmp_path, 'LABEL=root / ext4 defaults 0 1\n/dev/md0 /old ext4 defaults 0 0\n'
+                             'tmpfs /tmp tmpfs size=1g 0 0\n/dev/xvdb /mnt auto defaults 0 2')
+    userdata.add_to_fstab('/dev/md0', '/mnt', 'ext4', fstab=fstab)
+    userdata.add_to_fstab('tmpfs', '/var/cache', 'tmpfs', 'size=2g', fstab=fstab)
+
+    with open(fstab) as f:
+        assert f.read() == ('LABEL=root / ext4 defaults 0 1\ntmpfs /tmp tmpfs size=1g 0 0\n'
+                            '/dev/md0 /mnt ext4 {} 0 0\ntmpfs /var/cache tmpfs size=2g 0 0\n'.format(
+                                userdata.MOUNT_OPTIONS['ext4']))
+    with open(fstab + '.bak') as f:
+        assert f.read().endswith('/dev/md0 /mnt ext4 {} 0 0\n'.format(userdata.MOUNT_OPTIONS['ext4']))
@@ -0,0 +1,65 @@
+import os
+import stat
+import subprocess
+import time
+
+import pytest
+
+import userdata
+
+SGDISK_DELAY_S = 0.3
+
+
+@pytest.fixture
+def sgdisk(tmp_path, monkeypatch):
+    """Fake sgdisk on the PATH which logs its arguments, :returns: path of the log"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    log = tmp_path / 'sgdisk.log'
+    script = bin_dir / 'sgdisk'
+    script.write_text('#!/bin/sh\nsleep {}\necho "$@" >> {}\n'.format(SGDISK_DELAY_S, log))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', '{}:{}'.format(bin_dir, os.environ['PATH']))
+    return log
+
+
+@pytest.mark.parametrize('dev, part', [
+    ('/dev/xvdb', '/dev/xvdb1'),
+    ('/dev/nvme1n1', '/dev/nvme1n1p1'),
+    ('/dev/md0', '/dev/md0p1'),
+])
+def test_partition_path(dev, part):
+    assert userdata.partition_path(dev) == part
+
+
+def test_partition_devices_concurrently(sparse_device, sgdisk):
+    devs = [sparse_device('disk{}'.format(i)) for i in range(4)]
+    start = time.time()
+    timings = userdata.partition_devices(devs, timeout=10)
+    elapsed = time.time() - start
+
+    assert elapsed < 2 * SGDISK_DELAY_S
+    assert sorted(timings) == sorted(devs)
+    assert all(set(x) == {'wipe', 'partition', 'settle'} for x in timings.values())
+    assert sorted(sgdisk.read_text().splitlines()) == sorted('-o -n 1 -t 1:fd00 {}'.format(x) for x in devs)
+    gpt_size = userdata.GPT_PRIMARY_SECTORS * userdata.SECTOR_SIZE
+    for dev in devs:
+        with open(dev, 'rb') as f:
+            assert f.read(gpt_size) == bytes(gpt_size)
+
+
+def test_partition_failure_is_raised(sparse_device, tmp_path, monkeypatch):
+    monkeypatch.setenv('PATH', str(tmp_path))
+    (tmp_path / 'sgdisk').write_text('#!/bin/sh\nexit 2\n')
+    (tmp_path / 'sgdisk').chmod(0o755)
+    with pytest.raises(subprocess.CalledProcessError):
+        userdata.partition_devices([sparse_device('disk0')], timeout=1)
+
+
+def test_wait_partition_times_out(monkeypatch):
+    monkeypatch.setattr(userdata, '_is_block_device', lambda path: False if path.endswith('p1') else True)
+    monkeypatch.setattr(userdata, '_reread_partitions', lambda dev: None)
+    start = time.time()
+    with pytest.raises(TimeoutError, match='nvme9n1p1'):
+        userdata._wait_partition('/dev/nvme9n1', '/dev/nvme9n1p1', time.time() + 0.3)
+    assert time.time() - start < 1
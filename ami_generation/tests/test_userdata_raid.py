@@ -0,0 +1,90 @@
+import pytest
+
+import userdata
+
+GiB = 2**30
+
+
+def test_raid0_geometry():
+    geometry = userdata.raid_geometry('0', [900 * GiB] * 4)
+    assert geometry == userdata.RaidGeometry('0', 4, 4, 512, 128, 512)
+
+
+def test_small_members_get_smaller_chunks():
+    assert userdata.raid_geometry('0', [32 * GiB, 32 * GiB]).chunk_kb == 256
+    assert userdata.raid_geometry('0', [32 * GiB, 32 * GiB], chunk_kb=64).stride == 16
+
+
+@pytest.mark.parametrize('level, devices, data_disks', [('1', 2, 1), ('10', 4, 2), ('10', 5, 2)])
+def test_redundant_geometry(level, devices, data_disks):
+    assert userdata.raid_geometry(level, [100 * GiB] * devices).data_disks == data_disks
+
+
+@pytest.mark.parametrize('level, devices', [('1', 1), ('10', 1), ('5', 3)])
+def test_unsupported_geometry(level, devices):
+    with pytest.raises(ValueError):
+        userdata.raid_geometry(level, [100 * GiB] * devices)
+
+
+def test_mdadm_create_cmd():
+    parts = ['/dev/nvme1n1p1', '/dev/nvme2n1p1']
+    raid0 = userdata.mdadm_create_cmd('/dev/md0', userdata.raid_geometry('0', [100 * GiB] * 2), parts)
+    assert raid0[-3:] == ['--chunk=512K'] + parts
+    assert '--assume-clean' not in raid0
+    raid1 = userdata.mdadm_create_cmd('/dev/md0', userdata.raid_geometry('1', [100 * GiB] * 2), parts)
+    assert '--assume-clean' in raid1 and '--bitmap=internal' in raid1
+    assert not any(x.startswith('--chunk') for x in raid1)
+
+
+def test_ext4_aligned_to_the_stripes():
+    cmd = userdata.mkfs_cmd('/dev/md0', 'ext4', userdata.raid_geometry('0', [900 * GiB] * 4), label='ephemeral')
+    assert cmd[0] == 'mkfs.ext4'
+    assert 'stride=128,stripe_width=512,lazy_itable_init=1,lazy_journal_init=1,nodiscard' in cmd
+    assert cmd[-3:] == ['-L', 'ephemeral', '/dev/md0']
+
+
+def test_xfs_aligned_to_the_stripes():
+    cmd = userdata.mkfs_cmd('/dev/md0', 'xfs', userdata.raid_geometry('10', [900 * GiB] * 4))
+    assert cmd == ['mkfs.xfs', '-q', '-f', '-K', '-d', 'su=512k,sw=2', '/dev/md0']
+
+
+def test_mirror_is_not_striped():
+    geometry = userdata.raid_geometry('1', [900 * GiB] * 2)
+    assert not any('stride' in x for x in userdata.mkfs_cmd('/dev/md0', 'ext4', geometry))
+    assert '-d' not in userdata.mkfs_cmd('/dev/md0', 'xfs', geometry)
+
+
+
+def test_raid_capacity():
+    sizes = [100 * GiB, 120 * GiB]
+    raid0 = userdata.raid_capacity(userdata.raid_geometry('0', sizes), sizes)
+    assert 190 * GiB < raid0 < 200 * GiB
+    raid1 = userdata.raid_capacity(userdata.raid_geometry('1', sizes), sizes)
+    assert 95 * GiB < raid1 < 100 * GiB
+
+
+def _ephemeral_disks(monkeypatch, sizes):
+    class State:
+        def ephemeral(self):
+            return [userdata.BlockDevice('nvme{}n1'.format(i + 1), userdata.INSTANCE_STORE_MODEL, size, False, 1023,
+                                         True, (), ()) for i, size in enumerate(sizes)]
+    monkeypatch.setattr(userdata, 'BlockDeviceState', State)
+
+
+def test_files_not_fitting_abort_before_creating_the_raid(tmp_path, monkeypatch):
+    _ephemeral_disks(monkeypatch, [4 * 2**20, 4 * 2**20])
+    monkeypatch.setattr(userdata, 'create_raid', lambda *args, **kwargs: pytest.fail('create_raid called'))
+    (tmp_path / 'big').write_bytes(b'x' * 5 * 2**20)
+
+    with pytest.raises(RuntimeError, match='the disks were not touched'):
+        userdata.raid_setup_file_preserving('/dev/md0', str(tmp_path), '1')
+
+
+def test_files_fitting_go_on_to_create_the_raid(tmp_path, monkeypatch):
+    _ephemeral_disks(monkeypatch, [8 * 2**20, 8 * 2**20])
+    created = []
+    monkeypatch.setattr(userdata, 'create_raid', lambda *args, **kwargs: created.append(args) or False)
+    (tmp_path / 'big').write_bytes(b'x' * 5 * 2**20)
+
+    assert userdata.raid_setup_file_preserving('/dev/md0', str(tmp_path), '0') is False
+    assert created == [('/dev/md0', '0')]
@@ -0,0 +1,154 @@
+import os
+import subprocess
+
+import pytest
+
+import userdata
+from userdata import MountInfo, Relocation
+
+ROOT_FS = MountInfo('259:1', '/', '/', 'ext4', '/dev/nvme0n1p1')
+ARRAY = MountInfo('9:0', '/', '/mnt/ephemeral', 'ext4', '/dev/md0')
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    """Records the commands and fstab entries instead of running them"""
+    calls = []
+
+    def check_call(cmd, **kwargs):
+        # the copies are real
+        if cmd[0] == 'cp':
+            return subprocess.check_call(cmd, **kwargs)
+        calls.append(cmd)
+    monkeypatch.setattr(userdata, 'check_call', check_call)
+    monkeypatch.setattr(userdata, 'add_to_fstab', lambda *args: calls.append(('fstab',) + args))
+    monkeypatch.setattr(userdata, '_service_active', lambda unit: unit == 'docker')
+    monkeypatch.setattr(userdata, '_mem_total', lambda: 4 * 2**30)
+    return calls
+
+
+def _mounts(monkeypatch, mounts):
+    monkeypatch.setattr(userdata, 'mount_info', lambda path: mounts.get(path))
+
+
+def test_mount_info(tmp_path):
+    mountinfo = tmp_path / 'mountinfo'
+    mountinfo.write_text(
+        '22 1 259:1 / / rw,relatime shared:1 - ext4 /dev/nvme0n1p1 rw\n'
+        '40 22 9:0 / /mnt/ephemeral rw,noatime shared:20 - ext4 /dev/md0 rw,stripe=512\n'
+        '41 22 259:1 /home/docker /var/lib/docker rw,relatime shared:1 - ext4 /dev/nvme0n1p1 rw\n'
+        '42 41 9:0 /var/lib/docker /var/lib/docker rw,noatime shared:20 - ext4 /dev/md0 rw\n')
+    assert userdata.mount_info('/mnt/ephemeral', str(mountinfo)) == ARRAY
+    # the top one of stacked mounts
+    assert userdata.mount_info('/var/lib/docker', str(mountinfo)) == \
+        MountInfo('9:0', '/var/lib/docker', '/var/lib/docker', 'ext4', '/dev/md0')
+    assert userdata.mount_info('/home', str(mountinfo)) is None
+
+
+def test_bind_relocation(tmp_path, commands, monkeypatch):
+    path = tmp_path / 'docker'
+    (path / 'image').mkdir(parents=True)
+    (path / 'image' / 'layer').write_text('data')
+    array = tmp_path / 'array'
+    array.mkdir()
+    _mounts(monkeypatch, {str(array): ARRAY})
+
+    userdata.relocate(Relocation(str(path), ('docker.socket', 'docker')), str(array))
+
+    src = str(array) + str(path)
+    with open(os.path.join(src, 'image', 'layer')) as f:
+        assert f.read() == 'data'
+    assert commands == [
+        ['systemctl', 'stop', 'docker'],
+        ['mount', '--bind', src, str(path)],
+        ('fstab', src, str(path), 'none', 'bind,nofail,x-systemd.requires-mounts-for={}'.format(array)),
+        ['systemctl', 'start', 'docker'],
+    ]
+
+
+def test_bind_from_the_root_volume_is_replaced(tmp_path, commands, monkeypatch):
+    # docker.yml bind mounts /var/lib/docker from /home/docker
+    path = tmp_path / 'docker'
+    path.mkdir()
+    array = tmp_path / 'array'
+    array.mkdir()
+    _mounts(monkeypatch, {str(array): ARRAY, str(path): MountInfo('259:1', '/home/docker', str(path), 'ext4',
+                                                                  '/dev/nvme0n1p1')})
+
+    userdata.relocate(Relocation(str(path)), str(array))
+
+    src = str(array) + str(path)
+    assert commands[:2] == [['umount', str(path)], ['mount', '--bind', src, str(path)]]
+
+
+def test_relocated_targets_are_left_alone(tmp_path, commands, monkeypatch):
+    path = tmp_path / 'docker'
+    path.mkdir()
+    cache = tmp_path / 'cache'
+    cache.mkdir()
+    _mounts(monkeypatch, {
+        '/mnt/ephemeral': ARRAY,
+        str(path): MountInfo('9:0', str(path), str(path), 'ext4', '/dev/md0'),
+        str(cache): MountInfo('0:45', '/', str(cache), 'tmpfs', 'tmpfs'),
+    })
+
+    userdata.relocate(Relocation(str(path), ('docker',)), '/mnt/ephemeral')
+    userdata.relocate(Relocation(str(cache), mode='tmpfs'))
+
+    assert commands == []
+
+
+def test_tmpfs_is_mounted_on_the_target(tmp_path, commands, monkeypatch):
+    path = tmp_path / 'pip'
+    path.mkdir(mode=0o750)
+    (path / 'wheel').write_text('data')
+    _mounts(monkeypatch, {})
+
+    userdata.relocate(Relocation(str(path), mode='tmpfs', tmpfs_fraction=0.25))
+
+    options = 'size=1024m,mode=750,nofail'
+    assert commands == [
+        ['mount', '-t', 'tmpfs', '-o', options, 'tmpfs', str(path)],
+        ('fstab', 'tmpfs', str(path), 'tmpfs', options),
+    ]
+    assert (path / 'wheel').read_text() == 'data'
+    # nothing left aside
+    assert sorted(os.listdir(str(tmp_path))) == ['pip']
+
+
+def _can_mount(tmp_path) -> bool:
+    if os.geteuid() != 0:
+        return False
+    probe = tmp_path / 'probe'
+    probe.mkdir()
+    if subprocess.call(['mount', '-t', 'tmpfs', 'tmpfs', str(probe)], stderr=subprocess.DEVNULL) != 0:
+        return False
+    subprocess.check_call(['umount', str(probe)])
+    probe.rmdir()
+    return True
+
+
+def test_tmpfs_under_a_shared_mount(tmp_path, monkeypatch):
+    if not _can_mount(tmp_path):
+        pytest.skip('needs to mount filesystems')
+    monkeypatch.setattr(userdata, 'add_to_fstab', lambda *args: None)
+    monkeypatch.setattr(userdata, '_service_active', lambda unit: False)
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    subprocess.check_call(['mount', '-t', 'tmpfs', 'tmpfs', str(shared)])
+    try:
+        # like / on systemd hosts, a mount can't be moved out of it
+        subprocess.check_call(['mount', '--make-shared', str(shared)])
+        path = shared / 'cache'
+        (path / 'sub').mkdir(parents=True)
+        (path / 'sub' / 'file').write_text('data')
+
+        userdata.relocate(Relocation(str(path), mode='tmpfs', tmpfs_fraction=0.01))
+        try:
+            assert userdata.mount_info(str(path)).fs_type == 'tmpfs'
+            assert userdata.mount_info(str(path)).device != userdata.mount_info(str(shared)).device
+            assert (path / 'sub' / 'file').read_text() == 'data'
+        finally:
+            subprocess.check_call(['umount', str(path)])
+    finally:
+        subprocess.check_call(['umount', '-l', str(shared)])
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+import userdata
+from userdata import Step
+
+
+def _fail():
+    raise RuntimeError('boom')
+
+
+def test_independent_steps_run_concurrently():
+    barrier = threading.Barrier(3, timeout=2)
+    results = userdata.run_steps([Step(name, barrier.wait) for name in ('a', 'b', 'c')])
+    assert {name: x['status'] for name, x in results.items()} == {'a': 'ok', 'b': 'ok', 'c': 'ok'}
+
+
+def test_dependencies_run_first():
+    order = []
+    steps = [
+        Step('hostname', lambda: order.append('hostname'), ('metadata',)),
+        Step('metadata', lambda: time.sleep(0.1) or order.append('metadata')),
+        Step('tuning', lambda: order.append('tuning'), ('metadata', 'hostname')),
+    ]
+    results = userdata.run_steps(steps)
+    assert order == ['metadata', 'hostname', 'tuning']
+    assert results['hostname']['start_s'] >= results['metadata']['duration_s']
+
+
+def test_dependents_of_failed_steps_are_skipped():
+    ran = []
+    steps = [
+        Step('raid', _fail),
+        Step('relocate docker', lambda: ran.append('docker'), ('raid',)),
+        Step('tuning', lambda: ran.append('tuning'), ('relocate docker',)),
+        Step('hostname', lambda: ran.append('hostname')),
+    ]
+    results = userdata.run_steps(steps)
+    assert ran == ['hostname']
+    assert results['raid']['status'] == 'failed' and results['raid']['error'] == 'boom'
+    assert results['relocate docker']['status'] == 'skipped'
+    assert results['tuning']['status'] == 'skipped'
+    assert results['hostname']['status'] == 'ok'
+
+
+def test_required_done_before_optional_steps_finish():
+    finished = threading.Event()
+    seen = []
+
+    def required_done(results):
+        seen.append(dict(results))
+        assert not finished.is_set()
+
+    steps = [
+        Step('metadata', lambda: None),
+        Step('warm cache', lambda: time.sleep(0.3) or finished.set(), required=False),
+    ]
+    results = userdata.run_steps(steps, required_done)
+    assert list(seen[0]) == ['metadata']
+    assert results['warm cache']['status'] == 'ok'
+
+
+def test_required_done_called_once_without_required_steps():
+    calls = []
+    userdata.run_steps([Step('optional', lambda: None, required=False)], calls.append)
+    assert len(calls) == 1
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError, match='unknown'):
+        userdata.run_steps([Step('a', lambda: None, ('missing',))])
+
+
+def test_circular_dependencies():
+    with pytest.raises(ValueError, match='circular'):
+        userdata.run_steps([Step('a', lambda: None, ('b',)), Step('b', lambda: None, ('a',))])
+
+
+def test_userdata_steps_by_configuration(monkeypatch):
+    monkeypatch.setattr(userdata, 'EPHEMERAL_RAID', None)
+    monkeypatch.setattr(userdata, 'TUNING_PROFILE', None)
+    assert [x.name for x in userdata.userdata_steps()] == ['hostname']
+
+    monkeypatch.setattr(userdata, 'EPHEMERAL_RAID', ('/dev/md0', '/mnt/ephemeral', '0'))
+    monkeypatch.setattr(userdata, 'TUNING_PROFILE', 'auto')
+    steps = {x.name: x for x in userdata.userdata_steps()}
+    assert steps['tuning'].deps == ('raid',)
+    assert steps['relocate /var/lib/docker'].deps == ('raid',)
+
+
+def test_skips_spread_regardless_of_the_step_order():
+    calls = []
+    steps = [
+        Step('c', lambda: None, ('b',)),
+        Step('b', lambda: None, ('a',)),
+        Step('a', _fail),
+    ]
+    results = userdata.run_steps(steps, calls.append)
+    assert {name: x['status'] for name, x in results.items()} == {'a': 'failed', 'b': 'skipped', 'c': 'skipped'}
+    assert len(calls) == 1
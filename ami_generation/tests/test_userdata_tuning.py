@@ -0,0 +1,104 @@
+import json
+import os
+
+import pytest
+
+import userdata
+
+
+def _write(root, path, value):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(value + '\n')
+
+
+@pytest.fixture
+def fake_root(tmp_path):
+    root = str(tmp_path / 'root')
+    for cpu in ('cpu0', 'cpu1'):
+        _write(root, 'sys/devices/system/cpu/{}/cpufreq/scaling_governor'.format(cpu), 'powersave')
+    for dev in ('nvme0n1', 'nvme1n1'):
+        _write(root, 'sys/block/{}/queue/scheduler'.format(dev), '[mq-deadline] none')
+    _write(root, 'sys/block/md0/queue/read_ahead_kb', '128')
+    _write(root, 'sys/kernel/mm/transparent_hugepage/enabled', 'always [madvise] never')
+    _write(root, 'proc/sys/vm/dirty_ratio', '20')
+    _write(root, 'proc/sys/vm/dirty_background_ratio', '10')
+    _write(root, 'proc/sys/vm/swappiness', '60')
+    return root
+
+
+def test_build_profile(fake_root):
+    changes = userdata.apply_tuning('build', fake_root, record_file=None)
+    assert [(x['path'], x['old'], x['new']) for x in changes] == [
+        ('/sys/devices/system/cpu/cpu0/cpufreq/scaling_governor', 'powersave', 'performance'),
+        ('/sys/devices/system/cpu/cpu1/cpufreq/scaling_governor', 'powersave', 'performance'),
+        ('/sys/block/nvme0n1/queue/scheduler', 'mq-deadline', 'none'),
+        ('/sys/block/nvme1n1/queue/scheduler', 'mq-deadline', 'none'),
+        ('/sys/block/md0/queue/read_ahead_kb', '128', '4096'),
+        ('/proc/sys/vm/dirty_ratio', '20', '40'),
+        ('/proc/sys/vm/swappiness', '60', '10'),
+    ]
+    assert all(x['ok'] for x in changes)
+    # already set, nothing to do
+    assert userdata.apply_tuning('build', fake_root, record_file=None) == []
+
+
+def test_settings_applied_in_profile_order(fake_root, monkeypatch):
+    profile = {
+        'sys/block/nvme*/queue/scheduler': 'none',
+        'sys/block/md*/queue/read_ahead_kb': '8192',
+        'proc/sys/vm/dirty_ratio': '30',
+    }
+    monkeypatch.setitem(userdata.TUNING_PROFILES, 'test', profile)
+    changes = userdata.apply_tuning('test', fake_root, record_file=None)
+    assert [x['path'].split('/')[-1] for x in changes] == ['scheduler', 'scheduler', 'read_ahead_kb', 'dirty_ratio']
+
+
+@pytest.mark.parametrize('profile', sorted(userdata.TUNING_PROFILES))
+def test_queue_settings_come_after_the_scheduler(profile):
+    paths = list(userdata.TUNING_PROFILES[profile])
+    # a scheduler switch resets nr_requests, with none it can't go above the hardware queue depth
+    assert not any(x.endswith('/queue/nr_requests') for x in paths)
+    for i, scheduler in enumerate(paths):
+        if scheduler.endswith('/queue/scheduler'):
+            queue = scheduler[:-len('scheduler')]
+            assert all(j > i for j, x in enumerate(paths) if x.startswith(queue) and x != scheduler)
+
+
+def test_unsupported_settings_are_reported(fake_root):
+    os.makedirs(os.path.join(fake_root, 'proc/sys/net/core/rmem_max'))
+    changes = userdata.apply_tuning('network-bench', fake_root, record_file=None)
+    failed = [x for x in changes if not x['ok']]
+    assert [x['path'] for x in failed] == ['/proc/sys/net/core/rmem_max']
+    assert failed[0]['new'] is None and failed[0]['error']
+
+
+def test_record_keeps_the_original_values(fake_root, tmp_path):
+    record = str(tmp_path / 'tuning_changes.json')
+    userdata.apply_tuning('build', fake_root, record)
+    userdata.apply_tuning('gpu-train', fake_root, record)
+    with open(record) as f:
+        recorded = {x['path']: x for x in json.load(f)}
+    read_ahead = recorded['/sys/block/md0/queue/read_ahead_kb']
+    assert (read_ahead['old'], read_ahead['new'], read_ahead['profile']) == ('128', '8192', 'gpu-train')
+    assert recorded['/sys/kernel/mm/transparent_hugepage/enabled']['old'] == 'madvise'
+
+
+def test_tuning_is_opt_in(monkeypatch):
+    assert userdata.TUNING_PROFILE is None
+    monkeypatch.setattr(userdata.instance_metadata, 'instance_type', lambda: 'p3.16xlarge')
+    applied = []
+    monkeypatch.setattr(userdata, 'apply_tuning', applied.append)
+    monkeypatch.setattr(userdata, 'TUNING_PROFILE', 'auto')
+    userdata._tuning_step()
+    monkeypatch.setattr(userdata, 'TUNING_PROFILE', 'build')
+    userdata._tuning_step()
+    assert applied == ['gpu-train', 'build']
+
+
+@pytest.mark.parametrize('instance_type, profile', [
+    ('p3.16xlarge', 'gpu-train'), ('p3dn.24xlarge', 'network-bench'), ('c5.18xlarge', 'build'),
+])
+def test_profile_by_family(instance_type, profile):
+    assert userdata.tuning_profile(instance_type) == profile
@@ -0,0 +1,60 @@
+import os
+
+import userdata
+
+PRIMARY = userdata.GPT_PRIMARY_SECTORS * userdata.SECTOR_SIZE
+BACKUP = userdata.GPT_BACKUP_SECTORS * userdata.SECTOR_SIZE
+
+
+def _read(path: str, offset: int, size: int) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def test_wipe_devices_zeroes_only_the_gpt(sparse_device):
+    devs = [sparse_device('nvme{}n1'.format(i)) for i in range(1, 4)]
+    size = os.path.getsize(devs[0])
+
+    res = userdata.wipe_devices(devs)
+
+    assert sorted(res) == sorted(devs)
+    # files can't be discarded
+    assert {method for method, _ in res.values()} == {'zero'}
+    for dev in devs:
+        assert os.path.getsize(dev) == size
+        assert _read(dev, 0, PRIMARY) == bytes(PRIMARY)
+        assert _read(dev, size - BACKUP, BACKUP) == bytes(BACKUP)
+        # the rest is left alone
+        assert _read(dev, PRIMARY, 512) == b'\xaa' * 512
+        assert _read(dev, size - BACKUP - 512, 512) == b'\xaa' * 512
+
+
+def test_wipe_device_prefers_discard_on_nvme(sparse_device, monkeypatch):
+    discarded = []
+    monkeypatch.setattr(userdata, 'discard_device', lambda dev, secure=False: discarded.append(dev) or True)
+    nvme = sparse_device('nvme1n1')
+    xvd = sparse_device('xvdb')
+
+    assert userdata.wipe_device(nvme) == 'discard'
+    # the GPT isn't zeroed after a discard
+    assert _read(nvme, 0, 512) == b'\xaa' * 512
+    assert userdata.wipe_device(xvd) == 'zero'
+    assert userdata.wipe_device(nvme, discard=False) == 'zero'
+    assert discarded == [nvme]
+    assert _read(nvme, 0, PRIMARY) == bytes(PRIMARY)
+
+
+def test_discard_skips_files(sparse_device):
+    assert userdata.discard_device(sparse_device('nvme1n1')) is False
+
+
+def test_zero_gpt_of_a_small_device(tmp_path):
+    path = str(tmp_path / 'tiny')
+    with open(path, 'wb') as f:
+        f.write(b'\xaa' * 4096)
+
+    userdata.zero_gpt(path)
+
+    assert os.path.getsize(path) == 4096
+    assert _read(path, 0, 4096) == bytes(4096)
@@ -38,8 +38,11 @@ import logging
 from subprocess import check_output, check_call, call
 import re
 import sys
+import json
 import urllib.request
+import urllib.error
 import contextlib
+from typing import Dict
 
 import ssl
 
@@ -381,11 +384,99 @@ def add_paths():
     run_command("PowerShell Set-ItemProperty -path 'hklm:\\system\\currentcontrolset\\control\\session manager\\environment' -Name Path -Value '" + new_path + "'")
 
 
+class InstanceMetadata:
+    """
+    EC2 instance metadata service client. Uses IMDSv2 session tokens, cached until they are about to
+    expire, and falls back to IMDSv1 if tokens are not available. Documents that can't change during
+    the life of the instance are memoized.
+    """
+    IMMUTABLE = {
+        'dynamic/instance-identity/document',
+        'meta-data/ami-id',
+        'meta-data/instance-id',
+        'meta-data/instance-type',
+        'meta-data/placement/availability-zone',
+        'meta-data/placement/region',
+    }
+
+    def __init__(self, endpoint: str = None, token_ttl_s: int = 21600, timeout_s: float = 1.0, tries: int = 3):
+        import threading
+        self.endpoint = (endpoint or os.getenv('AWS_EC2_METADATA_SERVICE_ENDPOINT', 'http://169.254.169.254'))
+        self.token_ttl_s = token_ttl_s
+        self.timeout_s = timeout_s
+        self.tries = tries
+        self._lock = threading.Lock()
+        self._token = None
+        self._token_expires = 0
+        self._cache = {}
+
+    def token(self, refresh: bool = False) -> str:
+        """:returns: IMDSv2 session token or None if the service only supports IMDSv1"""
+        import time
+        with self._lock:
+            if refresh or time.time() > self._token_expires - 60:
+                request = urllib.request.Request(
+                    self.endpoint.rstrip('/') + '/latest/api/token', method='PUT',
+                    headers={'X-aws-ec2-metadata-token-ttl-seconds': str(self.token_ttl_s)})
+                try:
+                    with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+                        self._token = response.read().decode('utf-8')
+                except OSError as e:
+                    # HTTPError, or URLError and socket.timeout from services which don't answer the PUT
+                    logging.debug("IMDSv2 token not available (%s), using IMDSv1", e)
+                    self._token = None
+                self._token_expires = time.time() + self.token_ttl_s
+            return self._token
+
+    def _get(self, path: str, token: str) -> str:
+        headers = {'X-aws-ec2-metadata-token': token} if token else {}
+        request = urllib.request.Request('{}/latest/{}'.format(self.endpoint.rstrip('/'), path), headers=headers)
+        with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+            return response.read().decode('utf-8')
+
+    def get(self, path: str) -> str:
+        """:param path: path under /latest, ex. 'meta-data/instance-type'"""
+        import time
+        path = path.strip('/')
+        if path in self._cache:
+            return self._cache[path]
+        for attempt in range(1, self.tries + 1):
+            try:
+                res = self._get(path, self.token(refresh=attempt > 1))
+                break
+            except urllib.error.HTTPError as e:
+                # 401 is an expired token, retried with a new one
+                if e.code != 401 or attempt == self.tries:
+                    raise
+            except OSError as e:
+                if attempt == self.tries:
+                    raise
+                logging.debug("Instance metadata %s: %s, retrying", path, e)
+                time.sleep(0.1 * attempt)
+        if path in self.IMMUTABLE:
+            self._cache[path] = res
+        return res
+
+    def get_many(self, paths) -> Dict[str, str]:
+        """Fetch several paths concurrently, :returns: dict of path -> value"""
+        from concurrent.futures import ThreadPoolExecutor
+        paths = list(paths)
+        self.token()
+        with ThreadPoolExecutor(max(len(paths), 1)) as executor:
+            return dict(zip(paths, executor.map(self.get, paths)))
+
+    def identity(self) -> Dict:
+        return json.loads(self.get('dynamic/instance-identity/document'))
+
+    def instance_type(self) -> str:
+        return self.get('meta-data/instance-type')
+
+
 def has_gpu():
     gpu_family = {'p2', 'p3', 'g4dn', 'p3dn', 'g3', 'g2', 'g3s'}
 
     def instance_family():
-        return urllib.request.urlopen('http://instance-data/latest/meta-data/instance-type').read().decode().split('.')[0]
+        return InstanceMetadata().instance_type().split('.')[0]
     try:
         return instance_family() in gpu_family
     except:
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 """A collection of python utilties useful for coding infra in AWS"""
 
+import asyncio
 import contextlib
 import logging
 import logging.config
@@ -9,16 +10,19 @@ import os
 from troposphere import Template
 import boto3
 import botocore
+import botocore.config
 import yaml
-import urllib.request
 import re
 import ssl
 import sys
+import itertools
 import json
+import socket
+import threading
+import time
 import urllib.request
 import urllib.error
-from subprocess import check_call
-from typing import List, Dict, Sequence
+from typing import List, Dict, Sequence, Tuple, Iterator, Optional, NamedTuple
 
 
 def get_root() -> str:
@@ -35,10 +39,206 @@ def get_root() -> str:
     return curpath
 
 
+class ClientRegistry:
+    """
+    Cache of boto3 clients keyed by (service, region, profile, config), so credential resolution,
+    endpoint loading and connection pools are shared by everything in the process. Clients are
+    thread safe and shared by all threads, resources are not, so they are cached per thread.
+    """
+    def __init__(self, max_pool_connections: int = 32, retry_mode: str = 'adaptive', max_attempts: int = 10):
+        import collections
+        import threading
+        self.max_pool_connections = max_pool_connections
+        self.retry_mode = retry_mode
+        self.max_attempts = max_attempts
+        self.counters = collections.Counter()
+        self._lock = threading.RLock()
+        self._sessions = {}
+        self._clients = {}
+        self._local = threading.local()
+
+    def session(self, profile_name: Optional[str] = None) -> boto3.session.Session:
+        with self._lock:
+            if profile_name is None:
+                # Honors boto3.setup_default_session
+                return boto3._get_default_session()
+            if profile_name not in self._sessions:
+                self._sessions[profile_name] = boto3.session.Session(profile_name=profile_name)
+                self.counters['sessions'] += 1
+            return self._sessions[profile_name]
+
+    def _config(self, **config) -> botocore.config.Config:
+        config.setdefault('max_pool_connections', self.max_pool_connections)
+        config.setdefault('retries', {'mode': self.retry_mode, 'max_attempts': self.max_attempts})
+        return botocore.config.Config(**config)
+
+    def _key(self, service: str, region_name: Optional[str], profile_name: Optional[str], config: Dict) -> Tuple:
+        session = self.session(profile_name)
+        return (service, region_name or session.region_name, session.profile_name,
+                tuple(sorted((k, repr(v)) for k, v in config.items())))
+
+    def client(self, service: str, region_name: Optional[str] = None, profile_name: Optional[str] = None,
+               **config):
+        """
+        :param config: botocore.config.Config arguments, ex. max_pool_connections
+        :returns: cached boto3 client
+        """
+        key = self._key(service, region_name, profile_name, config)
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = self.session(profile_name).client(
+                    service, region_name=key[1], config=self._config(**config))
+                self.counters['clients'] += 1
+            else:
+                self.counters['client_hits'] += 1
+            return self._clients[key]
+
+    def resource(self, service: str, region_name: Optional[str] = None, profile_name: Optional[str] = None,
+                 **config):
+        """:returns: boto3 resource cached for the calling thread"""
+        key = self._key(service, region_name, profile_name, config)
+        if not hasattr(self._local, 'resources'):
+            self._local.resources = {}
+        resources = self._local.resources
+        if key not in resources:
+            with self._lock:
+                resources[key] = self.session(profile_name).resource(
+                    service, region_name=key[1], config=self._config(**config))
+                self.counters['resources'] += 1
+        return resources[key]
+
+    def connections(self) -> int:
+        """:returns: number of HTTP connections opened by the cached clients"""
+        total = 0
+        with self._lock:
+            clients = list(self._clients.values())
+        for client in clients:
+            try:
+                manager = client._endpoint.http_session._manager
+                total += sum(pool.num_connections for pool in manager.pools._container.values())
+            except AttributeError:
+                pass
+        return total
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            res = dict(self.counters)
+        res['connections'] = self.connections()
+        return res
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+            self._clients.clear()
+            self._local = type(self._local)()
+
+
+# Registry shared by awsutils functions when no client is given
+client_registry = ClientRegistry()
+
+
+def aws_client(service: str, region_name: Optional[str] = None, **config):
+    return client_registry.client(service, region_name, **config)
+
+
+def aws_resource(service: str, region_name: Optional[str] = None, **config):
+    return client_registry.resource(service, region_name, **config)
+
+
+class InstanceMetadata:
+    """
+    EC2 instance metadata service client. Uses IMDSv2 session tokens, cached until they are about to
+    expire, and falls back to IMDSv1 if tokens are not available. Documents that can't change during
+    the life of the instance are memoized.
+    """
+    IMMUTABLE = {
+        'dynamic/instance-identity/document',
+        'meta-data/ami-id',
+        'meta-data/instance-id',
+        'meta-data/instance-type',
+        'meta-data/placement/availability-zone',
+        'meta-data/placement/region',
+    }
+
+    def __init__(self, endpoint: str = None, token_ttl_s: int = 21600, timeout_s: float = 1.0, tries: int = 3):
+        import threading
+        self.endpoint = (endpoint or os.getenv('AWS_EC2_METADATA_SERVICE_ENDPOINT', 'http://169.254.169.254'))
+        self.token_ttl_s = token_ttl_s
+        self.timeout_s = timeout_s
+        self.tries = tries
+        self._lock = threading.Lock()
+        self._token = None
+        self._token_expires = 0
+        self._cache = {}
+
+    def token(self, refresh: bool = False) -> str:
+        """:returns: IMDSv2 session token or None if the service only supports IMDSv1"""
+        import time
+        with self._lock:
+            if refresh or time.time() > self._token_expires - 60:
+                request = urllib.request.Request(
+                    self.endpoint.rstrip('/') + '/latest/api/token', method='PUT',
+                    headers={'X-aws-ec2-metadata-token-ttl-seconds': str(self.token_ttl_s)})
+                try:
+                    with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+                        self._token = response.read().decode('utf-8')
+                except OSError as e:
+                    # HTTPError, or URLError and socket.timeout from services which don't answer the PUT
+                    logging.debug("IMDSv2 token not available (%s), using IMDSv1", e)
+                    self._token = None
+                self._token_expires = time.time() + self.token_ttl_s
+            return self._token
+
+    def _get(self, path: str, token: str) -> str:
+        headers = {'X-aws-ec2-metadata-token': token} if token else {}
+        request = urllib.request.Request('{}/latest/{}'.format(self.endpoint.rstrip('/'), path), headers=headers)
+        with urllib.request.urlopen(request, timeout=self.timeout_s) as response:
+            return response.read().decode('utf-8')
+
+    def get(self, path: str) -> str:
+        """:param path: path under /latest, ex. 'meta-data/instance-type'"""
+        import time
+        path = path.strip('/')
+        if path in self._cache:
+            return self._cache[path]
+        for attempt in range(1, self.tries + 1):
+            try:
+                res = self._get(path, self.token(refresh=attempt > 1))
+                break
+            except urllib.error.HTTPError as e:
+                # 401 is an expired token, retried with a new one
+                if e.code != 401 or attempt == self.tries:
+                    raise
+            except OSError as e:
+                if attempt == self.tries:
+                    raise
+                logging.debug("Instance metadata %s: %s, retrying", path, e)
+                time.sleep(0.1 * attempt)
+        if path in self.IMMUTABLE:
+            self._cache[path] = res
+        return res
+
+    def get_many(self, paths) -> Dict[str, str]:
+        """Fetch several paths concurrently, :returns: dict of path -> value"""
+        from concurrent.futures import ThreadPoolExecutor
+        paths = list(paths)
+        self.token()
+        with ThreadPoolExecutor(max(len(paths), 1)) as executor:
+            return dict(zip(paths, executor.map(self.get, paths)))
+
+    def identity(self) -> Dict:
+        return json.loads(self.get('dynamic/instance-identity/document'))
+
+    def instance_type(self) -> str:
+        return self.get('meta-data/instance-type')
+
+
+# Shared by everything in the process so the token and immutable documents are fetched once
+instance_metadata = InstanceMetadata()
+
+
 def instance_identity() -> Dict:
-    response = urllib.request.urlopen("http://169.254.169.254/latest/dynamic/instance-identity/document")
-    instance_info = json.loads(response.read().decode('utf-8'))
-    return instance_info
+    return instance_metadata.identity()
 
 
 def own_instance_id() -> str:
@@ -50,7 +250,7 @@ def rename_instance(name: str):
         logging.info('Renaming instance to {}'.format(name))
         nfo = instance_identity()
         instance_id_ = nfo['instanceId']
-        ec2 = boto3.resource('ec2', region_name=nfo['region'])
+        ec2 = aws_client('ec2', region_name=nfo['region'])
         ec2.create_tags(
             DryRun=False,
             Resources=[
@@ -71,7 +271,7 @@ def ec2_tag_own(key, value):
     try:
         nfo = instance_identity()
         instance_id_ = nfo['instanceId']
-        ec2 = boto3.resource('ec2', region_name=nfo['region'])
+        ec2 = aws_client('ec2', region_name=nfo['region'])
         ec2.create_tags(
             DryRun=False,
             Resources=[
@@ -88,64 +288,6 @@ def ec2_tag_own(key, value):
         logging.exception('ec2_tag')
 
 
-
-def wait_port_open(server, port, timeout=None):
-    """ Wait for network service to appear
-        @param server: host to connect to (str)
-        @param port: port (int)
-        @param timeout: in seconds, if None or 0 wait forever
-        @return: True of False, if timeout is None may return only True or
-                 throw unhandled network exception
-    """
-    import socket
-    import errno
-    import time
-    sleep_s = 0
-    if timeout:
-        from time import time as now
-        # time module is needed to calc timeout shared between two exceptions
-        end = now() + timeout
-
-    while True:
-        logging.debug("Sleeping for %s second(s)", sleep_s)
-        time.sleep(sleep_s)
-        s = socket.socket()
-        try:
-            if timeout:
-                next_timeout = end - now()
-                if next_timeout < 0:
-                    return False
-                else:
-                    s.settimeout(next_timeout)
-
-            logging.info("connect %s %d", server, port)
-            s.connect((server, port))
-
-        except ConnectionError as err:
-            logging.debug("ConnectionError %s", err)
-            if sleep_s == 0:
-                sleep_s = 1
-
-        except socket.gaierror as err:
-            logging.debug("gaierror %s", err)
-            return False
-
-        except socket.timeout as err:
-            # this exception occurs only if timeout is set
-            if timeout:
-                return False
-
-        except TimeoutError as err:
-            # catch timeout exception from underlying network library
-            # this one is different from socket.timeout
-            raise
-
-        else:
-            s.close()
-            logging.info("wait_port_open: port %s:%s is open", server, port)
-            return True
-
-
 @contextlib.contextmanager
 def remember_cwd():
     '''
@@ -197,34 +339,205 @@ def retry(target_exception, tries=4, delay_s=1, backoff=2):
     return decorated_retry
 
 
+# Every stack status except DELETE_COMPLETE, for list_stacks StackStatusFilter
+STACK_LIVE_STATUSES = [
+    'CREATE_IN_PROGRESS', 'CREATE_FAILED', 'CREATE_COMPLETE',
+    'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
+    'DELETE_IN_PROGRESS', 'DELETE_FAILED',
+    'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE',
+    'UPDATE_FAILED', 'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED',
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE',
+    'REVIEW_IN_PROGRESS',
+    'IMPORT_IN_PROGRESS', 'IMPORT_COMPLETE', 'IMPORT_ROLLBACK_IN_PROGRESS',
+    'IMPORT_ROLLBACK_FAILED', 'IMPORT_ROLLBACK_COMPLETE',
+]
+
+
+class StackState(NamedTuple):
+    exists: bool
+    status: Optional[str] = None
+    outputs: Dict[str, str] = {}
+    parameters: Dict[str, str] = {}
+
+
+# (region, stack name) -> StackState, valid for the duration of the run
+_stack_states = {}
+
+
+def _stack_state_key(client, stack_name: str) -> Tuple[str, str]:
+    return client.meta.region_name, stack_name
+
+
+def _describe_stack_state(client, stack_name: str) -> StackState:
+    try:
+        stacks = client.describe_stacks(StackName=stack_name)['Stacks']
+    except botocore.exceptions.ClientError as e:
+        if 'does not exist' in str(e):
+            return StackState(False)
+        logging.warning("describe_stacks %s failed (%s), looking it up in list_stacks", stack_name, e)
+        return _list_stack_state(client, stack_name)
+    if not stacks:
+        return StackState(False)
+    stack = stacks[0]
+    outputs = {x['OutputKey']: x['OutputValue'] for x in stack.get('Outputs', [])}
+    parameters = {x['ParameterKey']: x.get('ParameterValue') for x in stack.get('Parameters', [])}
+    return StackState(True, stack['StackStatus'], outputs, parameters)
+
+
+def _list_stack_state(client, stack_name: str) -> StackState:
+    paginator = client.get_paginator('list_stacks')
+    for page in paginator.paginate(StackStatusFilter=STACK_LIVE_STATUSES):
+        for stack in page['StackSummaries']:
+            if stack['StackName'] == stack_name:
+                # Summaries don't have outputs
+                return StackState(True, stack['StackStatus'])
+    return StackState(False)
+
+
+def stack_state(client, stack_name: str, refresh: bool = False) -> StackState:
+    """
+    :returns: existence, status and outputs of the stack with a targeted describe_stacks call,
+        memoized until refresh is requested or the stack is modified through awsutils
+    """
+    key = _stack_state_key(client, stack_name)
+    if refresh or key not in _stack_states:
+        _stack_states[key] = _describe_stack_state(client, stack_name)
+    return _stack_states[key]
+
+
+def forget_stack_state(client, stack_name: str) -> None:
+    _stack_states.pop(_stack_state_key(client, stack_name), None)
+
+
 def stack_exists(client, stack_name):
-    stacks = client.list_stacks()['StackSummaries']
-    for stack in stacks:
-        if stack['StackStatus'] == 'DELETE_COMPLETE':
-            continue
-        if stack_name == stack['StackName']:
-            return True
-    return False
+    return stack_state(client, stack_name).exists
 
 
 def delete_stack_s3_content(client, stack_name) -> None:
-    stacks = client.describe_stacks(StackName=stack_name)
-    #In [24]: stack['Stacks'][0]['Outputs'][0]
-    # Out[24]:
+    state = stack_state(client, stack_name)
     # {'OutputKey': 'ArtifactBucket',
     # 'OutputValue': 'cdpipeline-s3bucket-1o1kj4z50v7gv',
     # 'Description': 'Bucket for build artifacts'}
     buckets = []
-    if not 'Outputs' in stacks['Stacks'][0]:
-        return
-    for output in stacks['Stacks'][0]['Outputs']:
-        if output['OutputKey'] == 'ArtifactBucket':
-            buckets.append(output['OutputValue'])
+    if 'ArtifactBucket' in state.outputs:
+        buckets.append(state.outputs['ArtifactBucket'])
     for bucket in buckets:
         logging.info("Nuking bucket: %s", bucket)
-        s3 = boto3.resource('s3')
-        b = s3.Bucket(bucket)
-        b.objects.all().delete()
+        purge_bucket(bucket, aws_client('s3', client.meta.region_name))
+
+
+# Keys accepted by a single delete_objects call
+S3_DELETE_MAX_KEYS = 1000
+
+
+class BucketPurgeStats:
+    """Thread safe counters for purge_bucket"""
+    def __init__(self, bucket: str):
+        import threading
+        import time
+        self.bucket = bucket
+        self.deleted = 0
+        self.failed = 0
+        self.start = time.time()
+        self.elapsed_s = 0.0
+        self._lock = threading.Lock()
+        self._next_report = 10000
+
+    def add(self, deleted: int, failed: int = 0) -> None:
+        import time
+        with self._lock:
+            self.deleted += deleted
+            self.failed += failed
+            self.elapsed_s = time.time() - self.start
+            if self.deleted >= self._next_report:
+                self._next_report += 10000
+                logging.info("%s", self)
+
+    def rate(self) -> float:
+        return self.deleted / self.elapsed_s if self.elapsed_s else 0.0
+
+    def __str__(self):
+        return "s3://{}: {} objects deleted, {} failed in {:.1f} s ({:.0f} objects/s)".format(
+            self.bucket, self.deleted, self.failed, self.elapsed_s, self.rate())
+
+
+def _s3_list_pages(s3_client, bucket: str, prefix: str, delimiter: Optional[str],
+                   versions: bool) -> Iterator[Tuple[List[Dict], List[str]]]:
+    """:returns: generator of (objects to delete, common prefixes) per listing page"""
+    kwargs = dict(Bucket=bucket, Prefix=prefix)
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    if versions:
+        # Lists every version and delete marker, including the current ones ('null' version when
+        # versioning was never enabled)
+        paginator = s3_client.get_paginator('list_object_versions')
+    else:
+        paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**kwargs):
+        if versions:
+            objects = [{'Key': x['Key'], 'VersionId': x['VersionId']}
+                       for x in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+        else:
+            objects = [{'Key': x['Key']} for x in page.get('Contents', [])]
+        yield objects, [x['Prefix'] for x in page.get('CommonPrefixes', [])]
+
+
+def _s3_delete_batch(s3_client, bucket: str, objects: List[Dict], stats: BucketPurgeStats,
+                     tries: int = 5, delay_s: float = 1, backoff: float = 2) -> None:
+    """Delete up to S3_DELETE_MAX_KEYS objects, retrying the keys that failed"""
+    import time
+    while True:
+        resp = s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+        errors = resp.get('Errors', [])
+        tries -= 1
+        if not errors or tries == 0:
+            stats.add(len(objects) - len(errors), len(errors))
+            break
+        stats.add(len(objects) - len(errors))
+        failed = {(x['Key'], x.get('VersionId')) for x in errors}
+        objects = [x for x in objects if (x['Key'], x.get('VersionId')) in failed]
+        logging.warning("s3://%s: %d objects failed to delete (%s), retrying in %d seconds...",
+                        bucket, len(objects), errors[0].get('Code'), delay_s)
+        time.sleep(delay_s)
+        delay_s *= backoff
+
+
+def purge_bucket(bucket: str, s3_client=None, versions: bool = True, workers: int = 16) -> BucketPurgeStats:
+    """
+    Delete every object in a bucket. The bucket is listed first, fanned out by top level prefix,
+    then the keys are deleted in 1000 key delete_objects batches from a thread pool. Deleting while
+    listing would invalidate the markers of the pages not listed yet.
+    :param versions: delete every object version and delete marker as well, otherwise versioned
+        buckets can't be deleted
+    :returns: BucketPurgeStats
+    :raises RuntimeError: if some objects couldn't be deleted
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if s3_client is None:
+        s3_client = aws_client('s3', max_pool_connections=max(workers, client_registry.max_pool_connections))
+    stats = BucketPurgeStats(bucket)
+
+    def list_prefix(prefix: str, delimiter: Optional[str] = None) -> Tuple[List[Dict], List[str]]:
+        objects = []
+        prefixes = []
+        for page_objects, common_prefixes in _s3_list_pages(s3_client, bucket, prefix, delimiter, versions):
+            objects.extend(page_objects)
+            prefixes.extend(common_prefixes)
+        return objects, prefixes
+
+    with ThreadPoolExecutor(workers) as executor:
+        objects, top_level_prefixes = list_prefix('', '/')
+        for prefix_objects, _ in executor.map(list_prefix, top_level_prefixes):
+            objects.extend(prefix_objects)
+        logging.info("s3://%s: %d objects to delete", bucket, len(objects))
+        deletes = [executor.submit(_s3_delete_batch, s3_client, bucket, batch, stats)
+                   for batch in _chunks(objects, S3_DELETE_MAX_KEYS)]
+        for delete in deletes:
+            delete.result()
+    logging.info("%s", stats)
+    if stats.failed:
+        raise RuntimeError("Couldn't delete {} objects from s3://{}".format(stats.failed, bucket))
+    return stats
 
 
 def delete_stack(client, stack_name) -> None:
@@ -233,17 +546,118 @@ def delete_stack(client, stack_name) -> None:
         # rm -rf /
         delete_stack_s3_content(client, stack_name)
         client.delete_stack(StackName=stack_name)
+        forget_stack_state(client, stack_name)
         waiter = client.get_waiter('stack_delete_complete')
         logging.info("Waiting for stack deletion...")
         waiter.wait(StackName=stack_name)
+        _stack_states[_stack_state_key(client, stack_name)] = StackState(False)
+
+
+def _stack_fingerprint(template_body, parameters: Dict[str, str]) -> str:
+    import hashlib
+    if not isinstance(template_body, str):
+        # get_template decodes JSON templates
+        template_body = json.dumps(template_body, sort_keys=True)
+    h = hashlib.sha256(template_body.encode('utf-8'))
+    h.update(json.dumps(parameters, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _deployed_stack_fingerprint(client, stack_name: str, parameter_keys: Sequence[str]) -> Optional[str]:
+    """:returns: fingerprint of the template and the given parameters of the deployed stack"""
+    state = stack_state(client, stack_name)
+    if not state.exists:
+        return None
+    template_body = client.get_template(StackName=stack_name, TemplateStage='Original')['TemplateBody']
+    return _stack_fingerprint(template_body, {k: state.parameters.get(k) for k in parameter_keys})
+
+
+# Status reasons of a change set that would do nothing
+CHANGE_SET_NO_CHANGES = ("didn't contain changes", "No updates are to be performed")
+
+
+def _change_set_changes(client, stack_name: str, change_set_name: str) -> List[Dict]:
+    changes = []
+    kwargs = dict(StackName=stack_name, ChangeSetName=change_set_name)
+    while True:
+        resp = client.describe_change_set(**kwargs)
+        changes.extend(x['ResourceChange'] for x in resp['Changes'] if 'ResourceChange' in x)
+        if not resp.get('NextToken'):
+            return changes
+        kwargs['NextToken'] = resp['NextToken']
+
+
+def print_change_set(stack_name: str, changes: List[Dict]) -> None:
+    print(f"Change set for stack '{stack_name}': {len(changes)} changes")
+    for change in changes:
+        print("  {:<8} {:<40} {:<40} replacement: {}".format(
+            change['Action'], change['LogicalResourceId'], change['ResourceType'],
+            change.get('Replacement', '-')))
+
+
+def deploy_change_set(client, stack_params: Dict, change_set_type: str = 'UPDATE', dry_run: bool = False) -> bool:
+    """
+    Create a change set for the stack and execute it, so only the changed resources are touched.
+    :param stack_params: create_stack style arguments
+    :param change_set_type: 'CREATE' or 'UPDATE'
+    :param dry_run: print the change set and delete it instead of executing it
+    :returns: True if the stack was changed
+    """
+    import time
+    stack_name = stack_params['StackName']
+    change_set_name = 'awsutils-{}'.format(int(time.time()))
+    change_set_params = {k: v for k, v in stack_params.items() if k in (
+        'StackName', 'TemplateBody', 'TemplateURL', 'Parameters', 'Capabilities', 'Tags', 'RoleARN',
+        'NotificationARNs', 'ResourceTypes', 'RollbackConfiguration')}
+    logging.info(f"Creating {change_set_type} change set {change_set_name} for stack {stack_name}")
+    client.create_change_set(ChangeSetName=change_set_name, ChangeSetType=change_set_type, **change_set_params)
+    try:
+        waiter = client.get_waiter('change_set_create_complete')
+        waiter.wait(StackName=stack_name, ChangeSetName=change_set_name, WaiterConfig={'Delay': 5})
+    except botocore.exceptions.WaiterError:
+        reason = client.describe_change_set(StackName=stack_name, ChangeSetName=change_set_name).get('StatusReason', '')
+        if any(x in reason for x in CHANGE_SET_NO_CHANGES):
+            logging.info(f"Stack {stack_name} is up to date")
+            client.delete_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+            return False
+        raise RuntimeError(f"Change set {change_set_name} for stack {stack_name} failed: {reason}")
+    changes = _change_set_changes(client, stack_name, change_set_name)
+    if dry_run:
+        print_change_set(stack_name, changes)
+        client.delete_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+        if change_set_type == 'CREATE':
+            # Don't leave an empty stack in REVIEW_IN_PROGRESS behind
+            client.delete_stack(StackName=stack_name)
+            forget_stack_state(client, stack_name)
+        return False
+    for change in changes:
+        logging.info("%s %s (%s)", change['Action'], change['LogicalResourceId'], change['ResourceType'])
+    client.execute_change_set(StackName=stack_name, ChangeSetName=change_set_name)
+    forget_stack_state(client, stack_name)
+    if change_set_type == 'CREATE':
+        waiter = client.get_waiter('stack_create_complete')
+        logging.info("Waiting for stack create...")
+    else:
+        waiter = client.get_waiter('stack_update_complete')
+        logging.info("Waiting for stack update...")
+    waiter.wait(StackName=stack_name)
+    return True
 
 
-def instantiate_CF_template(template: Template, stack_name: str = "unnamed", **params) -> None:
-    client = boto3.client('cloudformation')
+def instantiate_CF_template(template: Template, stack_name: str = "unnamed", dry_run: bool = False,
+                            client=None, **params) -> bool:
+    """
+    Create or update a stack from a template through a change set. Nothing is done if the template
+    and parameters are the same as the deployed stack's.
+    :param dry_run: only print the change set
+    :param client: cloudformation client, from the shared registry if not given
+    :returns: True if the stack was changed
+    """
+    if client is None:
+        client = aws_client('cloudformation')
     logging.info(f"Validating stack {stack_name}")
     tpl_yaml = template.to_yaml()
     validate_result = client.validate_template(TemplateBody=tpl_yaml)
-    logging.info(f"Creating stack {stack_name}")
     stack_params = dict(
         StackName=stack_name,
         TemplateBody=tpl_yaml,
@@ -252,108 +666,314 @@ def instantiate_CF_template(template: Template, stack_name: str = "unnamed", **p
         #OnFailure = 'DELETE',
     )
     stack_params.update(params)
-    if stack_exists(client, stack_name):
+    parameters = {x['ParameterKey']: x.get('ParameterValue') for x in stack_params['Parameters']}
+    state = stack_state(client, stack_name)
+    if state.exists and state.status != 'REVIEW_IN_PROGRESS':
         logging.warning(f"Stack '{stack_name}' already exists")
-        stacks = client.describe_stacks(StackName=stack_name)
-        status = stacks['Stacks'][0]['StackStatus']
-        if status == 'ROLLBACK_COMPLETE':
+        if state.status == 'ROLLBACK_COMPLETE':
             # Stacks in Rollback complete can't be updated.
             #input("Press enter to delete the stack (is in ROLLBACK_COMPLETE state) or ^C to abort...")
+            if dry_run:
+                logging.info("Stack is in ROLLBACK_COMPLETE and would be deleted and created again")
+                return False
             logging.info("Deleting stack...")
             delete_stack(client, stack_name)
-            stack_result = client.create_stack(**stack_params)
-            waiter = client.get_waiter('stack_create_complete')
-            logging.info("Waiting for stack create...")
-            waiter.wait(StackName=stack_name)
-        else:
-            stack_result = client.update_stack(**stack_params)
-            waiter = client.get_waiter('stack_update_complete')
-            logging.info("Waiting for stack update...")
-            waiter.wait(StackName=stack_name)
+            return deploy_change_set(client, stack_params, 'CREATE')
+        fingerprint = _stack_fingerprint(stack_params['TemplateBody'], parameters)
+        if fingerprint == _deployed_stack_fingerprint(client, stack_name, parameters.keys()):
+            logging.info(f"Stack '{stack_name}' is up to date with the template ({fingerprint[:12]})")
+            return False
+        return deploy_change_set(client, stack_params, 'UPDATE', dry_run)
     else:
-        stack_result = client.create_stack(**stack_params)
-        waiter = client.get_waiter('stack_create_complete')
-        logging.info("Waiting for stack create...")
-        waiter.wait(StackName=stack_name)
+        logging.info(f"Creating stack {stack_name}")
+        return deploy_change_set(client, stack_params, 'CREATE', dry_run)
 
 
-def get_ubuntu_ami(region, release, arch='amd64', instance_type='hvm:ebs-ssd'):
-    # https://aws.amazon.com/amazon-linux-ami/instance-type-matrix/
-    # https://cloud-images.ubuntu.com/locator/ec2/  -> Js console -> Network
-    ssl._create_default_https_context = ssl._create_unverified_context
-    ami_list = yaml.safe_load(urllib.request.urlopen(
-        "https://cloud-images.ubuntu.com/locator/ec2/releasesTable").read())['aaData']
-    # Items look like:
-    # ['us-east-1',
-    # 'artful',
-    # '17.10',
-    # 'amd64',
-    # 'hvm:instance-store',
-    # '20180621',
-    # '<a href="https://console.aws.amazon.com/ec2/home?region=us-east-1#launchAmi=ami-71e2b40e">ami-71e2b40e</a>',
-    # 'hvm']
-    res = [x for x in ami_list if x[0] == region and x[2].startswith(
-        release) and x[3] == arch and x[4] == instance_type]
-    ami_link = res[0][6]
-    ami_id = re.sub('<[^<]+?>', '', ami_link)
-    return ami_id
+UBUNTU_RELEASES_TABLE_URL = "https://cloud-images.ubuntu.com/locator/ec2/releasesTable"
+# https://ubuntu.com/server/docs/cloud-images/amazon-ec2
+UBUNTU_SSM_PARAMETER_FMT = ("/aws/service/canonical/ubuntu/server/{version}/stable/current/"
+                            "{arch}/{virt}/{storage}/ami-id")
+# releasesTable instance type -> volume type in Canonical's SSM parameter names
+UBUNTU_SSM_STORAGE = {
+    'ebs-ssd': 'ebs-gp2',
+    'ebs': 'ebs-standard',
+    'ebs-io1': 'ebs-io1',
+    'instance-store': 'instance-store',
+}
 
 
-def wait_port_open(server, port, timeout=None):
-    """ Wait for network service to appear
-        @param server: host to connect to (str)
-        @param port: port (int)
-        @param timeout: in seconds, if None or 0 wait forever
-        @return: True of False, if timeout is None may return only True or
-                 throw unhandled network exception
+def cache_dir(*subdirs: str) -> str:
+    """:returns: local cache folder for awsutils, can be changed with AWSUTILS_CACHE_DIR"""
+    base = os.getenv('AWSUTILS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'awsutils'))
+    path = os.path.join(base, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _write_json_atomic(path: str, obj) -> None:
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as f:
+        json.dump(obj, f)
+    os.replace(f.name, path)
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class UbuntuAMIResolver:
     """
-    import socket
-    import errno
-    import time
-    sleep_s = 0
-    if timeout:
-        from time import time as now
-        # time module is needed to calc timeout shared between two exceptions
-        end = now() + timeout
+    Resolve Ubuntu cloud image AMI ids.
 
-    while True:
-        logging.debug("Sleeping for %s second(s)", sleep_s)
-        time.sleep(sleep_s)
-        s = socket.socket()
+    With the default 'releases-table' source the cloud-images releasesTable is downloaded once, parsed
+    into a compact (region, version, arch, instance type) index and kept on disk. The cached index is
+    used as is for ttl_s seconds, then revalidated with ETag / If-Modified-Since, and used stale if the
+    download fails or offline is set.
+
+    The 'ssm' source reads Canonical's public SSM parameters instead, which are regional, so it does
+    one call per region and caches the results with the same ttl.
+    """
+    def __init__(self, source: str = 'releases-table', ttl_s: float = 24 * 3600, offline: bool = False,
+                 cache_path: Optional[str] = None, url: str = UBUNTU_RELEASES_TABLE_URL):
+        assert source in ('releases-table', 'ssm')
+        self.source = source
+        self.ttl_s = ttl_s
+        self.offline = offline
+        self.url = url
+        self.cache_path = cache_path or os.path.join(cache_dir('ubuntu_ami'), '{}.json'.format(source))
+        # (region, version, arch, instance_type) -> ami id
+        self._index = None
+        # [(codename, version)] in table order, to resolve a release prefix like '18.04' or 'bionic'
+        self._versions = []
+        # ssm: (region, version, arch, instance_type) -> (ami id, fetched timestamp)
+        self._ssm = None
+
+    def get(self, region: str, release: str, arch: str = 'amd64', instance_type: str = 'hvm:ebs-ssd') -> str:
+        return self.get_many([region], release, arch, instance_type)[region]
+
+    def get_many(self, regions: Sequence[str], release: str, arch: str = 'amd64',
+                 instance_type: str = 'hvm:ebs-ssd') -> Dict[str, str]:
+        """:returns: dict of region -> AMI id for the given release"""
+        if self.source == 'ssm':
+            return self._get_many_ssm(regions, release, arch, instance_type)
+        index = self.index()
+        res = {}
+        for region in regions:
+            for codename, version in self._versions:
+                if not (version.startswith(release) or codename == release):
+                    continue
+                ami = index.get((region, version, arch, instance_type))
+                if ami:
+                    res[region] = ami
+                    break
+            else:
+                raise RuntimeError("No Ubuntu AMI for {} {} {} {}".format(region, release, arch, instance_type))
+        return res
+
+    def index(self) -> Dict[Tuple[str, str, str, str], str]:
+        if self._index is None:
+            self._load_index(self._revalidate())
+        return self._index
+
+    def _load_index(self, cached: Dict) -> None:
+        import time
+        self._index = {}
+        versions = {}
+        for region, codename, version, arch, instance_type, ami in cached['images']:
+            self._index.setdefault((region, version, arch, instance_type), ami)
+            versions.setdefault((codename, version), None)
+        self._versions = list(versions.keys())
+        logging.debug("Ubuntu AMI index with %d images, %.0f s old", len(self._index),
+                      time.time() - cached['fetched'])
+
+    def _revalidate(self) -> Dict:
+        """:returns: cached table, downloading it only if the cache is expired and the table changed"""
+        import time
+        cached = _read_json(self.cache_path)
+        if cached and (self.offline or time.time() - cached['fetched'] < self.ttl_s):
+            return cached
+        if self.offline:
+            raise RuntimeError("No cached Ubuntu AMI table in {} to work offline".format(self.cache_path))
+        request = urllib.request.Request(self.url)
+        if cached and cached.get('etag'):
+            request.add_header('If-None-Match', cached['etag'])
+        if cached and cached.get('last_modified'):
+            request.add_header('If-Modified-Since', cached['last_modified'])
         try:
-            if timeout:
-                next_timeout = end - now()
-                if next_timeout < 0:
-                    return False
-                else:
-                    s.settimeout(next_timeout)
+            response = urllib.request.urlopen(request, timeout=30, context=ssl._create_unverified_context())
+            logging.info("Downloaded %s", self.url)
+            cached = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'images': UbuntuAMIResolver._parse_releases_table(response.read()),
+            }
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or not cached:
+                raise
+            logging.debug("%s not modified", self.url)
+        except (urllib.error.URLError, OSError) as e:
+            if not cached:
+                raise
+            logging.warning("Couldn't revalidate %s (%s), using the cached table", self.url, e)
+            return cached
+        cached['fetched'] = time.time()
+        _write_json_atomic(self.cache_path, cached)
+        return cached
+
+    @staticmethod
+    def _parse_releases_table(data: bytes) -> List[List[str]]:
+        """:returns: list of [region, codename, version, arch, instance type, ami id]"""
+        # Items look like:
+        # ['us-east-1',
+        # 'artful',
+        # '17.10',
+        # 'amd64',
+        # 'hvm:instance-store',
+        # '20180621',
+        # '<a href="https://console.aws.amazon.com/ec2/home?region=us-east-1#launchAmi=ami-71e2b40e">ami-71e2b40e</a>',
+        # 'hvm']
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        ami_list = yaml.load(data, Loader=loader)['aaData']
+        return [[x[0], x[1], x[2], x[3], x[4], re.sub('<[^<]+?>', '', x[6])] for x in ami_list]
+
+    def _get_many_ssm(self, regions: Sequence[str], release: str, arch: str, instance_type: str) -> Dict[str, str]:
+        import time
+        if self._ssm is None:
+            cached = _read_json(self.cache_path) or {'images': []}
+            self._ssm = {tuple(x[:4]): (x[4], x[5]) for x in cached['images']}
+        version = release.split()[0]
+        virt, storage = instance_type.split(':')
+        name = UBUNTU_SSM_PARAMETER_FMT.format(version=version, arch=arch, virt=virt,
+                                               storage=UBUNTU_SSM_STORAGE.get(storage, storage))
+        res = {}
+        fetched_any = False
+        for region in regions:
+            key = (region, version, arch, instance_type)
+            if key in self._ssm:
+                ami, fetched = self._ssm[key]
+                if self.offline or time.time() - fetched < self.ttl_s:
+                    res[region] = ami
+                    continue
+            if self.offline:
+                raise RuntimeError("No cached Ubuntu AMI for {} to work offline".format(key))
+            ssm = aws_client('ssm', region_name=region)
+            self._ssm[key] = (ssm.get_parameter(Name=name)['Parameter']['Value'], time.time())
+            res[region] = self._ssm[key][0]
+            fetched_any = True
+        if fetched_any:
+            _write_json_atomic(self.cache_path, {'images': [list(k) + list(v) for k, v in self._ssm.items()]})
+        return res
+
+
+_ubuntu_ami_resolvers = {}
+
+
+def get_ubuntu_ami(region, release, arch='amd64', instance_type='hvm:ebs-ssd', source='releases-table'):
+    # https://aws.amazon.com/amazon-linux-ami/instance-type-matrix/
+    # https://cloud-images.ubuntu.com/locator/ec2/  -> Js console -> Network
+    if source not in _ubuntu_ami_resolvers:
+        _ubuntu_ami_resolvers[source] = UbuntuAMIResolver(source)
+    return _ubuntu_ami_resolvers[source].get(region, release, arch, instance_type)
 
-            logging.info("connect %s %d", server, port)
-            s.connect((server, port))
 
-        except ConnectionError as err:
-            logging.debug("ConnectionError %s", err)
-            if sleep_s == 0:
-                sleep_s = 1
 
-        except socket.gaierror as err:
-            logging.debug("gaierror %s", err)
+
+
+async def _probe_port(server: str, port: int, deadline: float, ssh_banner: bool = False,
+                      connect_timeout: float = 5.0, retry_s: float = 1.0) -> bool:
+    """
+    Probe a single host:port until it accepts connections or the deadline (event loop time) passes.
+    Name resolution failures are retried, since fresh EC2 DNS names can take a while to resolve.
+    :param ssh_banner: require the peer to send an SSH identification string, not only accept TCP
+    :returns: True if the port became reachable before the deadline
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            logging.debug("probe %s:%d timed out", server, port)
             return False
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(server, port), min(connect_timeout, remaining))
+        except socket.gaierror as err:
+            logging.debug("probe %s:%d gaierror %s", server, port, err)
+        except (OSError, asyncio.TimeoutError) as err:
+            logging.debug("probe %s:%d %s", server, port, repr(err))
+        else:
+            try:
+                if not ssh_banner:
+                    return True
+                remaining = max(deadline - loop.time(), 0.1)
+                banner = await asyncio.wait_for(reader.readline(), min(connect_timeout, remaining))
+                if banner.startswith(b'SSH-'):
+                    logging.debug("probe %s:%d banner %s", server, port, banner.strip())
+                    return True
+                logging.debug("probe %s:%d unexpected banner %s", server, port, banner)
+            except (OSError, asyncio.TimeoutError) as err:
+                logging.debug("probe %s:%d no banner %s", server, port, repr(err))
+            finally:
+                writer.close()
+        await asyncio.sleep(min(retry_s, max(deadline - loop.time(), 0)))
+
+
+async def _probe_target(server: str, port: int, deadline: float, ssh_banner: bool) -> Tuple[str, int, bool]:
+    return server, port, await _probe_port(server, port, deadline, ssh_banner)
+
+
+def wait_ports_open(targets: Sequence[Tuple[str, int]], timeout: Optional[float] = None,
+                    ssh_banner: bool = False) -> Iterator[Tuple[str, int, bool]]:
+    """
+    Wait concurrently for network services on several hosts to appear.
+    Total wait is bounded by the slowest host instead of the sum of all of them.
 
-        except socket.timeout as err:
-            # this exception occurs only if timeout is set
-            if timeout:
-                return False
+        for host, port, is_open in wait_ports_open([(h, 22) for h in hosts], 300, ssh_banner=True):
+            ...
 
-        except TimeoutError as err:
-            # catch timeout exception from underlying network library
-            # this one is different from socket.timeout
-            raise
+    @param targets: sequence of (host, port) tuples
+    @param timeout: in seconds, shared by all the targets, if None or 0 wait forever
+    @param ssh_banner: require an SSH server banner instead of a bare TCP connect
+    @return: generator of (host, port, is_open) in the order the targets become reachable,
+             targets that didn't open before the timeout are yielded last with is_open False
+    """
+    loop = asyncio.new_event_loop()
+    pending = set()
+    try:
+        deadline = loop.time() + timeout if timeout else float('inf')
+        tasks = [loop.create_task(_probe_target(server, port, deadline, ssh_banner))
+                 for server, port in targets]
+        pending = set(tasks)
+        while pending:
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                server, port, is_open = task.result()
+                if is_open:
+                    logging.info("wait_ports_open: port %s:%s is open", server, port)
+                else:
+                    logging.warning("wait_ports_open: port %s:%s not open after %s s", server, port, timeout)
+                yield server, port, is_open
+    finally:
+        # The caller might stop iterating early, don't leave probes behind
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+        loop.close()
 
-        else:
-            s.close()
-            logging.info("wait_port_open: port %s:%s is open", server, port)
-            return True
+
+def wait_port_open(server, port, timeout=None):
+    """ Wait for network service to appear, see wait_ports_open
+        @param server: host to connect to (str)
+        @param port: port (int)
+        @param timeout: in seconds, if None or 0 wait forever
+        @return: True of False
+    """
+    return next(wait_ports_open([(server, port)], timeout))[2]
 
 
 def create_security_groups(ec2_client, ec2_resource):
@@ -376,31 +996,136 @@ def create_security_groups(ec2_client, ec2_resource):
     return [sec_group_name]
 
 
-def wait_for_instances(instances):
+def _chunks(xs: Sequence, n: int) -> Iterator[Sequence]:
+    for i in range(0, len(xs), n):
+        yield xs[i:i + n]
+
+
+# Ids accepted by a single describe_instance_status call
+EC2_DESCRIBE_MAX_IDS = 100
+# Wait for instances to be running with status checks ok, as the instance_running and
+# instance_status_ok waiters did one after the other
+INSTANCE_READY_TIMEOUT_S = 1200
+INSTANCE_FAILED_STATES = {'shutting-down', 'terminated', 'stopping', 'stopped'}
+
+
+INSTANCE_ID_RE = re.compile(r'\bi-[0-9a-f]+\b')
+
+
+def _instance_states(ec2_client, instance_ids: Sequence[str]) -> Dict[str, Dict]:
     """
-    Wait until the given boto3 instance objects are running
+    :returns: dict of instance id -> InstanceStatuses item, using batched describe_instance_status.
+        Instances which EC2 doesn't know about yet, as it happens right after launching them, are left out.
     """
-    logging.info("Waiting for instances: {}".format([i.id for i in instances]))
-    for i in instances:
-        logging.info("Waiting for instance {}".format(i.id))
-        i.wait_until_running()
-        logging.info("Instance {} running".format(i.id))
+    res = {}
+    paginator = ec2_client.get_paginator('describe_instance_status')
+    for ids in _chunks(list(instance_ids), EC2_DESCRIBE_MAX_IDS):
+        ids = list(ids)
+        while ids:
+            try:
+                for page in paginator.paginate(InstanceIds=ids, IncludeAllInstances=True):
+                    for status in page['InstanceStatuses']:
+                        res[status['InstanceId']] = status
+                break
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                    raise
+                # The whole batch fails, ask again for the ones the error doesn't mention
+                missing = set(INSTANCE_ID_RE.findall(e.response['Error'].get('Message', '')))
+                logging.debug("Instances %s not found yet", sorted(missing))
+                ids = [] if not missing & set(ids) else [x for x in ids if x not in missing]
+    return res
+
+
+def _describe_instances(ec2_client, instance_ids: Sequence[str]) -> Dict[str, Dict]:
+    """:returns: dict of instance id -> describe_instances record"""
+    res = {}
+    paginator = ec2_client.get_paginator('describe_instances')
+    for ids in _chunks(list(instance_ids), EC2_DESCRIBE_MAX_IDS):
+        for page in paginator.paginate(InstanceIds=list(ids)):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    res[instance['InstanceId']] = instance
+    return res
+
+
+def _is_instance_ready(status: Dict, status_ok: bool) -> bool:
+    if status['InstanceState']['Name'] != 'running':
+        return False
+    if not status_ok:
+        return True
+    return status.get('InstanceStatus', {}).get('Status') == 'ok' and \
+        status.get('SystemStatus', {}).get('Status') == 'ok'
+
+
+def iter_ready_instances(ec2_client, instance_ids: Sequence[str], status_ok: bool = True,
+                         timeout: Optional[float] = None, min_delay_s: float = 2,
+                         max_delay_s: float = 15) -> Iterator[Dict]:
+    """
+    Wait for the given instances with a few batched describe calls per round and yield each one as
+    soon as it's ready, so the caller can start working on it while the rest are still booting.
+    The poll interval grows while nothing changes and goes back to min_delay_s on progress.
+    Instances EC2 doesn't report yet (InvalidInstanceID.NotFound) are kept pending.
+
+    :param ec2_client: boto3 ec2 client
+    :param instance_ids: ids of the instances to wait for
+    :param status_ok: wait for instance and system status checks to pass, otherwise just for 'running'
+    :param timeout: in seconds, if None wait forever
+    :returns: generator of describe_instances records (PublicDnsName, PublicIpAddress,
+        PrivateIpAddress, Placement...) in the order the instances become ready
+    :raises RuntimeError: if an instance is stopped or terminated while waiting
+    :raises TimeoutError: if the instances are not ready before the timeout
+    """
+    import time
+    pending = set(instance_ids)
+    end = time.time() + timeout if timeout else None
+    delay_s = min_delay_s
+    logging.info("Waiting for instances: %s", sorted(pending))
+    while pending:
+        states = _instance_states(ec2_client, sorted(pending))
+        failed = sorted(i for i, st in states.items() if st['InstanceState']['Name'] in INSTANCE_FAILED_STATES)
+        if failed:
+            raise RuntimeError("Instances {} are no longer running".format(failed))
+        ready = [i for i, st in states.items() if i in pending and _is_instance_ready(st, status_ok)]
+        if ready:
+            records = _describe_instances(ec2_client, ready)
+            for instance_id in ready:
+                pending.discard(instance_id)
+                logging.info("Instance %s ready, %d pending", instance_id, len(pending))
+                yield records[instance_id]
+            delay_s = min_delay_s
+            continue
+        sleep_s = delay_s
+        if end:
+            now = time.time()
+            if now >= end:
+                raise TimeoutError("Instances {} not ready after {} s".format(sorted(pending), timeout))
+            sleep_s = min(delay_s, end - now)
+        logging.debug("Waiting %.1f s for instances %s", sleep_s, sorted(pending))
+        time.sleep(sleep_s)
+        delay_s = min(delay_s * 1.5, max_delay_s)
 
-    client = boto3.client('ec2')
-    waiter = client.get_waiter('instance_status_ok')
-    logging.info("Waiting for instances to initialize (status ok): {}".format([i.id for i in instances]))
-    waiter.wait(InstanceIds=[i.id for i in instances])
+
+def wait_for_instances(instances, ec2_client=None, timeout: Optional[float] = INSTANCE_READY_TIMEOUT_S):
+    """
+    Wait until the given boto3 instance objects are running and their status checks are ok
+    :raises TimeoutError: if they are not ready after timeout seconds
+    """
+    if ec2_client is None:
+        ec2_client = aws_client('ec2')
+    by_id = {i.id: i for i in instances}
+    for record in iter_ready_instances(ec2_client, list(by_id.keys()), timeout=timeout):
+        # Refresh the resource from the record we already have instead of reload()
+        by_id[record['InstanceId']].meta.data = record
     logging.info("EC2 instances are ready to roll")
-    for i in instances:
-        i.reload()
 
 
 def parse_args():
     with open('launch_template.yml', 'r') as f:
         launch_template = yaml.load(f)
     parser = argparse.ArgumentParser(description="launcher")
-    parser.add_argument('-n', '--instance-name', default=launch_template.get('instance-name',
-                                                                             "{}-{}".format('worker', getpass.getuser())))
+    parser.add_argument('-n', '--instance-name',
+                        default=launch_template.get('instance-name', "{}-{}".format('worker', getpass.getuser())))
     parser.add_argument('-i', '--instance-type', default=launch_template['instance-type'])
     parser.add_argument('--ubuntu', default=launch_template.get('ubuntu'))
     parser.add_argument('-u', '--username',
@@ -419,23 +1144,196 @@ def read_file(file):
         return f.read()
 
 
+# ansible-playbook PLAY RECAP line
+ANSIBLE_RECAP_RE = re.compile(r'^(\S+)\s+:\s+ok=(\d+)\s+changed=(\d+)\s+unreachable=(\d+)\s+failed=(\d+)')
+
+
+def ansible_env(**overrides) -> Dict[str, str]:
+    """
+    :returns: environment for running ansible-playbook fast against fresh instances. With an
+        ANSIBLE_CONFIG the settings are left to it, the environment would override the ones in the file.
+    """
+    env = dict(os.environ)
+    env.update(overrides)
+    if 'ANSIBLE_CONFIG' not in env:
+        for k, v in {
+            'ANSIBLE_HOST_KEY_CHECKING': 'False',
+            # Run modules through the ssh connection instead of copying them first
+            'ANSIBLE_PIPELINING': 'True',
+            'ANSIBLE_SSH_ARGS': '-o ControlMaster=auto -o ControlPersist=300s -o ServerAliveInterval=30',
+        }.items():
+            env.setdefault(k, v)
+    return env
+
+
+def ansible_provision_hosts(hosts: Sequence[str], username: str, playbook: str = 'playbook.yml',
+                            forks: Optional[int] = None, env: Optional[Dict[str, str]] = None,
+                            extra_vars: Optional[Dict] = None) -> Dict[str, bool]:
+    """
+    Ansible provisioning of several hosts with a single ansible-playbook run
+    :param forks: hosts provisioned in parallel, all of them by default
+    :param env: environment for ansible-playbook, ansible_env() by default
+    :param extra_vars: additional inventory variables
+    :returns: dict of host -> True if the playbook succeeded on it
+    """
+    import subprocess
+    import tempfile
+    assert hosts
+    assert username
+    if forks is None:
+        forks = max(len(hosts), 5)
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml') as inventory:
+        inventory.write(yaml_ansible_inventory(hosts, ansible_user='ubuntu', user_name=username, **(extra_vars or {})))
+        inventory.flush()
+        ansible_cmd = [
+            "ansible-playbook",
+            # "-v", # verbose
+            "-i", inventory.name,
+            "-f", str(forks),
+            playbook]
+        logging.info("Executing: '{}' on {}".format(' '.join(ansible_cmd), hosts))
+        results = {host: False for host in hosts}
+        with subprocess.Popen(ansible_cmd, env=env or ansible_env(), stdout=subprocess.PIPE,
+                              universal_newlines=True) as proc:
+            for line in proc.stdout:
+                sys.stdout.write(line)
+                m = ANSIBLE_RECAP_RE.match(line)
+                if m and m.group(1) in results:
+                    results[m.group(1)] = int(m.group(4)) == 0 and int(m.group(5)) == 0
+        if proc.returncode != 0:
+            logging.error("ansible-playbook exited with %d", proc.returncode)
+    for host, ok in results.items():
+        logging.info("Provisioning %s: %s", host, 'ok' if ok else 'FAILED')
+    return results
+
+
+def task_timings_summary(timings: Sequence[Dict]) -> Dict[str, float]:
+    """
+    :param timings: records written by the task_timings ansible callback plugin
+    :returns: dict of task -> wall-clock seconds, the slowest host for each task
+    """
+    res = {}
+    for x in timings:
+        res[x['task']] = max(res.get(x['task'], 0.0), x['duration_s'])
+    return res
+
+
+def compare_task_timings(current: Dict[str, float], baseline: Dict[str, float], top: int = 20) -> str:
+    """:returns: table of the slowest tasks in current with their time in baseline"""
+    lines = ["{:>9} {:>9} {:>9}  {}".format('time_s', 'base_s', 'delta_s', 'task')]
+    for task, t in sorted(current.items(), key=lambda x: -x[1])[:top]:
+        if task in baseline:
+            lines.append("{:9.1f} {:9.1f} {:+9.1f}  {}".format(t, baseline[task], t - baseline[task], task))
+        else:
+            lines.append("{:9.1f} {:>9} {:>9}  {}".format(t, '-', '-', task))
+    total, base_total = sum(current.values()), sum(baseline.values())
+    if baseline:
+        lines.append("{:9.1f} {:9.1f} {:+9.1f}  {}".format(total, base_total, total - base_total, 'TOTAL'))
+    else:
+        lines.append("{:9.1f} {:>9} {:>9}  {}".format(total, '-', '-', 'TOTAL'))
+    return '\n'.join(lines)
+
+
+class Timeline:
+    """
+    Wall-clock timeline of the phases of a job, phases can be recorded from several threads.
+    Each phase is a dict with name, start_s (from the start of the timeline), duration_s, ok and
+    any attributes given.
+    """
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name: str, **attrs) -> Iterator[Dict]:
+        """Record the duration of the with block, the yielded record can be updated in the block"""
+        start = time.time()
+        record = dict(name=name, start_s=round(start - self.started, 3), **attrs)
+        record['ok'] = False
+        try:
+            yield record
+            record['ok'] = True
+        finally:
+            record['duration_s'] = round(time.time() - start, 3)
+            with self._lock:
+                self.phases.append(record)
+            logging.info("Phase %s: %.1f s%s", name, record['duration_s'], '' if record['ok'] else ' FAILED')
+
+    def add(self, name: str, duration_s: float, start_s: Optional[float] = None, **attrs) -> None:
+        """Add a phase measured elsewhere"""
+        record = dict(name=name, start_s=None if start_s is None else round(start_s, 3),
+                      duration_s=round(duration_s, 3), ok=True)
+        record.update(attrs)
+        with self._lock:
+            self.phases.append(record)
+
+    def durations(self) -> Dict[str, float]:
+        """:returns: dict of phase name -> total seconds, in order of appearance"""
+        res = {}
+        for x in sorted(self.phases, key=lambda x: x['start_s'] if x['start_s'] is not None else -1):
+            res[x['name']] = res.get(x['name'], 0.0) + x['duration_s']
+        return res
+
+    def total_s(self) -> float:
+        return self.attrs.get('total_s', time.time() - self.started)
+
+    def summary(self, max_len: int = 255) -> str:
+        """:returns: short 'total=... phase=seconds...' summary, fits in a tag value"""
+        items = ['total={:.0f}'.format(self.total_s())]
+        items.extend('{}={:.0f}'.format(name, t) for name, t in self.durations().items())
+        res = ''
+        for item in items:
+            if len(res) + len(item) + 1 > max_len:
+                break
+            res = '{} {}'.format(res, item) if res else item
+        return res
+
+    def to_dict(self) -> Dict:
+        attrs = dict(self.attrs, total_s=round(self.total_s(), 3))
+        return {'name': self.name, 'started': self.started, 'attrs': attrs,
+                'phases': sorted(self.phases, key=lambda x: x['start_s'] if x['start_s'] is not None else -1)}
+
+    def save(self, path: str) -> None:
+        _write_json_atomic(path, self.to_dict())
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> 'Timeline':
+        res = cls(d['name'], **d.get('attrs', {}))
+        res.started = d['started']
+        res.phases = d['phases']
+        return res
+
+    @classmethod
+    def load(cls, path: str) -> 'Timeline':
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def task_timings(self) -> Dict[str, float]:
+        """:returns: ansible task -> seconds, of the phases which recorded 'tasks'"""
+        res = {}
+        for x in self.phases:
+            for task, t in x.get('tasks', {}).items():
+                res[task] = res.get(task, 0.0) + t
+        return res
+
+
+def compare_timelines(current: Timeline, baseline: Timeline, top: int = 20) -> str:
+    """:returns: tables of the phase and ansible task durations of current compared with baseline"""
+    return "Phases:\n{}\n\nAnsible tasks:\n{}".format(
+        compare_task_timings(current.durations(), baseline.durations(), top),
+        compare_task_timings(current.task_timings(), baseline.task_timings(), top))
+
+
 def ansible_provision_host(host: str, username: str, playbook: str = 'playbook.yml') -> None:
     """
     Ansible provisioning
     """
     assert host
-    assert username
-    ansible_cmd = [
-        "ansible-playbook",
-        # "-v", # verbose
-        "-u", "ubuntu",
-        "-i", "{},".format(host),
-        playbook,
-        "--extra-vars", "user_name={}".format(username)]
-
-    logging.info("Executing: '{}'".format(' '.join(ansible_cmd)))
-    os.environ['ANSIBLE_HOST_KEY_CHECKING'] = 'False'
-    check_call(ansible_cmd)
+    if not ansible_provision_hosts([host], username, playbook)[host]:
+        raise RuntimeError("Ansible provisioning of {} failed".format(host))
 
 
 def yaml_ansible_inventory(hosts, **vars):
@@ -449,35 +1347,177 @@ def yaml_ansible_inventory(hosts, **vars):
     return yaml.dump(invdata)
 
 
-def create_inventory(file: str = 'inventory.yaml') -> None:
+class InstanceRecord:
+    """Compact snapshot of the fields of an EC2 instance we use"""
+    __slots__ = ('id', 'type', 'az', 'public_ip', 'private_ip', 'public_dns', 'private_dns', 'state', 'tags')
+
+    def __init__(self, id: str, type: str, az: str, public_ip: Optional[str], private_ip: Optional[str],
+                 public_dns: Optional[str], private_dns: Optional[str], state: str, tags: Dict[str, str]):
+        self.id = id
+        self.type = type
+        self.az = az
+        self.public_ip = public_ip
+        self.private_ip = private_ip
+        self.public_dns = public_dns
+        self.private_dns = private_dns
+        self.state = state
+        self.tags = tags
+
+    @staticmethod
+    def from_describe(x: Dict) -> 'InstanceRecord':
+        """:param x: item of describe_instances Reservations[].Instances"""
+        return InstanceRecord(
+            x['InstanceId'], x['InstanceType'], x['Placement']['AvailabilityZone'],
+            x.get('PublicIpAddress'), x.get('PrivateIpAddress'),
+            x.get('PublicDnsName') or None, x.get('PrivateDnsName') or None,
+            x['State']['Name'], {t['Key']: t['Value'] for t in x.get('Tags', [])})
+
+    def to_dict(self) -> Dict:
+        return {k: getattr(self, k) for k in InstanceRecord.__slots__}
+
+    def __repr__(self):
+        return 'InstanceRecord({} {} {} {})'.format(self.id, self.type, self.az, self.state)
+
+
+class FleetSnapshot:
+    """
+    Instances matching some filters, fetched once with a paginated describe_instances and indexed by
+    tag, state and availability zone. Can be saved as JSON and reused by later commands.
+    """
+    def __init__(self, records: Sequence[InstanceRecord], filters: Optional[List[Dict]] = None,
+                 taken: Optional[float] = None):
+        import time
+        self.records = list(records)
+        self.filters = filters or []
+        self.taken = taken or time.time()
+        self._by_id = {}
+        self._by_tag = {}
+        self._by_state = {}
+        self._by_az = {}
+        for r in self.records:
+            self._by_id[r.id] = r
+            self._by_state.setdefault(r.state, []).append(r)
+            self._by_az.setdefault(r.az, []).append(r)
+            for k, v in r.tags.items():
+                self._by_tag.setdefault((k, v), []).append(r)
+
+    @staticmethod
+    def fetch(*tags: Tuple[str, str], states: Sequence[str] = ('pending', 'running'),
+              ec2_client=None) -> 'FleetSnapshot':
+        """:param tags: (key, value) tuples the instances must have"""
+        if ec2_client is None:
+            ec2_client = aws_client('ec2')
+        filters = [{'Name': f'tag:{k}', 'Values': [v]} for k, v in tags]
+        filters.append({'Name': 'instance-state-name', 'Values': list(states)})
+        records = []
+        paginator = ec2_client.get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                records.extend(map(InstanceRecord.from_describe, reservation['Instances']))
+        logging.info("Fleet snapshot: %d instances", len(records))
+        return FleetSnapshot(records, filters)
+
+    def __iter__(self) -> Iterator[InstanceRecord]:
+        return iter(self.records)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, instance_id: str) -> Optional[InstanceRecord]:
+        return self._by_id.get(instance_id)
+
+    def by_tag(self, key: str, value: str) -> List[InstanceRecord]:
+        return self._by_tag.get((key, value), [])
+
+    def by_state(self, state: str) -> List[InstanceRecord]:
+        return self._by_state.get(state, [])
+
+    def by_az(self, az: str) -> List[InstanceRecord]:
+        return self._by_az.get(az, [])
+
+    def public_dns_names(self) -> List[str]:
+        return [r.public_dns for r in self.records if r.public_dns]
+
+    def public_ips(self) -> List[str]:
+        return [r.public_ip for r in self.records if r.public_ip]
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'taken': self.taken,
+            'filters': self.filters,
+            'instances': [r.to_dict() for r in self.records]
+        })
+
+    @staticmethod
+    def from_json(data: str) -> 'FleetSnapshot':
+        x = json.loads(data)
+        return FleetSnapshot([InstanceRecord(**r) for r in x['instances']], x['filters'], x['taken'])
+
+    def save(self, file: str) -> None:
+        with open(file, 'w') as fh:
+            fh.write(self.to_json())
+
+    @staticmethod
+    def load(file: str) -> 'FleetSnapshot':
+        with open(file, 'r') as fh:
+            return FleetSnapshot.from_json(fh.read())
+
+
+# tags -> FleetSnapshot taken in this process
+_fleet_snapshots = {}
+
+
+def fleet_snapshot(*tags: Tuple[str, str], file: Optional[str] = None, max_age_s: float = 300) -> FleetSnapshot:
+    """
+    :returns: snapshot of the running instances with the given tags, reusing one taken in this process
+        or saved in file if it's not older than max_age_s, otherwise a new one which is saved to file
+    """
+    import time
+    snapshot = _fleet_snapshots.get(tags)
+    saved = file and os.path.exists(file)
+    if not snapshot and saved:
+        snapshot = FleetSnapshot.load(file)
+    if not snapshot or time.time() - snapshot.taken > max_age_s:
+        snapshot = FleetSnapshot.fetch(*tags)
+        saved = False
+    if file and not saved:
+        snapshot.save(file)
+    _fleet_snapshots[tags] = snapshot
+    return snapshot
+
+
+def create_inventory(file: str = 'inventory.yaml', snapshot: Optional[FleetSnapshot] = None) -> None:
     """Create inventory file from running tagged instances"""
     logging.info(f"Creating inventory file: '{file}'")
     if os.path.exists(file):
         logging.warning(f"create_inventory: '{file}' already exists, skipping")
         return
         #raise FileExistsError(f"'{file}' already exists")
-    instances = get_tagged_instances(('label', 'benchmark'))
-    hostnames = list(map(lambda x: x.public_dns_name, instances))
+    if snapshot is None:
+        snapshot = fleet_snapshot(('label', 'benchmark'))
+    hostnames = snapshot.public_dns_names()
     logging.info("hosts %s", hostnames)
     with open(file, 'w+') as fh:
         fh.write(yaml_ansible_inventory(hostnames, ansible_user='ubuntu', user_name='piotr'))
 
 
-def create_hosts_file(file: str = 'hosts.txt') -> None:
+def create_hosts_file(file: str = 'hosts.txt', snapshot: Optional[FleetSnapshot] = None) -> None:
     """Create a hosts file with ip addresses from the cluster nodes for mpirun / horovod"""
     logging.info(f"Creating hosts file: '{file}'")
     if os.path.exists(file):
         logging.warning(f"create_hosts_file: '{file}' already exists, skipping")
         return
-    instances = get_tagged_instances(('label', 'benchmark'))
-    ips = list(map(lambda x: x.public_ip_address, instances))
+    if snapshot is None:
+        snapshot = fleet_snapshot(('label', 'benchmark'))
+    ips = snapshot.public_ips()
     logging.info("ips %s", ips)
     with open(file, 'w+') as fh:
         fh.write('\n'.join(ips))
 
 
-def get_tagged_instances(*tags):
-    ec2_resource = boto3.resource('ec2')
+def get_tagged_instances(*tags, ec2_resource=None):
+    if ec2_resource is None:
+        ec2_resource = aws_resource('ec2')
     filters = []
     for k, v in tags:
         filters.append({'Name': f'tag:{k}', 'Values': [v]})
@@ -492,18 +1532,172 @@ def assemble_userdata(*userdata_files):
         assemble_userdata(('userdata.py', 'text/x-shellscript'), ('cloud-config',
         'text/cloud-config'))
     """
+    from email.charset import Charset
     from email.mime.multipart import MIMEMultipart
     from email.mime.text import MIMEText
+    # 8bit parts, base64 would take a third more of the user data size limit
+    charset = Charset(sys.getdefaultencoding())
+    charset.body_encoding = None
     combined_message = MIMEMultipart()
     for fname, mimetype in userdata_files:
         with open(fname, "r") as f:
             content = f.read()
-        sub_message = MIMEText(content, mimetype, sys.getdefaultencoding())
+        # MIMEText takes the subtype, text/cloud-config -> cloud-config
+        sub_message = MIMEText(content, mimetype.split('/', 1)[-1], charset)
         sub_message.add_header('Content-Disposition', 'attachment; filename="{}"'.format(fname))
         combined_message.attach(sub_message)
     return combined_message
 
 
+# EC2 limit of the user data, before base64 encoding
+USERDATA_MAX_BYTES = 16 * 1024
+# Warn when the user data takes more than this fraction of the limit
+USERDATA_WARN_FRACTION = 0.85
+_userdata_cache = {}
+_userdata_lock = threading.Lock()
+
+
+def build_userdata(userdata_files: Sequence[Tuple[str, str]], compress: bool = True,
+                   max_bytes: int = USERDATA_MAX_BYTES) -> bytes:
+    """
+    Build the user data of several files for cloud-init, gzip compressed. The payload is cached by
+    the hash of the files contents so launches of the same files reuse it.
+
+    :param userdata_files: tuples defining file and mime type for cloud-init, a single file is sent
+        as is without multipart
+    :param compress: gzip the payload, cloud-init decompresses it
+    :returns: user data to pass as UserData to run_instances
+    :raises RuntimeError: if the payload is over max_bytes
+    """
+    import gzip
+    import hashlib
+    h = hashlib.sha256(b'gzip' if compress else b'raw')
+    for fname, mimetype in userdata_files:
+        with open(fname, 'rb') as f:
+            content = f.read()
+        h.update('{}\0{}\0{}\0'.format(fname, mimetype, len(content)).encode())
+        h.update(content)
+    key = h.hexdigest()
+    with _userdata_lock:
+        payload = _userdata_cache.get(key)
+    if payload is None:
+        if len(userdata_files) == 1:
+            with open(userdata_files[0][0], 'rb') as f:
+                payload = f.read()
+        else:
+            message = assemble_userdata(*userdata_files)
+            # Same parts, same payload
+            message.set_boundary('==============={}=='.format(key[:20]))
+            payload = message.as_bytes()
+        size = len(payload)
+        if compress:
+            payload = gzip.compress(payload, mtime=0)
+        logging.info("User data %s: %d bytes%s, limit %d", [x[0] for x in userdata_files], len(payload),
+                     ' ({} before gzip)'.format(size) if compress else '', max_bytes)
+        with _userdata_lock:
+            _userdata_cache[key] = payload
+    if len(payload) > max_bytes:
+        raise RuntimeError("User data of {} is {} bytes, over the limit of {} bytes".format(
+            [x[0] for x in userdata_files], len(payload), max_bytes))
+    if len(payload) > max_bytes * USERDATA_WARN_FRACTION:
+        logging.warning("User data of %s is %d bytes, close to the limit of %d bytes",
+                        [x[0] for x in userdata_files], len(payload), max_bytes)
+    return payload
+
+
+class LaunchOption(NamedTuple):
+    """Where to launch instances, by priority in launch_fleet"""
+    instance_type: str
+    subnet_id: Optional[str] = None
+    availability_zone: Optional[str] = None
+
+
+def _run_instances(ec2_client, option: LaunchOption, count: int, launch_kwargs: Dict) -> List[str]:
+    """Launch up to count instances with option, :returns: list of instance ids"""
+    import copy
+    kwargs = copy.deepcopy(launch_kwargs)
+    kwargs.update(InstanceType=option.instance_type, MinCount=1, MaxCount=count)
+    if option.subnet_id:
+        if 'NetworkInterfaces' in kwargs:
+            kwargs['NetworkInterfaces'][0]['SubnetId'] = option.subnet_id
+        else:
+            kwargs['SubnetId'] = option.subnet_id
+    if option.availability_zone:
+        kwargs.setdefault('Placement', {})['AvailabilityZone'] = option.availability_zone
+    return [x['InstanceId'] for x in ec2_client.run_instances(**kwargs)['Instances']]
+
+
+def launch_fleet(ec2_client, count: int, options: Sequence[LaunchOption], launch_kwargs: Dict,
+                 tags: Optional[Dict[str, str]] = None, min_count: Optional[int] = None,
+                 spread: int = 1) -> List[str]:
+    """
+    Launch count instances using a prioritized list of instance type / subnet / AZ options.
+
+    The remaining count is launched on the first option accepting partial fulfilment. Options that
+    fail or fall short (ex. no capacity for the instance type in that AZ) are dropped and only the
+    shortfall goes to the next option, until the count is reached or the options run out.
+
+    :param launch_kwargs: run_instances arguments other than InstanceType, MinCount and MaxCount
+    :param tags: instance tags, applied at launch with TagSpecifications
+    :param min_count: accept fewer instances than count, default is count
+    :param spread: split the remaining count across this many options launched concurrently, to
+        spread the instances across instance types or AZs
+    :returns: ids of the launched instances, in priority order of their options
+    :raises RuntimeError: if less than min_count instances could be launched. On this or any other
+        error, including KeyboardInterrupt, the instances already launched are terminated
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if min_count is None:
+        min_count = count
+    launch_kwargs = dict(launch_kwargs)
+    if tags:
+        launch_kwargs.setdefault('TagSpecifications', []).append({
+            'ResourceType': 'instance',
+            'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()]
+        })
+    available = list(options)
+    instance_ids = []
+    errors = []
+    # launches of the current round not collected yet
+    pending = []
+    try:
+        with ThreadPoolExecutor(spread) as executor:
+            while len(instance_ids) < count and available:
+                remaining = count - len(instance_ids)
+                batch = available[:min(spread, remaining)]
+                # Higher priority options get the remainder of the split
+                shares = [remaining // len(batch) + (1 if i < remaining % len(batch) else 0)
+                          for i in range(len(batch))]
+                pending = [(option, n, executor.submit(_run_instances, ec2_client, option, n, launch_kwargs))
+                           for option, n in zip(batch, shares)]
+                while pending:
+                    option, n, future = pending[0]
+                    try:
+                        ids = future.result()
+                    except botocore.exceptions.ClientError as e:
+                        logging.warning("Couldn't launch %d x %s: %s", n, option, e)
+                        errors.append(e)
+                        ids = []
+                    pending.pop(0)
+                    logging.info("Launched %d/%d x %s: %s", len(ids), n, option, ids)
+                    instance_ids.extend(ids)
+                    if len(ids) < n:
+                        available.remove(option)
+        if len(instance_ids) < min_count:
+            raise RuntimeError("Could only launch {} of {} instances, launched: {} errors: {}".format(
+                len(instance_ids), count, instance_ids, [str(e) for e in errors]))
+    except BaseException:
+        # The executor waited for the rest of the round, keep what it launched
+        for _, _, future in pending:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                instance_ids.extend(future.result())
+        if instance_ids:
+            logging.warning("Terminating the %d instances launched", len(instance_ids))
+            ec2_client.terminate_instances(InstanceIds=instance_ids)
+        raise
+    return instance_ids
+
+
 def create_instances(
         ec2: object,
         tag: str,
@@ -513,16 +1707,21 @@ def create_instances(
         security_groups: List[str],
         userdata,
         create_instance_kwargs: Dict,
-        instanceCount: int = 1):
-
+        instanceCount: int = 1,
+        launch_options: Optional[Sequence[LaunchOption]] = None,
+        tags: Optional[Dict[str, str]] = None):
+    """
+    Launch instances tagged with Name=tag and the given tags
+    :param launch_options: prioritized instance type / subnet / AZ alternatives, instance_type if None
+    :returns: list of boto3 instances
+    """
     logging.info("Launching {} instances".format(instanceCount))
-    kwargs = {'ImageId': ami, 'MinCount': instanceCount, 'MaxCount': instanceCount, 'KeyName': keyName, 'InstanceType': instance_type}
+    kwargs = {'ImageId': ami, 'KeyName': keyName}
 
-    if type(userdata) is list and len(userdata) > 1:
-        kwargs['UserData'] = assemble_userdata(*userdata).as_string()
+    if type(userdata) is list and userdata and type(userdata[0]) in (list, tuple):
+        kwargs['UserData'] = build_userdata(userdata)
     elif type(userdata) is list and len(userdata) == 1:
-        with open(userdata[0], 'r') as f:
-            kwargs['UserData'] = f.read()
+        kwargs['UserData'] = build_userdata([(userdata[0], 'text/x-shellscript')])
     elif type(userdata) is str:
         kwargs['UserData'] = userdata
     else:
@@ -534,14 +1733,12 @@ def create_instances(
     else:
         kwargs['SecurityGroupIds'] = security_groups
     kwargs.update(create_instance_kwargs)
-    instances = ec2.create_instances(**kwargs)
-    ec2.create_tags(
-        Resources=[instance.id for instance in instances], Tags=[
-            {'Key': 'Name', 'Value': tag}
-        ]
-    )
-
-    return instances
+    if not launch_options:
+        launch_options = [LaunchOption(instance_type)]
+    all_tags = {'Name': tag}
+    all_tags.update(tags or {})
+    instance_ids = launch_fleet(ec2.meta.client, instanceCount, launch_options, kwargs, all_tags)
+    return [ec2.Instance(instance_id) for instance_id in instance_ids]
 
 
 def create_image(
@@ -559,6 +1756,188 @@ def create_image(
     return ec2.create_image(**kwargs)['ImageId']
 
 
+IMAGE_FAILED_STATES = {'invalid', 'deregistered', 'failed', 'error'}
+AMI_ID_RE = re.compile(r'\bami-[0-9a-f]+\b')
+# Seconds an image just created or copied might not be found yet, EC2 is eventually consistent
+IMAGE_NOT_FOUND_GRACE_S = 60
+
+
+def _describe_images(ec2_client, ami_ids: Sequence[str]) -> Dict[str, Dict]:
+    """
+    :returns: dict of AMI id -> describe_images record. Images which EC2 doesn't know about, as it
+        happens right after creating or copying them, are left out.
+    """
+    res = {}
+    for ids in _chunks(list(ami_ids), EC2_DESCRIBE_MAX_IDS):
+        ids = list(ids)
+        while ids:
+            try:
+                for image in ec2_client.describe_images(ImageIds=ids)['Images']:
+                    res[image['ImageId']] = image
+                break
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'InvalidAMIID.NotFound':
+                    raise
+                # The whole batch fails, ask again for the ones the error doesn't mention
+                missing = set(AMI_ID_RE.findall(e.response['Error'].get('Message', '')))
+                logging.debug("Images %s not found yet", sorted(missing))
+                ids = [] if not missing & set(ids) else [x for x in ids if x not in missing]
+    return res
+
+
+def _create_image_tags(ec2_client, ami_id: str, tags: List[Dict], grace_s: float = IMAGE_NOT_FOUND_GRACE_S,
+                       delay_s: float = 2) -> None:
+    """Tag an image just created or copied, which EC2 might not find yet"""
+    import time
+    end = time.time() + grace_s
+    while True:
+        try:
+            ec2_client.create_tags(Resources=[ami_id], Tags=tags)
+            return
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidAMIID.NotFound' or time.time() >= end:
+                raise
+            logging.debug("Image %s not found yet to tag it", ami_id)
+            time.sleep(delay_s)
+
+
+def image_progress(ec2_client, ami_ids: Sequence[str]) -> Dict[str, Tuple[str, float]]:
+    """
+    :returns: dict of AMI id -> (state, percent complete). While the image is pending the percent is
+        the mean progress of its EBS snapshots. Images EC2 doesn't find have the state 'not-found'.
+    """
+    images = _describe_images(ec2_client, ami_ids)
+    snapshots = {image_id: [x['Ebs']['SnapshotId'] for x in image.get('BlockDeviceMappings', [])
+                            if x.get('Ebs', {}).get('SnapshotId')]
+                 for image_id, image in images.items() if image['State'] == 'pending'}
+    snapshot_ids = sorted(set(itertools.chain.from_iterable(snapshots.values())))
+    snapshot_progress = {}
+    for chunk in _chunks(snapshot_ids, EC2_DESCRIBE_MAX_IDS):
+        for snapshot in ec2_client.describe_snapshots(SnapshotIds=chunk)['Snapshots']:
+            snapshot_progress[snapshot['SnapshotId']] = float(snapshot.get('Progress', '').rstrip('%') or 0)
+    res = {}
+    for ami_id in ami_ids:
+        if ami_id not in images:
+            res[ami_id] = ('not-found', 0.0)
+        elif images[ami_id]['State'] == 'available':
+            res[ami_id] = ('available', 100.0)
+        else:
+            progress = [snapshot_progress.get(x, 0.0) for x in snapshots.get(ami_id, [])]
+            res[ami_id] = (images[ami_id]['State'], sum(progress) / len(progress) if progress else 0.0)
+    return res
+
+
+def wait_image_snapshots(ec2_client, ami_id: str, timeout: Optional[float] = 600, delay_s: float = 2,
+                         not_found_grace_s: float = IMAGE_NOT_FOUND_GRACE_S) -> float:
+    """
+    Wait until every EBS volume of an image being created has its snapshot started. The snapshots
+    are point in time from then on, so an instance imaged with NoReboot can be written again.
+
+    :param not_found_grace_s: seconds the image is considered pending while EC2 doesn't find it
+    :returns: seconds waited
+    :raises RuntimeError: if the image fails or is not found after the grace period
+    :raises TimeoutError: if the snapshots are not started before the timeout
+    """
+    import time
+    start = time.time()
+    while True:
+        image = _describe_images(ec2_client, [ami_id]).get(ami_id)
+        if image is None:
+            if time.time() - start > not_found_grace_s:
+                raise RuntimeError("Image {} not found after {} s".format(ami_id, not_found_grace_s))
+        elif image['State'] in IMAGE_FAILED_STATES:
+            raise RuntimeError("Image {} failed: {}".format(ami_id, image['State']))
+        else:
+            volumes = [x['Ebs'] for x in image.get('BlockDeviceMappings', []) if 'Ebs' in x]
+            if image['State'] == 'available' or (volumes and all(x.get('SnapshotId') for x in volumes)):
+                elapsed = time.time() - start
+                logging.info("Snapshots of AMI %s started after %.1f s", ami_id, elapsed)
+                return elapsed
+        now = time.time()
+        if timeout and now - start >= timeout:
+            raise TimeoutError("Snapshots of image {} not started after {} s".format(ami_id, timeout))
+        time.sleep(min(delay_s, start + timeout - now) if timeout else delay_s)
+
+
+def wait_images_available(ec2_client, ami_ids: Sequence[str], timeout: Optional[float] = 3600,
+                          min_delay_s: float = 5, max_delay_s: float = 60,
+                          not_found_grace_s: float = IMAGE_NOT_FOUND_GRACE_S) -> Dict[str, float]:
+    """
+    Wait until the given AMIs are available logging their percent complete. The poll interval
+    follows the estimated time left from the snapshot progress rate.
+
+    :param timeout: in seconds, if None wait forever
+    :param not_found_grace_s: seconds the images are considered pending while EC2 doesn't find them,
+        as it happens right after copy_image
+    :returns: dict of AMI id -> seconds until it was available
+    :raises RuntimeError: if an image fails or is not found after the grace period
+    :raises TimeoutError: if the images are not available before the timeout
+    """
+    import time
+    start = time.time()
+    pending = {ami_id: None for ami_id in ami_ids}
+    res = {}
+    delay_s = min_delay_s
+    while pending:
+        progress = image_progress(ec2_client, list(pending))
+        elapsed = time.time() - start
+        failed = sorted(ami_id for ami_id, (state, _) in progress.items() if state in IMAGE_FAILED_STATES
+                        or (state == 'not-found' and elapsed > not_found_grace_s))
+        if failed:
+            raise RuntimeError("Images {} failed: {}".format(failed, {x: progress[x][0] for x in failed}))
+        etas = []
+        for ami_id, (state, percent) in progress.items():
+            if state == 'available':
+                del pending[ami_id]
+                res[ami_id] = elapsed
+                logging.info("AMI %s available after %.0f s", ami_id, elapsed)
+                continue
+            if percent != pending[ami_id]:
+                logging.info("AMI %s %s %.0f%%", ami_id, state, percent)
+                pending[ami_id] = percent
+            if percent > 0:
+                etas.append(elapsed * (100 - percent) / percent)
+        if not pending:
+            break
+        if timeout and elapsed + min_delay_s > timeout:
+            raise TimeoutError("Images {} not available after {} s".format(sorted(pending), timeout))
+        # Poll about 4 times in the remaining time, slowly growing while there's no estimate yet
+        delay_s = min(max(min(etas) / 4, min_delay_s), max_delay_s) if etas else min(delay_s * 1.5, max_delay_s)
+        logging.debug("Waiting %.1f s for images %s", delay_s, sorted(pending))
+        time.sleep(delay_s)
+    return res
+
+
+def copy_image_to_regions(ec2_client, ami_id: str, regions: Sequence[str], wait: bool = True,
+                          timeout: Optional[float] = 3600) -> Dict[str, str]:
+    """
+    Copy an AMI with its name, description and tags to several regions concurrently
+    :param ec2_client: boto3 ec2 client of the region of the AMI
+    :param wait: wait in parallel until all the copies are available
+    :returns: dict of region -> AMI id of the copy
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    source_region = ec2_client.meta.region_name
+    image = ec2_client.describe_images(ImageIds=[ami_id])['Images'][0]
+    regions = [x for x in regions if x != source_region]
+
+    def copy(region: str) -> str:
+        client = aws_client('ec2', region)
+        copy_id = client.copy_image(SourceImageId=ami_id, SourceRegion=source_region, Name=image['Name'],
+                                    Description=image.get('Description', ''))['ImageId']
+        logging.info("Copying AMI %s to %s: %s", ami_id, region, copy_id)
+        if image.get('Tags'):
+            _create_image_tags(client, copy_id, image['Tags'])
+        if wait:
+            wait_images_available(client, [copy_id], timeout)
+        return copy_id
+
+    if not regions:
+        return {}
+    with ThreadPoolExecutor(len(regions)) as executor:
+        return dict(zip(regions, executor.map(copy, regions)))
+
+
 def create_ssh_anywhere_sg(ec2_client, ec2_resource):
     sec_group_name = 'ssh_anywhere'
     try:
@@ -0,0 +1,91 @@
+"""Local stand-in for the EC2 instance metadata service"""
+import http.server
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+
+class MetadataServer:
+    """
+    Serves documents under /latest like the instance metadata service, on a free local port. Point
+    InstanceMetadata at it with the endpoint argument or AWS_EC2_METADATA_SERVICE_ENDPOINT.
+
+        with MetadataServer({'meta-data/instance-type': 'p3.2xlarge'}) as server:
+            InstanceMetadata(server.endpoint).instance_type()
+    """
+    def __init__(self, documents: Dict[str, str], token_mode: str = 'v2'):
+        """
+        :param documents: path under /latest -> body
+        :param token_mode: 'v2' issues and requires session tokens, 'v1' answers the token PUT with
+            403 and serves without tokens, 'hang' never answers the token PUT, like a service behind
+            a hop limit, and serves without tokens
+        """
+        assert token_mode in ('v2', 'v1', 'hang')
+        self.documents = documents
+        self.token_mode = token_mode
+        # method, path, token
+        self.requests: List[tuple] = []
+        # token -> expiration time
+        self.tokens: Dict[str, float] = {}
+        self._released = threading.Event()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code: int, body: str = '') -> None:
+                data = body.encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_PUT(self):
+                server.requests.append(('PUT', self.path, None))
+                if self.path != '/latest/api/token':
+                    return self._reply(404)
+                if server.token_mode == 'hang':
+                    server._released.wait(5)
+                    return
+                if server.token_mode == 'v1':
+                    return self._reply(403)
+                token = uuid.uuid4().hex
+                server.tokens[token] = time.time() + int(self.headers['X-aws-ec2-metadata-token-ttl-seconds'])
+                self._reply(200, token)
+
+            def do_GET(self):
+                token = self.headers.get('X-aws-ec2-metadata-token')
+                server.requests.append(('GET', self.path, token))
+                if server.token_mode == 'v2' and server.tokens.get(token, 0) < time.time():
+                    return self._reply(401)
+                path = self.path[len('/latest/'):] if self.path.startswith('/latest/') else None
+                if path not in server.documents:
+                    return self._reply(404)
+                self._reply(200, server.documents[path])
+
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def endpoint(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_address[1])
+
+    def expire_tokens(self) -> None:
+        self.tokens.clear()
+
+    def count(self, method: str, path: Optional[str] = None) -> int:
+        return sum(1 for m, p, _ in self.requests if m == method and (path is None or p == path))
+
+    def __enter__(self) -> 'MetadataServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._released.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
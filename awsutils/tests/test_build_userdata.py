@@ -0,0 +1,60 @@
+import email
+import gzip
+import os
+
+import pytest
+import yaml
+
+from awsutils import USERDATA_MAX_BYTES, build_userdata
+
+AMI_GENERATION_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                  'ami_generation')
+LAUNCH_TEMPLATES = ['linux/launch_template.yaml', 'linux_gpu/launch_template.yaml']
+
+
+def _user_data(launch_template):
+    with open(os.path.join(AMI_GENERATION_DIR, launch_template)) as f:
+        return [tuple(x) for x in yaml.safe_load(f)['user-data']]
+
+
+@pytest.mark.parametrize('launch_template', LAUNCH_TEMPLATES)
+def test_shipped_user_data_fits(launch_template, monkeypatch):
+    monkeypatch.chdir(AMI_GENERATION_DIR)
+    userdata_files = _user_data(launch_template)
+
+    payload = build_userdata(userdata_files)
+
+    # keep room to grow, the scripts are sent whole
+    assert len(payload) < 0.85 * USERDATA_MAX_BYTES
+    message = email.message_from_bytes(gzip.decompress(payload))
+    parts = message.get_payload()
+    assert [x.get_content_type() for x in parts] == [mimetype for _, mimetype in userdata_files]
+    for (fname, _), part in zip(userdata_files, parts):
+        with open(fname) as f:
+            assert part.get_payload(decode=True).decode() == f.read()
+
+
+def test_payload_is_cached_and_reproducible(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    (tmp_path / 'cloud-config').write_text('#cloud-config\npackages: [python3]\n')
+    (tmp_path / 'script.sh').write_text('#!/bin/sh\necho hello\n')
+    files = [('cloud-config', 'text/cloud-config'), ('script.sh', 'text/x-shellscript')]
+    first = build_userdata(files)
+    assert build_userdata(files) is first
+    (tmp_path / 'script.sh').write_text('#!/bin/sh\necho bye\n')
+    assert build_userdata(files) != first
+    (tmp_path / 'script.sh').write_text('#!/bin/sh\necho hello\n')
+    assert build_userdata(files) == first
+
+
+def test_single_file_is_sent_as_is(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    (tmp_path / 'script.sh').write_text('#!/bin/sh\necho hello\n')
+    assert build_userdata([('script.sh', 'text/x-shellscript')], compress=False) == b'#!/bin/sh\necho hello\n'
+
+
+def test_over_the_limit(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    (tmp_path / 'big.sh').write_bytes(os.urandom(USERDATA_MAX_BYTES))
+    with pytest.raises(RuntimeError, match='over the limit'):
+        build_userdata([('big.sh', 'text/x-shellscript')])
@@ -0,0 +1,128 @@
+import boto3
+import botocore.exceptions
+import pytest
+from moto import mock_aws
+
+import awsutils
+from awsutils import wait_image_snapshots
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    with mock_aws():
+        yield boto3.client('ec2')
+
+
+def _image(ec2):
+    image_id = ec2.describe_images()['Images'][0]['ImageId']
+    instance_id = ec2.run_instances(ImageId=image_id, MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+    return ec2.create_image(InstanceId=instance_id, Name='layer', NoReboot=True)['ImageId']
+
+
+def _describe_in_states(ec2, monkeypatch, images):
+    """describe_images answers with the given image records one after the other, then the real one"""
+    describe_images = ec2.describe_images
+    calls = []
+
+    def describe(**kwargs):
+        calls.append(kwargs)
+        if len(calls) <= len(images):
+            return {'Images': [dict(images[len(calls) - 1], ImageId=kwargs['ImageIds'][0])]}
+        return describe_images(**kwargs)
+    monkeypatch.setattr(ec2, 'describe_images', describe)
+    return calls
+
+
+def test_snapshots_of_an_available_image(ec2):
+    assert wait_image_snapshots(ec2, _image(ec2)) >= 0
+
+
+def test_waits_for_every_snapshot_to_start(ec2, monkeypatch):
+    ami_id = _image(ec2)
+    calls = _describe_in_states(ec2, monkeypatch, [
+        {'State': 'pending', 'BlockDeviceMappings': []},
+        {'State': 'pending', 'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {'SnapshotId': 'snap-1'}},
+                                                     {'DeviceName': '/dev/sdf', 'Ebs': {}}]},
+        {'State': 'pending', 'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {'SnapshotId': 'snap-1'}},
+                                                     {'DeviceName': '/dev/sdf', 'Ebs': {'SnapshotId': 'snap-2'}},
+                                                     {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'}]},
+    ])
+    wait_image_snapshots(ec2, ami_id)
+    assert len(calls) == 3
+
+
+def test_failed_image(ec2, monkeypatch):
+    ami_id = _image(ec2)
+    _describe_in_states(ec2, monkeypatch, [{'State': 'failed'}])
+    with pytest.raises(RuntimeError, match='failed'):
+        wait_image_snapshots(ec2, ami_id)
+
+
+def test_snapshots_timeout(ec2, monkeypatch):
+    ami_id = _image(ec2)
+    _describe_in_states(ec2, monkeypatch, [{'State': 'pending'}] * 1000)
+    clock = iter(range(1000))
+    monkeypatch.setattr(awsutils.time, 'time', lambda: next(clock))
+    with pytest.raises(TimeoutError):
+        wait_image_snapshots(ec2, ami_id, timeout=10)
+
+
+def _not_found(ami_ids):
+    return botocore.exceptions.ClientError({'Error': {
+        'Code': 'InvalidAMIID.NotFound',
+        'Message': "The image ids '[{}]' do not exist".format(', '.join(ami_ids))}}, 'DescribeImages')
+
+
+def _unknown_first(client, monkeypatch, unknown, times):
+    """describe_images and create_tags fail like EC2 for the unknown images in the first calls"""
+    calls = []
+    for method, ids_param in [('describe_images', 'ImageIds'), ('create_tags', 'Resources')]:
+        def call(f=getattr(client, method), ids_param=ids_param, **kwargs):
+            calls.append(kwargs)
+            missing = [x for x in kwargs[ids_param] if x in unknown]
+            if missing and len(calls) <= times:
+                raise _not_found(missing)
+            return f(**kwargs)
+        monkeypatch.setattr(client, method, call)
+    return calls
+
+
+def test_describe_leaves_out_images_not_found(ec2, monkeypatch):
+    ami_id = _image(ec2)
+    unknown = 'ami-0123456789abcdef0'
+    calls = _unknown_first(ec2, monkeypatch, {unknown}, 1)
+    assert list(awsutils._describe_images(ec2, [unknown, ami_id])) == [ami_id]
+    assert [x['ImageIds'] for x in calls] == [[unknown, ami_id], [ami_id]]
+
+
+def test_copy_not_found_right_after_copy_image(ec2, monkeypatch):
+    ami_id = _image(ec2)
+    ec2.create_tags(Resources=[ami_id], Tags=[{'Key': 'Name', 'Value': 'layer'}])
+    west = boto3.client('ec2', 'us-west-2')
+    copy_image = west.copy_image
+
+    def copy(**kwargs):
+        res = copy_image(**kwargs)
+        calls[:] = [_unknown_first(west, monkeypatch, {res['ImageId']}, 3)]
+        return res
+    calls = []
+    monkeypatch.setattr(west, 'copy_image', copy)
+    monkeypatch.setattr(awsutils, 'aws_client', lambda service, region: west)
+
+    copies = awsutils.copy_image_to_regions(ec2, ami_id, ['us-east-1', 'us-west-2'])
+
+    assert list(copies) == ['us-west-2']
+    # tagging and waiting went on after the copy wasn't found
+    assert len(calls[0]) > 3
+    image = west.describe_images(ImageIds=[copies['us-west-2']])['Images'][0]
+    assert image['State'] == 'available'
+    assert image['Tags'] == [{'Key': 'Name', 'Value': 'layer'}]
+
+
+def test_image_not_found_after_grace(ec2, monkeypatch):
+    clock = iter(range(0, 1000, 10))
+    monkeypatch.setattr(awsutils.time, 'time', lambda: next(clock))
+    with pytest.raises(RuntimeError, match='not-found'):
+        awsutils.wait_images_available(ec2, ['ami-0123456789abcdef0'], not_found_grace_s=30)
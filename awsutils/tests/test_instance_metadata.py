@@ -0,0 +1,86 @@
+import json
+import time
+
+import pytest
+
+from awsutils import InstanceMetadata
+from imds_server import MetadataServer
+
+DOCUMENTS = {
+    'meta-data/instance-type': 'p3.2xlarge',
+    'meta-data/public-ipv4': '54.1.2.3',
+    'meta-data/placement/region': 'us-west-2',
+    'dynamic/instance-identity/document': json.dumps({'instanceId': 'i-0123456789abcdef0', 'region': 'us-west-2'}),
+}
+
+
+def test_token_is_reused_and_immutable_documents_memoized():
+    with MetadataServer(DOCUMENTS) as server:
+        metadata = InstanceMetadata(server.endpoint)
+        assert metadata.instance_type() == 'p3.2xlarge'
+        assert metadata.instance_type() == 'p3.2xlarge'
+        assert metadata.identity()['instanceId'] == 'i-0123456789abcdef0'
+        assert metadata.get('meta-data/public-ipv4') == '54.1.2.3'
+        assert metadata.get('/meta-data/public-ipv4/') == '54.1.2.3'
+    assert server.count('PUT') == 1
+    assert server.count('GET', '/latest/meta-data/instance-type') == 1
+    # not memoized, an elastic ip can change
+    assert server.count('GET', '/latest/meta-data/public-ipv4') == 2
+    assert all(token for method, _, token in server.requests if method == 'GET')
+
+
+def test_expired_token_is_refreshed():
+    with MetadataServer(DOCUMENTS) as server:
+        metadata = InstanceMetadata(server.endpoint)
+        first = metadata.token()
+        server.expire_tokens()
+        assert metadata.get('meta-data/public-ipv4') == '54.1.2.3'
+        assert metadata.token() != first
+    assert server.count('PUT') == 2
+    assert server.requests[-1][2] == metadata.token()
+
+
+def test_token_refreshed_before_ttl_ends():
+    with MetadataServer(DOCUMENTS) as server:
+        metadata = InstanceMetadata(server.endpoint, token_ttl_s=61)
+        metadata.get('meta-data/public-ipv4')
+        time.sleep(1.1)
+        metadata.get('meta-data/public-ipv4')
+    assert server.count('PUT') == 2
+
+
+def test_imdsv1_fallback_when_tokens_are_refused():
+    with MetadataServer(DOCUMENTS, token_mode='v1') as server:
+        metadata = InstanceMetadata(server.endpoint)
+        assert metadata.token() is None
+        assert metadata.instance_type() == 'p3.2xlarge'
+    assert [token for method, _, token in server.requests if method == 'GET'] == [None]
+
+
+def test_imdsv1_fallback_when_token_request_times_out():
+    with MetadataServer(DOCUMENTS, token_mode='hang') as server:
+        metadata = InstanceMetadata(server.endpoint, timeout_s=0.2)
+        start = time.time()
+        assert metadata.instance_type() == 'p3.2xlarge'
+        assert metadata.get('meta-data/public-ipv4') == '54.1.2.3'
+        assert time.time() - start < 2
+    # the token isn't asked again for every request
+    assert server.count('PUT') == 1
+
+
+def test_get_many_and_endpoint_from_environment(monkeypatch):
+    with MetadataServer(DOCUMENTS) as server:
+        monkeypatch.setenv('AWS_EC2_METADATA_SERVICE_ENDPOINT', server.endpoint)
+        metadata = InstanceMetadata()
+        paths = ['meta-data/instance-type', 'meta-data/public-ipv4', 'meta-data/placement/region']
+        assert metadata.get_many(paths) == {x: DOCUMENTS[x] for x in paths}
+    assert server.count('PUT') == 1
+
+
+def test_missing_document_raises():
+    import urllib.error
+    with MetadataServer(DOCUMENTS) as server:
+        metadata = InstanceMetadata(server.endpoint)
+        with pytest.raises(urllib.error.HTTPError) as e:
+            metadata.get('meta-data/spot/instance-action')
+    assert e.value.code == 404
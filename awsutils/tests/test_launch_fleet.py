@@ -0,0 +1,108 @@
+import boto3
+import botocore.exceptions
+import pytest
+from moto import mock_aws
+
+import awsutils
+from awsutils import LaunchOption, launch_fleet
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        client = boto3.client('ec2')
+        run_instances = client.run_instances
+
+        def run_max_count(**kwargs):
+            # moto launches MinCount instances, EC2 launches MaxCount when there is capacity
+            return run_instances(**dict(kwargs, MinCount=kwargs['MaxCount']))
+        monkeypatch.setattr(client, 'run_instances', run_max_count)
+        yield client
+
+
+@pytest.fixture
+def launch_kwargs(ec2):
+    return {'ImageId': ec2.describe_images()['Images'][0]['ImageId']}
+
+
+def _running(ec2):
+    res = ec2.describe_instances(Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running']}])
+    return sorted(x['InstanceId'] for r in res['Reservations'] for x in r['Instances'])
+
+
+def _instance_types(ec2, ids):
+    res = ec2.describe_instances(InstanceIds=ids)
+    return {x['InstanceId']: x['InstanceType'] for r in res['Reservations'] for x in r['Instances']}
+
+
+def test_launch_on_first_option(ec2, launch_kwargs):
+    options = [LaunchOption('c5.large'), LaunchOption('m5.large')]
+    ids = launch_fleet(ec2, 5, options, launch_kwargs, tags={'Name': 'fleet'})
+    assert sorted(ids) == _running(ec2)
+    assert len(ids) == 5
+    assert set(_instance_types(ec2, ids).values()) == {'c5.large'}
+
+
+def test_launch_spread_across_options(ec2, launch_kwargs):
+    options = [LaunchOption('c5.large'), LaunchOption('m5.large'), LaunchOption('r5.large')]
+    ids = launch_fleet(ec2, 5, options, launch_kwargs, spread=2)
+    types = _instance_types(ec2, ids)
+    assert [types[x] for x in ids] == ['c5.large'] * 3 + ['m5.large'] * 2
+
+
+def _failing_option(monkeypatch, instance_type, error):
+    run_instances = awsutils._run_instances
+
+    def run(ec2_client, option, count, kwargs):
+        if option.instance_type == instance_type:
+            raise error
+        return run_instances(ec2_client, option, count, kwargs)
+    monkeypatch.setattr(awsutils, '_run_instances', run)
+
+
+def test_failed_option_falls_back_to_the_next(ec2, launch_kwargs, monkeypatch):
+    error = botocore.exceptions.ClientError({'Error': {'Code': 'InsufficientInstanceCapacity'}}, 'RunInstances')
+    _failing_option(monkeypatch, 'p3.2xlarge', error)
+    options = [LaunchOption('p3.2xlarge'), LaunchOption('g4dn.xlarge'), LaunchOption('g4dn.2xlarge')]
+    ids = launch_fleet(ec2, 4, options, launch_kwargs)
+    assert list(_instance_types(ec2, ids).values()) == ['g4dn.xlarge'] * 4
+
+
+def test_only_shortfall_falls_back(ec2, launch_kwargs, monkeypatch):
+    run_instances = awsutils._run_instances
+    counts = []
+
+    def run(ec2_client, option, count, kwargs):
+        counts.append((option.instance_type, count))
+        # partial fulfilment on the first option
+        return run_instances(ec2_client, option, 3 if option.instance_type == 'p3.2xlarge' else count, kwargs)
+    monkeypatch.setattr(awsutils, '_run_instances', run)
+    options = [LaunchOption('p3.2xlarge'), LaunchOption('g4dn.xlarge'), LaunchOption('g4dn.2xlarge')]
+    ids = launch_fleet(ec2, 5, options, launch_kwargs)
+    assert len(ids) == 5
+    assert counts == [('p3.2xlarge', 5), ('g4dn.xlarge', 2)]
+
+
+def test_shortfall_terminates_launched(ec2, launch_kwargs, monkeypatch):
+    run_instances = awsutils._run_instances
+
+    def run(ec2_client, option, count, kwargs):
+        if option.instance_type == 'p3.2xlarge':
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InsufficientInstanceCapacity'}}, 'RunInstances')
+        # partial fulfilment
+        return run_instances(ec2_client, option, 1, kwargs)
+    monkeypatch.setattr(awsutils, '_run_instances', run)
+    with pytest.raises(RuntimeError, match='Could only launch 1 of 4'):
+        launch_fleet(ec2, 4, [LaunchOption('g4dn.xlarge'), LaunchOption('p3.2xlarge')], launch_kwargs, spread=2)
+    assert _running(ec2) == []
+
+
+@pytest.mark.parametrize('error', [botocore.exceptions.EndpointConnectionError(endpoint_url='https://ec2'),
+                                   KeyboardInterrupt()])
+def test_other_errors_terminate_launched(ec2, launch_kwargs, monkeypatch, error):
+    _failing_option(monkeypatch, 'p3.2xlarge', error)
+    options = [LaunchOption('g4dn.xlarge'), LaunchOption('p3.2xlarge'), LaunchOption('c5.large')]
+    with pytest.raises(type(error)):
+        launch_fleet(ec2, 6, options, launch_kwargs, spread=3)
+    assert _running(ec2) == []
@@ -0,0 +1,69 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+from awsutils import purge_bucket
+
+BUCKET = 'purge-bucket-test'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _versions(s3):
+    res = s3.list_object_versions(Bucket=BUCKET)
+    return res.get('Versions', []) + res.get('DeleteMarkers', [])
+
+
+@pytest.mark.parametrize('workers', [1, 8])
+def test_purge_versioned_bucket(s3, workers):
+    s3.put_bucket_versioning(Bucket=BUCKET, VersioningConfiguration={'Status': 'Enabled'})
+    keys = ['dir{}/key{}'.format(i % 3, i) if i % 2 else 'key{}'.format(i) for i in range(1100)]
+    for i, key in enumerate(keys):
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b'1')
+        if i % 10 == 0:
+            s3.put_object(Bucket=BUCKET, Key=key, Body=b'2')
+        if i % 5 == 0:
+            s3.delete_object(Bucket=BUCKET, Key=key)
+    expected = 1100 + 110 + 220
+
+    stats = purge_bucket(BUCKET, s3, workers=workers)
+
+    assert (stats.deleted, stats.failed) == (expected, 0)
+    assert _versions(s3) == []
+    s3.delete_bucket(Bucket=BUCKET)
+
+
+def test_purge_unversioned_bucket(s3):
+    for i in range(1500):
+        s3.put_object(Bucket=BUCKET, Key='dir{}/key{}'.format(i % 4, i), Body=b'')
+
+    stats = purge_bucket(BUCKET, s3, versions=False, workers=4)
+
+    assert stats.deleted == 1500
+    assert s3.list_objects_v2(Bucket=BUCKET)['KeyCount'] == 0
+
+
+def test_purge_reports_failed_keys(s3, monkeypatch):
+    for i in range(10):
+        s3.put_object(Bucket=BUCKET, Key='key{}'.format(i), Body=b'')
+    delete_objects = s3.delete_objects
+
+    def fail_first_key(**kwargs):
+        objects = kwargs['Delete']['Objects']
+        res = {}
+        if objects[1:]:
+            res = delete_objects(**dict(kwargs, Delete=dict(kwargs['Delete'], Objects=objects[1:])))
+        res['Errors'] = [dict(objects[0], Code='InternalError')]
+        return res
+    monkeypatch.setattr(s3, 'delete_objects', fail_first_key)
+    monkeypatch.setattr('time.sleep', lambda s: None)
+
+    with pytest.raises(RuntimeError, match="Couldn't delete 1 objects"):
+        purge_bucket(BUCKET, s3, workers=2)
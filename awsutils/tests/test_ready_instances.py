@@ -0,0 +1,94 @@
+import time
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from awsutils import EC2_DESCRIBE_MAX_IDS, _instance_states, iter_ready_instances, wait_for_instances
+
+UNKNOWN_ID = 'i-0123456789abcdef0'
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        yield boto3.client('ec2')
+
+
+def _launch(ec2, count):
+    image_id = ec2.describe_images()['Images'][0]['ImageId']
+    return [x['InstanceId'] for x in ec2.run_instances(ImageId=image_id, MinCount=count, MaxCount=count)['Instances']]
+
+
+def _count_calls(ec2, operation):
+    calls = []
+    ec2.meta.events.register('provide-client-params.ec2.{}'.format(operation),
+                             lambda **kwargs: calls.append(kwargs['params']))
+    return calls
+
+
+def test_states_are_described_in_batches(ec2):
+    ids = _launch(ec2, EC2_DESCRIBE_MAX_IDS + 20)
+    calls = _count_calls(ec2, 'DescribeInstanceStatus')
+
+    states = _instance_states(ec2, ids)
+
+    assert sorted(states) == sorted(ids)
+    assert [len(x['InstanceIds']) for x in calls] == [EC2_DESCRIBE_MAX_IDS, 20]
+
+
+def test_unknown_ids_are_left_out_and_the_rest_asked_again(ec2):
+    ids = _launch(ec2, 3)
+    calls = _count_calls(ec2, 'DescribeInstanceStatus')
+
+    states = _instance_states(ec2, ids + [UNKNOWN_ID])
+
+    assert sorted(states) == sorted(ids)
+    assert [sorted(x['InstanceIds']) for x in calls] == [sorted(ids + [UNKNOWN_ID]), sorted(ids)]
+
+
+def test_ready_instances_are_yielded_with_their_records(ec2):
+    ids = _launch(ec2, 3)
+    records = list(iter_ready_instances(ec2, ids, status_ok=False, timeout=10, min_delay_s=0.1))
+    assert sorted(x['InstanceId'] for x in records) == sorted(ids)
+    assert all(x['State']['Name'] == 'running' and x['PrivateIpAddress'] for x in records)
+
+
+def test_instances_not_found_yet_stay_pending(ec2, monkeypatch):
+    ids = _launch(ec2, 2)
+    describe_instance_status = ec2.describe_instance_status
+    rounds = []
+
+    def not_found_at_first(**kwargs):
+        rounds.append(kwargs['InstanceIds'])
+        if len(rounds) == 1:
+            # right after run_instances EC2 may not know about the instances yet
+            kwargs = dict(kwargs, InstanceIds=kwargs['InstanceIds'] + [UNKNOWN_ID])
+        return describe_instance_status(**kwargs)
+    monkeypatch.setattr(ec2, 'describe_instance_status', not_found_at_first)
+
+    records = list(iter_ready_instances(ec2, ids, status_ok=False, timeout=10, min_delay_s=0.1))
+
+    assert sorted(x['InstanceId'] for x in records) == sorted(ids)
+
+
+def test_timeout_at_the_deadline(ec2):
+    start = time.time()
+    with pytest.raises(TimeoutError, match=UNKNOWN_ID):
+        list(iter_ready_instances(ec2, [UNKNOWN_ID], timeout=1, min_delay_s=0.4, max_delay_s=0.4))
+    assert 1 <= time.time() - start < 1.5
+
+
+def test_stopped_instances_fail(ec2):
+    ids = _launch(ec2, 2)
+    ec2.stop_instances(InstanceIds=ids[:1])
+    with pytest.raises(RuntimeError, match=ids[0]):
+        list(iter_ready_instances(ec2, ids, timeout=10, min_delay_s=0.1))
+
+
+def test_wait_for_instances_is_bounded(ec2):
+    class Instance:
+        id = UNKNOWN_ID
+    with pytest.raises(TimeoutError):
+        wait_for_instances([Instance()], ec2, timeout=0.5)
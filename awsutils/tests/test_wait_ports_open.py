@@ -0,0 +1,109 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import awsutils
+from awsutils import wait_port_open, wait_ports_open
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Listener:
+    """Accepts connections on a local port, optionally after a delay and sending a banner"""
+    def __init__(self, port=0, banner=None, delay_s=0.0):
+        self.port = port or _free_port()
+        self.banner = banner
+        self.delay_s = delay_s
+        self._sock = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def _serve(self):
+        if self._stopped.wait(self.delay_s):
+            return
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', self.port))
+        self._sock.listen()
+        self._sock.settimeout(0.1)
+        while not self._stopped.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            if self.banner is not None:
+                conn.sendall(self.banner)
+            conn.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        if self._sock:
+            self._sock.close()
+
+
+def test_open_port():
+    with Listener() as listener:
+        assert list(wait_ports_open([('127.0.0.1', listener.port)], 5)) == [('127.0.0.1', listener.port, True)]
+
+
+def test_closed_port():
+    port = _free_port()
+    start = time.monotonic()
+    assert list(wait_ports_open([('127.0.0.1', port)], 1.5)) == [('127.0.0.1', port, False)]
+    assert time.monotonic() - start < 5
+
+
+def test_delayed_listener_yields_in_reachable_order():
+    with Listener(delay_s=1.5) as slow, Listener() as fast:
+        start = time.monotonic()
+        res = list(wait_ports_open([('127.0.0.1', slow.port), ('127.0.0.1', fast.port)], 10))
+        elapsed = time.monotonic() - start
+    assert res == [('127.0.0.1', fast.port, True), ('127.0.0.1', slow.port, True)]
+    # bounded by the slowest target, probes retry every second
+    assert elapsed < 5
+
+
+def test_ssh_banner_required():
+    with Listener(banner=b'HTTP/1.1 400 Bad Request\r\n') as http, Listener(banner=b'SSH-2.0-OpenSSH_8.9\r\n') as ssh:
+        res = dict(((h, p), is_open) for h, p, is_open in
+                   wait_ports_open([('127.0.0.1', http.port), ('127.0.0.1', ssh.port)], 1.5, ssh_banner=True))
+    assert res == {('127.0.0.1', http.port): False, ('127.0.0.1', ssh.port): True}
+
+
+def test_dns_errors_are_retried(monkeypatch):
+    open_connection = awsutils.asyncio.open_connection
+    attempts = []
+
+    async def resolving_late(host, port, **kwargs):
+        attempts.append(host)
+        if len(attempts) < 3:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return await open_connection('127.0.0.1', port, **kwargs)
+    monkeypatch.setattr(awsutils.asyncio, 'open_connection', resolving_late)
+    with Listener() as listener:
+        assert wait_port_open('ip-10-0-0-1.ec2.internal', listener.port, 10)
+    assert len(attempts) == 3
+
+
+def test_wait_port_open_timeout():
+    assert not wait_port_open('127.0.0.1', _free_port(), 1)
+
+
+def test_early_exit_cancels_probes():
+    with Listener() as listener:
+        probes = wait_ports_open([('127.0.0.1', listener.port), ('127.0.0.1', _free_port())], 30)
+        assert next(probes)[2]
+        start = time.monotonic()
+        probes.close()
+    assert time.monotonic() - start < 1
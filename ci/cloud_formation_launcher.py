@@ -158,6 +158,8 @@ def config_argparse() -> argparse.ArgumentParser:
                                      epilog="""
 """)
     parser.add_argument('config', nargs='?', help='config file', default='config.yaml')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="only print the change set that would be applied to the stack")
     return parser
 
 
@@ -171,13 +173,9 @@ def main():
     boto3.setup_default_session(region_name=config['aws_region'], profile_name=config['aws_profile'])
 
     template = create_template(config)
-    client = boto3.client('cloudformation')
 
     logging.info(f"Creating stack {config['stack_name']}")
 
-    client = boto3.client('cloudformation')
-    awsutils.delete_stack(client, config['stack_name'])
-
     param_values_dict = parameters_interactive(template)
     tparams = dict(
         TemplateBody=template.to_yaml(),
@@ -185,7 +183,7 @@ def main():
         Capabilities=['CAPABILITY_IAM'],
         #OnFailure = 'DELETE',
     )
-    awsutils.instantiate_CF_template(template, config['stack_name'], **tparams)
+    awsutils.instantiate_CF_template(template, config['stack_name'], dry_run=args.dry_run, **tparams)
     return 0
 
 